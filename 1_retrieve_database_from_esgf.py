@@ -1,14 +1,45 @@
 import os
+import json
 import time
 import logging
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import argparse
+import threading
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, CancelledError, as_completed, wait, FIRST_COMPLETED
 
+import requests
 from pyesgf.search import SearchConnection
+from pyesgf.search.results import FileResult
 from requests.exceptions import HTTPError
 
+from config import experiment_ids, variables, search_domains, search_url
+from metadata_store import MetadataStore, dataset_facets, write_csv
+from metrics import metrics, instrument_session
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+def metadata_record(master_id, data_node, f):
+    """
+    Collects the metadata of a file replica as a record.
+
+    Args:
+        master_id: The dataset ID without the data node.
+        data_node: The data node serving the file.
+        f: The file result object from pyesgf.
+
+    Returns:
+        A dict of file metadata; data_node, download_url and opendap_url are lists of mirrors.
+    """
+    return {'master_id': master_id,
+            'data_node': [data_node],
+            'filename': f.filename,
+            'size': f.size,
+            'download_url': [f.download_url] if f.download_url else [],
+            'opendap_url': [f.opendap_url] if f.opendap_url else [],
+            'checksum': f.checksum or '',
+            'checksum_type': f.checksum_type or ''}
+
 def download_file_metadata(dataset, data_node, retries=3, retry_delay=2):
     """
     Retrieves metadata for files associated with a dataset.
@@ -20,34 +51,104 @@ def download_file_metadata(dataset, data_node, retries=3, retry_delay=2):
         retry_delay: Time in seconds to wait between retries.
 
     Returns:
-        A list of strings, each containing file metadata, or None if retrieval fails after retries.
+        A list of file metadata records, or None if retrieval fails after retries.
     """
+    index_node = urlparse(dataset.context.connection.url).netloc
     for attempt in range(retries):
         try:
-            files = dataset.file_context().search()
-            metadata_lines = []
-            for f in files:
-                metadata_lines.append(
-                   ','.join(str(item) if item is not None else '' for item in
-                           [dataset.dataset_id.split('|')[0],
-                            data_node,
-                            f.filename,
-                            f.size,
-                            f.download_url,
-                            f.opendap_url]
-                    )
-                )
-            return metadata_lines  # Success, return the list of metadata
+            with metrics.timer('file_listing_seconds', node=index_node):
+                files = dataset.file_context().search()
+                metadata_records = [metadata_record(dataset.dataset_id.split('|')[0], data_node, f) for f in files]
+            return metadata_records  # Success, return the list of metadata
         except HTTPError as e:
             logging.warning(f"HTTPError retrieving file metadata (attempt {attempt+1}/{retries}) for dataset {dataset.dataset_id}. Error: {e}")
             if attempt < retries - 1:
+                metrics.inc('search_retries_total', node=index_node)
                 time.sleep(retry_delay)
             else:
                 logging.error(f"Failed to retrieve file metadata for dataset {dataset.dataset_id} after {retries} retries.")
                 return None  # Failed after all retries
 
+def bulk_file_metadata(conn, datasets, page_size=500, batch_size=50, retries=3, retry_delay=2):
+    """
+    Retrieves metadata for the files of many datasets with paginated File-type searches.
+
+    Each search asks for the files of batch_size datasets at once, page_size files per request.
+
+    Args:
+        conn: An ESGF SearchConnection object.
+        datasets: A list of (dataset, data_node) pairs.
+        page_size: Number of files per request.
+        batch_size: Number of datasets per search.
+        retries: Number of times to retry a request on HTTP errors.
+        retry_delay: Time in seconds to wait between retries.
+
+    Returns:
+        A dict mapping the dataset ID to a list of file metadata records.
+        Datasets whose search failed after retries are left out.
+    """
+    fields = 'dataset_id,title,size,url,checksum,checksum_type'
+    listings = {}
+    for start in range(0, len(datasets), batch_size):
+        batch = datasets[start:start + batch_size]
+        query = [('type', 'File'), ('fields', fields)] + [('dataset_id', dataset.dataset_id) for dataset, _ in batch]
+        batch_listings = {dataset.dataset_id: [] for dataset, _ in batch}
+        offset = 0
+        num_found = 1
+        try:
+            while offset < num_found:
+                for attempt in range(retries):
+                    try:
+                        with metrics.timer('file_listing_seconds', node=urlparse(conn.url).netloc):
+                            response = conn.send_search(query, limit=page_size, offset=offset)['response']
+                        break
+                    except HTTPError as e:
+                        logging.warning(f"HTTPError retrieving file metadata (attempt {attempt+1}/{retries}) for {len(batch)} datasets. Error: {e}")
+                        if attempt < retries - 1:
+                            metrics.inc('search_retries_total', node=urlparse(conn.url).netloc)
+                            time.sleep(retry_delay)
+                        else:
+                            raise
+                num_found = response['numFound']
+                for doc in response['docs']:
+                    dataset_id = doc['dataset_id']
+                    if dataset_id in batch_listings:
+                        master_id, data_node = dataset_id.split('|')
+                        batch_listings[dataset_id].append(metadata_record(master_id, data_node, FileResult(doc, None)))
+                if not response['docs']:
+                    break
+                offset += len(response['docs'])
+        except Exception as e:
+            logging.error(f"Failed to retrieve file metadata for {len(batch)} datasets: {e}")
+            continue
+        listings.update(batch_listings)
+    return listings
+
+def collapse_replicas(records):
+    """
+    Collapses the metadata records of identical files on different data nodes into one record.
+
+    Files are identical if they have the same dataset ID, file name and checksum. The data nodes,
+    download urls and opendap urls of the replicas are merged.
+
+    Args:
+        records: A list of file metadata records, one per replica.
+
+    Returns:
+        A list of file metadata records, one per file.
+    """
+    collapsed = {}
+    for record in records:
+        key = (record['master_id'], record['filename'], record['checksum'])
+        if key not in collapsed:
+            collapsed[key] = dict(record, data_node=[], download_url=[], opendap_url=[])
+        for column in ['data_node', 'download_url', 'opendap_url']:
+            for value in record[column]:
+                if value not in collapsed[key][column]:
+                    collapsed[key][column].append(value)
+    return list(collapsed.values())
 
-def search_cmip_data(experiment_id, variable, conn, retry_delay=2):
+def search_cmip_data(experiment_id, variable, conn, retry_delay=2, cache=None, bulk=False, page_size=500, batch_size=50):
     '''
     Searches for CMIP data using ESGF API and returns file metadata.
 
@@ -56,9 +157,37 @@ def search_cmip_data(experiment_id, variable, conn, retry_delay=2):
         variable: The variable to search for.
         conn: An ESGF SearchConnection object.
         retry_delay: Time in seconds to wait between retries when connecting to a new ESGF node.
+        cache: MetadataCache of file listings from previous runs; only datasets missing from it are listed.
+        bulk: If True, list the files with paginated File-type searches over many datasets at once
+              and collapse the replicas of each file into one record.
+        page_size: Number of files per request in bulk mode.
+        batch_size: Number of datasets per search in bulk mode.
 
     Returns:
-        A list of strings, each a comma-separated line of file metadata, or an empty list if no suitable data is found.
+        A list of file metadata records, or an empty list if no suitable data is found.
+    '''
+    try:
+        datasets = search_datasets(experiment_id, variable, conn)
+    except Exception as e:
+        logging.error(f"Error during search for {experiment_id}.{variable}: {e}")
+        return [] # Return empty list if search fails
+    return list_files(experiment_id, variable, conn, datasets, retry_delay, cache, bulk, page_size, batch_size)
+
+def search_datasets(experiment_id, variable, conn, stop=None):
+    '''
+    Searches for the datasets of an (experiment_id, variable) combination (the dataset query only, no file listings).
+
+     Args:
+        experiment_id: The experiment ID to search for.
+        variable: The variable to search for.
+        conn: An ESGF SearchConnection object.
+        stop: threading.Event; once set, no further pages of results are requested (CancelledError is raised).
+
+    Returns:
+        A dict mapping each master_id to its (dataset, data_node) replicas.
+
+    Raises:
+        Exception: If the search fails.
     '''
 
     facets = 'project,source_id,experiment_id,variable,frequency,latest'
@@ -77,16 +206,13 @@ def search_cmip_data(experiment_id, variable, conn, retry_delay=2):
     }
 
     ctx = conn.new_context(**kwargs)
-    try:
-        results = ctx.search()
-    except Exception as e:
-        logging.error(f"Error during search for {experiment_id}.{variable}: {e}")
-        return [] # Return empty list if search fails
-
-    results = ctx.search()
+    # the facet counts are not used: skip the extra request for them
+    results = ctx.search(ignore_facet_check=True)
 
     datasets = {}
     for result in results:
+        if stop is not None and stop.is_set():
+            raise CancelledError(f"search for {experiment_id}.{variable} dropped")
         master_id, data_node = result.dataset_id.split('|')
         project, activity_id, institution_id, source_id, experiment_id, variant_label, freq, variable, grid_label, *_ = master_id.split('.')
         if frequency == 'mon' and freq != 'Amon':
@@ -94,54 +220,282 @@ def search_cmip_data(experiment_id, variable, conn, retry_delay=2):
         datasets.setdefault(master_id, []).append((result, data_node))
 
     logging.info(f"{len(datasets)} datasets found for {experiment_id}.{variable}")
+    return datasets
+
+def list_files(experiment_id, variable, conn, datasets, retry_delay=2, cache=None, bulk=False, page_size=500, batch_size=50):
+    '''
+    Lists the files of the datasets found by search_datasets.
+
+     Args:
+        experiment_id: The experiment ID searched for.
+        variable: The variable searched for.
+        conn: The ESGF SearchConnection the datasets were found on.
+        datasets: A dict mapping each master_id to its (dataset, data_node) replicas.
+        retry_delay, cache, bulk, page_size, batch_size: As in search_cmip_data.
+
+    Returns:
+        A list of file metadata records.
+    '''
+
+    # reuse the file listings of datasets (and versions) seen in previous runs
+    records = []
+    to_list = []
+    for master_id, data_nodes in datasets.items():
+        for dataset, data_node in data_nodes:
+            cached_records = cache.get(dataset.dataset_id, dataset.json.get('version')) if cache is not None else None
+            if cached_records is None:
+                to_list.append((dataset, data_node))
+            else:
+                records.extend(cached_records)
+    if cache is not None:
+        num_replicas = sum(len(data_nodes) for data_nodes in datasets.values())
+        logging.info(f"{num_replicas - len(to_list)} of {num_replicas} dataset replicas reused from cache for {experiment_id}.{variable}")
+
+    if bulk:
+        listings = bulk_file_metadata(conn, to_list, page_size, batch_size, retry_delay=retry_delay)
+        for dataset, data_node in to_list:
+            metadata_records = listings.get(dataset.dataset_id)
+            if metadata_records is not None:
+                records.extend(metadata_records)
+                if cache is not None:
+                    cache.put(dataset.dataset_id, dataset.json.get('version'), metadata_records)
+        return collapse_replicas(records)
 
-    lines = []
     with ThreadPoolExecutor(max_workers=10) as executor:  # Adjust max_workers as needed
         future_to_dataset = {
             executor.submit(download_file_metadata, dataset, data_node): (dataset, data_node)
-            for master_id, data_nodes in datasets.items()
-                for dataset, data_node in data_nodes
+            for dataset, data_node in to_list
             }
 
         for future in as_completed(future_to_dataset):
             dataset, data_node = future_to_dataset[future]
             try:
-                metadata_lines = future.result()
-                if metadata_lines:
-                    lines.extend(metadata_lines)
+                metadata_records = future.result()
+                if metadata_records:
+                    records.extend(metadata_records)
+                if metadata_records is not None and cache is not None:
+                    cache.put(dataset.dataset_id, dataset.json.get('version'), metadata_records)
             except Exception as e:
                 logging.error(f"Error processing dataset {dataset.dataset_id}: {e}")
-    return lines
+    return records
+
+class MetadataCache:
+    '''
+    File listings of the datasets of an (experiment_id, variable) combination from previous runs,
+    kept in a json file and keyed by dataset_id (which includes the version and data node)
+
+    Only the listings used or added in the current run are saved, so that
+    datasets that disappeared or were superseded by a newer version are dropped
+    '''
+
+    def __init__(self, file_path, reuse=True):
+        self.file_path = file_path
+        self.datasets = {}
+        self._current = {}
+        self._lock = threading.Lock()
+        if reuse and os.path.isfile(file_path):
+            with open(file_path, 'r') as f:
+                self.datasets = json.load(f)['datasets']
+
+    def get(self, dataset_id, version):
+        '''
+        Return the cached metadata records of a dataset, or None if it is not cached in this version
+        '''
+        with self._lock:
+            entry = self.datasets.get(dataset_id)
+            if entry is None or entry['version'] != version or 'records' not in entry:
+                return None
+            self._current[dataset_id] = entry
+            return entry['records']
+
+    def put(self, dataset_id, version, records):
+        '''
+        Store the metadata records of a dataset
+        '''
+        with self._lock:
+            self._current[dataset_id] = {'version': version, 'records': records}
+
+    def save(self):
+        '''
+        Write the listings used or added in this run to the json file
+        '''
+        with self._lock:
+            data = {'updated': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), 'datasets': self._current}
+            tmp_file_path = f"{self.file_path}.tmp"
+            with open(tmp_file_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_file_path, self.file_path)
+
+def query_node(experiment_id, variable, search_domain, timeout=120, stop=None):
+    '''
+    Connects to one ESGF index node and searches it for the datasets of an (experiment_id, variable) combination.
+    The latency of every request to the node is observed in the search_request_seconds metric.
+
+    Returns:
+        A (conn, session, datasets) tuple (see search_datasets); the caller closes the session.
+    '''
+    session = instrument_session(requests.Session(), 'search_request_seconds')
+    try:
+        conn = SearchConnection(search_url(search_domain), distrib=True, timeout=timeout, session=session)
+        return conn, session, search_datasets(experiment_id, variable, conn, stop)
+    except Exception:
+        session.close()
+        raise
+
+def close_query(future):
+    '''
+    Close the session of a finished query_node call whose answer is not used.
+    '''
+    if not future.cancelled() and future.exception() is None:
+        future.result()[1].close()
+
+def hedged_search(experiment_id, variable, search_domains, executor, hedge_delay=30, timeout=120, **kwargs):
+    '''
+    Searches for an (experiment_id, variable) combination on the search domains in order, hedging slow nodes.
+
+    The dataset query is sent to the first node; if no node has answered with datasets within hedge_delay
+    seconds, or a node fails or finds nothing, the same query is also sent to the next node. The files are
+    then listed once, from the first node that answered with datasets. Queries not yet started on other
+    nodes are cancelled, and those still running stop before their next request and are dropped.
+
+     Args:
+        experiment_id: The experiment ID to search for.
+        variable: The variable to search for.
+        search_domains: ESGF index nodes in order of preference.
+        executor: ThreadPoolExecutor running the dataset queries to the nodes.
+        hedge_delay: Time in seconds to wait for an answer before querying the next node.
+        timeout: Time in seconds to wait for a response from a node.
+        kwargs: Further arguments of list_files (cache, bulk, page_size, batch_size).
+
+    Returns:
+        A list of file metadata records, an empty list if the nodes that answered found no data,
+        or None if the search failed (no node answered, or the files of the datasets found could not be listed).
+    '''
+    pending = {}
+    remaining = list(search_domains)
+    start = time.perf_counter()
+    answer = None
+    answered = False
+    stop = threading.Event()
+    try:
+        while (remaining or pending) and answer is None:
+            if remaining:
+                search_domain = remaining.pop(0)
+                pending[executor.submit(query_node, experiment_id, variable, search_domain, timeout, stop)] = search_domain
+            done, _ = wait(pending, timeout=hedge_delay if remaining else None, return_when=FIRST_COMPLETED)
+            if not done and remaining:
+                logging.info(f"No answer from {', '.join(pending.values())} within {hedge_delay} s for {experiment_id}.{variable}, also trying {remaining[0]}")
+                metrics.inc('search_hedges_total', node=remaining[0])
+            for future in done:
+                search_domain = pending.pop(future)
+                try:
+                    conn, session, datasets = future.result()
+                except Exception as e:
+                    logging.error(f"Error connecting to {search_domain}: {e}")
+                    metrics.inc('search_failures_total', node=search_domain)
+                    continue
+                answered = True
+                if datasets and answer is None:
+                    answer = (search_domain, conn, session, datasets)
+                else:
+                    session.close()
+    finally:
+        stop.set()
+        for future in pending:
+            if not future.cancel():
+                future.add_done_callback(close_query)
+
+    if answer is None:
+        metrics.record('searches', search=f"{experiment_id}.{variable}", node=None,
+                       seconds=time.perf_counter() - start, files=0)
+        return [] if answered else None
+    search_domain, conn, session, datasets = answer
+    try:
+        records = list_files(experiment_id, variable, conn, datasets, **kwargs)
+    finally:
+        session.close()
+    metrics.record('searches', search=f"{experiment_id}.{variable}", node=search_domain,
+                   seconds=time.perf_counter() - start, files=len(records))
+    return records if records else None
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Retrieve the file metadata of CMIP6 datasets from ESGF")
+    parser.add_argument('--workers', type=int, default=8,
+                        help="number of (experiment, variable) combinations searched at the same time")
+    parser.add_argument('--hedge-delay', type=float, default=30,
+                        help="seconds to wait for an index node to answer the dataset query before sending it to the next one")
+    parser.add_argument('--timeout', type=float, default=120,
+                        help="seconds to wait for a response from an index node")
+    parser.add_argument('--full', action='store_true',
+                        help="list the files of every dataset again instead of reusing the cached listings")
+    parser.add_argument('--bulk', action='store_true',
+                        help="list files with paginated searches over many datasets and keep one record per file with all its mirrors")
+    parser.add_argument('--page-size', type=int, default=500,
+                        help="number of files per request for --bulk")
+    parser.add_argument('--batch-size', type=int, default=50,
+                        help="number of datasets per search for --bulk")
+    parser.add_argument('--experiments', nargs='+', default=experiment_ids,
+                        help="experiments to search for (default: experiment_ids in config.py)")
+    parser.add_argument('--variables', nargs='+', default=variables,
+                        help="variables to search for (default: variables in config.py)")
+    parser.add_argument('--search-domains', nargs='+', default=search_domains,
+                        help="index nodes to search in order, as host names or esg-search urls (default: search_domains in config.py)")
+    return parser.parse_args()
 
 def main():
 
-    # specify experiments and variables to download
-    experiment_ids = ['piControl', 'abrupt-4xCO2', '1pctCO2', 'historical', 'ssp119', 'ssp245', 'ssp370', 'ssp460', 'ssp585', 'esm-piControl', 'esm-hist', 'esm-ssp585', 'esm-1pctCO2']
-    variables = ["areacella", "tas", "rsdt", "rsut", "rlut"]
+    args = parse_args()
 
     # create output directory
     output_dir = "database"
     os.makedirs(output_dir, exist_ok=True)
 
-    # specify the search domains in order
-    search_domains = ["esgf-node.llnl.gov", "esgf-data.dkrz.de", "esgf-index1.ceda.ac.uk"]
-
     # generate database of cmip data
-    headers = ['master_id,data_node,filename,size,download_url,opendap_url']
-    for experiment_id in experiment_ids:
-        for variable in variables:
-            lines = []  # initialize empty lines for each (experiment_id, variable) combination
-            for search_domain in search_domains:
-                try:
-                    conn = SearchConnection(f"https://{search_domain}/esg-search", distrib=True)
-                    lines = search_cmip_data(experiment_id, variable, conn)
-                    if lines:
-                        break # Exit loop of search_domains if data is found in this node
-                except Exception as e:
-                    logging.error(f"Error connecting to {search_domain}: {e}")
-            output = headers + lines
-            with open(f"{output_dir}/{experiment_id}.{variable}.csv", 'w') as f:
-                f.write('\n'.join(output))
+    headers = ['master_id', 'data_node', 'filename', 'size', 'download_url', 'opendap_url', 'checksum', 'checksum_type']
+    store = MetadataStore()
+    combinations = [(experiment_id, variable) for experiment_id in args.experiments for variable in args.variables]
+
+    # file listings from previous runs, one cache file per combination
+    cache_dir = os.path.join(output_dir, 'cache')
+    os.makedirs(cache_dir, exist_ok=True)
+    caches = {
+        (experiment_id, variable): MetadataCache(os.path.join(cache_dir, f"{experiment_id}.{variable}.json"), reuse=not args.full)
+        for experiment_id, variable in combinations
+    }
+
+    # metrics/1_retrieve_database_from_esgf.prom is rewritten during the searches (see metrics.py)
+    metrics.start_exporter()
+
+    # one thread per combination waits on its searches, which run on the nodes through node_executor
+    with ThreadPoolExecutor(max_workers=args.workers * len(args.search_domains)) as node_executor, \
+         ThreadPoolExecutor(max_workers=args.workers) as executor:
+        future_to_combination = {
+            executor.submit(hedged_search, experiment_id, variable, args.search_domains, node_executor,
+                            args.hedge_delay, args.timeout, cache=caches[(experiment_id, variable)],
+                            bulk=args.bulk, page_size=args.page_size, batch_size=args.batch_size): (experiment_id, variable)
+            for experiment_id, variable in combinations
+        }
+        for future in as_completed(future_to_combination):
+            experiment_id, variable = future_to_combination[future]
+            try:
+                records = future.result()
+            except Exception as e:
+                logging.error(f"Error searching for {experiment_id}.{variable}: {e}")
+                records = None
+            if records is None:
+                # keep the replicas of the last successful search rather than replacing them with nothing
+                logging.error(f"Search failed for {experiment_id}.{variable}, keeping the replicas of the previous run")
+                continue
+            if records:
+                caches[(experiment_id, variable)].save()
+            search = f"{experiment_id}.{variable}"
+            rows = [dict(record, search=search, origin='', **dataset_facets(record['master_id'])) for record in records]
+            store.replace('replicas', rows, search=search, origin='')
+            # csv export of the same records
+            write_csv(f"{output_dir}/{search}.csv", headers, headers, records)
+    store.close()
+    metrics.stop_exporter()
+    metrics.export()
 
 if __name__ == "__main__":
 
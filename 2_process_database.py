@@ -1,100 +1,159 @@
 import os
-from collections import defaultdict
+import argparse
 import logging
 
+import pandas as pd
+
+from config import experiment_ids, variables
+from metadata_store import MetadataStore, dataset_facets, read_csv, write_csv, tables
+from metrics import metrics
+
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
 
 data_dir = 'database'
-experiment_ids = ['piControl', 'abrupt-4xCO2', '1pctCO2', 'historical', 'ssp119', 'ssp245', 'ssp370', 'ssp460', 'ssp585', 'esm-piControl', 'esm-hist', 'esm-ssp585', 'esm-1pctCO2']
-variables = ["areacella", "tas", "rsdt", "rsut", "rlut"]
 
 output_dir = 'database_processed'
-headers = ['soruce_id,activity_id,experiment_id,variant_label,variable,grid_label,filename,filesize,download_url,opendap_url']
-
-def variant_tuple(variant_label):
-    rest = variant_label.split('r')[-1]
-    r, rest = rest.split('i')
-    i, rest = rest.split('p')
-    p, f = rest.split('f')
-    return (int(r), int(i), int(p), int(f))
-
-def variant_string(variant):
-    return f"r{variant[0]}i{variant[1]}p{variant[2]}f{variant[3]}"
-
-def process_csv_file(file_path, source_ids, dct_source, dct_filesize):
-    with open(file_path, 'r') as f:
-        next(f)
-        for line in f:
-            lst = line.strip().split(',')
-            if len(lst) == 6:
-                master_id, data_node, filename, size, download_url, opendap_url = lst
-            else:
-                master_id, data_node, filename, size, download_url = lst
-                opendap_url = ''
-            project, activity_id, institution_id, source_id, experiment_id, variant_label, frequency, variable, grid_label, *_ = master_id.split('.')
-            if source_id not in source_ids:
-                source_ids.append(source_id)
-            dct_filesize[filename] = size
-            dct_activity = dct_source.setdefault(source_id, {})
-            dct_experiment = dct_activity.setdefault(activity_id, {})
-            dct_variant = dct_experiment.setdefault(experiment_id, {})
-            dct_variable = dct_variant.setdefault(variant_label, {})
-            dct_grid = dct_variable.setdefault(variable, {})
-            dct_file = dct_grid.setdefault(grid_label, {})
-            dct_url = dct_file.setdefault(filename, {})
-            dct_url.setdefault('download', []).append(download_url)
-            dct_url.setdefault('opendap', []).append(opendap_url)
+headers = ['soruce_id', 'activity_id', 'experiment_id', 'variant_label', 'variable', 'grid_label', 'filename', 'filesize', 'download_url', 'opendap_url', 'checksum', 'checksum_type']
+file_columns = tables['files']
 
-def main():
+# columns of the csv files written by stage 1 (and stage 5)
+replica_columns = ['master_id', 'data_node', 'filename', 'size', 'download_url', 'opendap_url', 'checksum', 'checksum_type']
+
+def variant_keys(variant_labels):
     '''
-    Use cmip_database (csv files containing metadata of datasets, each csv file is for (experiment_id, variable) pair) generated in the previous step
-    Reorganize the database and generate a csv file for each source
-    Download urls for the same dataset file is combined with '|' separator
+    Parse variant labels (e.g., r1i1p1f1) into integer (r, i, p, f) columns for sorting
     '''
+    keys = variant_labels.str.extract(r'r(\d+)i(\d+)p(\d+)f(\d+)').astype(int)
+    keys.columns = ['r', 'i', 'p', 'f']
+    return keys
 
-    source_ids = []
-    dct_source = {}
-    dct_filesize = {}
+def import_csv_files(store):
+    '''
+    Load the csv files of a database generated before the metadata store into it
+    '''
+    num_files = 0
     for experiment_id in experiment_ids:
         for variable in variables:
-            file_path = f"{data_dir}/{experiment_id}.{variable}.csv"
-            process_csv_file(file_path, source_ids, dct_source, dct_filesize)
+            search = f"{experiment_id}.{variable}"
+            file_paths = [(f"{data_dir}/{search}.csv", '')]
 
             # add extra data sources if exist
-            extra_dir = f"{data_dir}/extra/{experiment_id}.{variable}"
+            extra_dir = f"{data_dir}/extra/{search}"
             if os.path.isdir(extra_dir):
                 csv_filenames = [filename for filename in os.listdir(extra_dir) if (not filename.startswith('.')) and filename.endswith('.csv')]
                 for filename in csv_filenames:
-                    file_path = os.path.join(extra_dir, filename)
-                    process_csv_file(file_path, source_ids, dct_source, dct_filesize)
+                    file_paths.append((os.path.join(extra_dir, filename), filename[len(search)+1:-len('.csv')]))
+
+            for file_path, origin in file_paths:
+                if not os.path.isfile(file_path):
+                    continue
+                rows = read_csv(file_path, replica_columns)
+                for row in rows:
+                    row.update(search=search, origin=origin, **dataset_facets(row['master_id']))
+                store.replace('replicas', rows, search=search, origin=origin)
+                num_files += 1
+    logging.info(f"Imported {num_files} csv files from {data_dir} into the metadata store")
+
+def merge_mirrors(file_ids, urls, num_files):
+    '''
+    Merge the mirror lists of the rows of each file, keeping the first occurrence of every url
+
+    Args:
+        file_ids (pandas.Series): Index of the file of each row
+        urls (pandas.Series): List of mirror urls of each row
+        num_files (int): Number of files
+
+    Returns:
+        list: List of mirror urls of each file
+    '''
+    pairs = pd.DataFrame({'file_id': file_ids, 'url': urls}).explode('url').dropna().drop_duplicates()
+    mirrors = [[] for _ in range(num_files)]
+    for file_id, url in zip(pairs['file_id'], pairs['url']):
+        mirrors[file_id].append(url)
+    return mirrors
+
+def consolidate(df):
+    '''
+    Consolidate replica rows into one row per file with all its mirrors
+
+    Sources, activities, experiments, variables, grids and files keep the order in which
+    they first appear in df; variants are sorted by (r, i, p, f)
+
+    Args:
+        df (pandas.DataFrame): Replica rows in processing order
+
+    Returns:
+        pandas.DataFrame: One row per file with the columns of the files table
+    '''
+    keys = ['source_id', 'activity_id', 'experiment_id', 'variant_label', 'variable', 'grid_label', 'filename']
+
+    # integer codes per column make the group-bys below cheap
+    codes = pd.DataFrame({key: pd.factorize(df[key])[0] for key in keys}, index=df.index)
+    file_ids = codes.groupby(keys, sort=False).ngroup()
+    first_rows = ~file_ids.duplicated()
+    files = df.loc[first_rows, keys].reset_index(drop=True)
+
+    # the size seen last and the checksum published last for each file name
+    filesize = df.groupby('filename')['size'].last()
+    checksums = df[df['checksum'] != ''].groupby('filename')[['checksum', 'checksum_type']].last()
+    files['filesize'] = files['filename'].map(filesize)
+    files['checksum'] = files['filename'].map(checksums['checksum']).fillna('')
+    files['checksum_type'] = files['filename'].map(checksums['checksum_type']).fillna('')
+
+    for column in ['download_url', 'opendap_url']:
+        files[column] = merge_mirrors(file_ids, df[column], len(files))
+
+    # order of first appearance at every level of the hierarchy, variants sorted by (r, i, p, f)
+    file_codes = codes.loc[first_rows].reset_index(drop=True)
+    order = pd.DataFrame({f"level{idx}": file_codes.groupby(keys[:idx+1], sort=False).ngroup() for idx in range(len(keys))})
+    order = pd.concat([order.drop(columns='level3'), variant_keys(files['variant_label'])], axis=1)
+    sort_columns = ['level0', 'level1', 'level2', 'r', 'i', 'p', 'f', 'level4', 'level5', 'level6']
+    files = files.loc[order.sort_values(sort_columns, kind='stable').index]
+    return files[file_columns].reset_index(drop=True)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Reorganize the metadata of the previous step into one table per source")
+    parser.add_argument('--import-csv', action='store_true',
+                        help="load the csv files in database/ into the metadata store first (e.g., after editing them by hand)")
+    return parser.parse_args()
+
+def main():
+    '''
+    Use cmip_database (metadata of datasets found for each (experiment_id, variable) pair) generated in the previous step
+    Reorganize the database and generate a csv file for each source
+    Download urls for the same dataset file are combined (with '|' separator in the csv files)
+    If the metadata store is empty, the csv files of the previous step are loaded into it first
+    '''
+
+    args = parse_args()
+
+    store = MetadataStore()
+    if args.import_csv or not store.count('replicas'):
+        import_csv_files(store)
+
+    # all replicas in bulk: stage 1 search results first, then extra data sources (stage 5)
+    searches = [f"{experiment_id}.{variable}" for experiment_id in experiment_ids for variable in variables]
+    df = store.frame('replicas', search=searches)
+    df['search_order'] = df['search'].map({search: idx for idx, search in enumerate(searches)})
+    df['is_extra'] = df['origin'] != ''
+    df = df.sort_values(['search_order', 'is_extra', 'origin'], kind='stable')
+
+    files = consolidate(df)
 
     # generate output
     os.makedirs(output_dir, exist_ok=True)
-    for source_id in source_ids:
-        lines = []
-        for activity_id in dct_source[source_id].keys():
-            for experiment_id in dct_source[source_id][activity_id].keys():
-                variant_tuples = []
-                for variant_label in dct_source[source_id][activity_id][experiment_id].keys():
-                    variant_tuples.append(variant_tuple(variant_label))
-                variant_tuples.sort()
-                variant_labels = [variant_string(t) for t in variant_tuples]
-                for variant_label in variant_labels:
-                    for variable in dct_source[source_id][activity_id][experiment_id][variant_label].keys():
-                        for grid_label in dct_source[source_id][activity_id][experiment_id][variant_label][variable]:
-                            for filename in dct_source[source_id][activity_id][experiment_id][variant_label][variable][grid_label].keys():
-                                download_urls = dct_source[source_id][activity_id][experiment_id][variant_label][variable][grid_label][filename]['download']
-                                opendap_urls = dct_source[source_id][activity_id][experiment_id][variant_label][variable][grid_label][filename]['opendap']
-                                filesize = dct_filesize[filename]
-                                line = f"{source_id},{activity_id},{experiment_id},{variant_label},{variable},{grid_label},{filename},{filesize},{'|'.join(download_urls)},{'|'.join(opendap_urls)}"
-                                lines.append(line)
-        output = headers + lines
-
+    for source_id, rows in files.groupby('source_id', sort=False):
         file_path_out = f"{output_dir}/{source_id}.csv"
-        with open(file_path_out, 'w') as f:
-            f.write('\n'.join(output))
+        write_csv(file_path_out, headers, file_columns, rows.to_dict('records'))
         print(f"Saved: {file_path_out}")
 
+    store.replace('files', files.to_dict('records'))
+    store.close()
+    metrics.set('replicas', len(df))
+    metrics.set('files', len(files))
+    metrics.set('sources', files['source_id'].nunique())
+    metrics.export()
+
 if __name__ == "__main__":
     main()
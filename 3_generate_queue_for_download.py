@@ -1,22 +1,218 @@
 import os
+import json
+import argparse
+
 import pandas as pd
 
-def variant_tuple(variant_label):
-    rest = variant_label.split('r')[-1]
-    r, rest = rest.split('i')
-    i, rest = rest.split('p')
-    p, f = rest.split('f')
-    return (int(r), int(i), int(p), int(f))
+from metadata_store import MetadataStore, read_csv, write_csv, tables
+from metrics import metrics
 
 data_dir = 'database_processed'
 output_dir = 'queue_for_download'
 os.makedirs(output_dir, exist_ok=True)
 
-headers = ['source_id,activity_id,experiment_id,variant_label,variable,grid_label,filenum,filename,filesize,download_url,opendap_url']
+headers = tables['queue']
+
+# selection rules used without --profile (see profiles/default.json)
+default_profile = {
+    # sources must have datasets for all of these experiments
+    'required_experiments': ['piControl', 'abrupt-4xCO2'],
+    # an experiment (and variant) is selected only if it has all of these variables
+    'required_variables': ['rsdt', 'rsut', 'rlut', 'tas'],
+    # 'first': the first variant label of each experiment by (r, i, p, f), usually r1i1p1f1
+    # 'all': every variant label that has the required variables
+    # or a variant label such as 'r1i1p1f1' to use only that variant
+    'variant_policy': 'first',
+    # experiments and variables to consider at all (null for all in the catalog)
+    'experiments': None,
+    'variables': None,
+}
+
+def load_profile(file_path=None):
+    '''
+    Load selection rules from a json file, using the default rules for missing keys
+
+    Args:
+        file_path (str): Path to the profile json file, or None for the default profile
+
+    Returns:
+        dict: Selection rules (see default_profile)
+    '''
+    profile = dict(default_profile)
+    if file_path is not None:
+        with open(file_path, 'r') as f:
+            rules = json.load(f)
+        unknown = set(rules) - set(default_profile)
+        if unknown:
+            raise ValueError(f"Unknown selection rules in {file_path}: {', '.join(sorted(unknown))}")
+        profile.update(rules)
+    return profile
+
+def variant_keys(variant_labels):
+    '''
+    Parse variant labels (e.g., r1i1p1f1) into integer (r, i, p, f) columns for sorting
+    '''
+    keys = variant_labels.str.extract(r'r(\d+)i(\d+)p(\d+)f(\d+)').astype(int)
+    keys.columns = ['r', 'i', 'p', 'f']
+    return keys
+
+def select_files(df, profile):
+    '''
+    Select the files to download from the whole catalog at once
+
+    Args:
+        df (pandas.DataFrame): Rows of the files table in catalog order
+        profile (dict): Selection rules (see default_profile)
+
+    Returns:
+        tuple: (selected, sources), where selected holds the selected rows with their filenum
+               (index/number of files of the variable) ordered by source, experiment, variant and variable,
+               and sources lists the sources that have all required experiments
+    '''
+    df = df.reset_index(drop=True)
+    if profile['experiments'] is not None:
+        df = df[df['experiment_id'].isin(profile['experiments'])]
+    if profile['variables'] is not None:
+        df = df[df['variable'].isin(profile['variables'])]
+    df = pd.concat([df, variant_keys(df['variant_label'])], axis=1).dropna(subset=['source_id'])
+
+    # sources with all required experiments
+    required_experiments = profile['required_experiments']
+    num_experiments = df[df['experiment_id'].isin(required_experiments)].groupby('source_id')['experiment_id'].nunique()
+    sources = sorted(num_experiments.index[num_experiments == len(set(required_experiments))])
+    if not required_experiments:
+        sources = sorted(df['source_id'].unique())
+    df = df[df['source_id'].isin(sources)]
+
+    # variants
+    policy = profile['variant_policy']
+    if policy == 'first':
+        first = df.sort_values(['r', 'i', 'p', 'f'], kind='stable').groupby(['source_id', 'experiment_id'])['variant_label'].first()
+        df = df[df['variant_label'].values == first.reindex(pd.MultiIndex.from_frame(df[['source_id', 'experiment_id']])).values]
+    elif policy != 'all':
+        df = df[df['variant_label'] == policy]
+
+    # (source, experiment, variant) with all required variables
+    group = ['source_id', 'experiment_id', 'variant_label']
+    required_variables = profile['required_variables']
+    num_variables = df[df['variable'].isin(required_variables)].groupby(group)['variable'].nunique()
+    complete = num_variables.index[num_variables == len(set(required_variables))]
+    if required_variables:
+        df = df[pd.MultiIndex.from_frame(df[group]).isin(complete)]
+
+    selected = df.sort_values(['source_id', 'experiment_id', 'r', 'i', 'p', 'f', 'variable'], kind='stable')
+    files = selected.groupby(group + ['variable'], sort=False)
+    selected = selected.assign(filenum=(files.cumcount() + 1).astype(str) + '/' + files['filename'].transform('size').astype(str))
+    return selected[tables['queue']].reset_index(drop=True), sources
+
+def load_priorities(file_path=None):
+    '''
+    Load bundle priorities from a json file of the form
+    {"experiments": {"piControl": 3}, "models": {"CESM2": 2}, "variables": {}, "default": 1}
+
+    A bundle is worth the product of the priorities of its experiment, model and variable;
+    anything not listed gets the default priority, and a priority of 0 excludes it
+    '''
+    priorities = {'experiments': {}, 'models': {}, 'variables': {}, 'default': 1}
+    if file_path is not None:
+        with open(file_path, 'r') as f:
+            priorities.update(json.load(f))
+    return priorities
+
+def plan_queue(selected, budget, priorities):
+    '''
+    Choose the (source_id, experiment_id, variable) bundles to download within a storage budget
+
+    Bundles are taken greedily by value per byte; only whole bundles are queued, and
+    a bundle is queued only together with the areacella file(s) of its source, experiment
+    and variant, whose size counts once against the budget. The queue is ordered by
+    bundle value, each areacella file coming just before the first bundle that needs it,
+    so that the most valuable complete bundles finish downloading first
+
+    Args:
+        selected (pandas.DataFrame): Selected queue rows (see select_files)
+        budget (float): Storage budget in bytes
+        priorities (dict): Bundle priorities (see load_priorities)
+
+    Returns:
+        tuple: (planned, plan_lines), the queue rows in download order and a report of the plan
+    '''
+    default = priorities['default']
+    run = ['source_id', 'experiment_id', 'variant_label']
+    bundle_keys = run + ['variable']
+
+    sizes = selected.groupby(bundle_keys, sort=False)['filesize'].sum().reset_index()
+    area_sizes = sizes[sizes['variable'] == 'areacella'].set_index(run)['filesize']
+    bundles = sizes[sizes['variable'] != 'areacella'].copy()
+    bundles['value'] = (bundles['experiment_id'].map(lambda key: priorities['experiments'].get(key, default))
+                        * bundles['source_id'].map(lambda key: priorities['models'].get(key, default))
+                        * bundles['variable'].map(lambda key: priorities['variables'].get(key, default)))
+    bundles = bundles[bundles['value'] > 0]
+    bundles = bundles.assign(density=bundles['value'] / bundles['filesize'].clip(lower=1))
+    bundles = bundles.sort_values(['density', 'value'], ascending=False, kind='stable')
+
+    chosen = []
+    skipped_lines = []
+    included_runs = set()
+    used = 0
+    for bundle in bundles.itertuples(index=False):
+        key = (bundle.source_id, bundle.experiment_id, bundle.variant_label)
+        line = f"{bundle.variable}_{bundle.source_id}_{bundle.experiment_id}_{bundle.variant_label},{bundle.value},{bundle.filesize * 1.0e-9:.3f}GB"
+        if key not in area_sizes.index:
+            skipped_lines.append(f"skipped (no areacella),{line}")
+            continue
+        cost = bundle.filesize + (0 if key in included_runs else area_sizes[key])
+        if used + cost > budget:
+            skipped_lines.append(f"skipped (over budget),{line}")
+            continue
+        used += cost
+        included_runs.add(key)
+        chosen.append((-bundle.value, -bundle.density, key, bundle.variable, line))
+
+    # download order: most valuable bundles first, areacella before the first bundle of its run
+    order = []
+    ordered_runs = set()
+    plan_lines = []
+    for _, _, key, variable, line in sorted(chosen, key=lambda itm: itm[:2]):
+        if key not in ordered_runs:
+            ordered_runs.add(key)
+            order.append(key + ('areacella',))
+            plan_lines.append(f"queued,areacella_{'_'.join(key)},,{area_sizes[key] * 1.0e-9:.3f}GB")
+        order.append(key + (variable,))
+        plan_lines.append(f"queued,{line}")
+    plan_lines += skipped_lines
+    plan_lines.append(f"total,{used * 1.0e-9:.3f}GB of {budget * 1.0e-9:.3f}GB")
+
+    rank = pd.Series(range(len(order)), index=pd.MultiIndex.from_tuples(order, names=bundle_keys), dtype=int)
+    bundle_index = pd.MultiIndex.from_frame(selected[bundle_keys])
+    planned = selected.assign(rank=rank.reindex(bundle_index).values).dropna(subset=['rank'])
+    planned = planned.sort_values('rank', kind='stable').drop(columns='rank').reset_index(drop=True)
+    return planned, plan_lines
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Select the files to download from the processed database")
+    parser.add_argument('--profile', default=None,
+                        help="json file with the selection rules (see profiles/default.json)")
+    parser.add_argument('--budget', type=float, default=None,
+                        help="storage budget in gigabytes; queue only the most valuable complete bundles that fit")
+    parser.add_argument('--priorities', default=None,
+                        help="json file with per-experiment/model/variable priorities for --budget")
+    return parser.parse_args()
+
+def import_csv_files(store):
+    '''
+    Load the csv files of a processed database generated before the metadata store into it
+    '''
+    rows = []
+    for filename in sorted(os.listdir(data_dir)):
+        if filename.endswith('.csv'):
+            rows += read_csv(os.path.join(data_dir, filename), tables['files'])
+    store.replace('files', rows)
 
 def main():
     '''
-    Identify the sources that satisfy:
+    Identify the sources and files that satisfy the selection rules of a profile
+    (by default, see default_profile):
      - datasets for piControl and abrupt-4xCO2 are available
      - these datasets include at least the following variables:
        - rsdt
@@ -25,57 +221,44 @@ def main():
        - tas
      - use the first variant label (usually r1i1p1f1)
      - identify a single dataset file for each (source_id, experiment_id, variable) tuple
-       and generate a comma separated line including download urls and opendap urls for the file
+       and generate a queue entry including download urls and opendap urls for the file
      - calculate the total file size (in gigabyte)
+    With --budget, only the most valuable complete bundles that fit in the budget are queued (see plan_queue)
     '''
 
-    storage_required = 0
-    storage_lines = []
+    args = parse_args()
+    profile = load_profile(args.profile)
 
-    for filename in os.listdir(data_dir):
-        if filename.endswith('.csv'):
-            source_id, ext = os.path.splitext(filename)
-            file_path = os.path.join(data_dir, filename)
-            df = pd.read_csv(file_path)
-            experiment_ids = sorted(list(set(df['experiment_id'])))
-            lines = []
-            filesize_total = 0
-            if 'piControl' in experiment_ids and 'abrupt-4xCO2' in experiment_ids:
-                for experiment_id in experiment_ids:
-                    df_experiment = df[df['experiment_id'] == experiment_id]
-                    variant_labels = list(set(df_experiment['variant_label']))
-                    variant_labels.sort(key=lambda s: variant_tuple(s))
-                    variant_label = variant_labels[0]
-                    df_experiment_variant = df_experiment[df_experiment['variant_label'] == variant_label]
-                    variables = set(df_experiment_variant['variable'])
-                    if {'rsdt', 'rsut', 'rlut', 'tas'}.issubset(variables):
-                        for variable in sorted(list(variables)):
-                            df_experiment_variant_variable = df_experiment_variant[df_experiment_variant['variable'] == variable]
-                            num_files = len(df_experiment_variant_variable)
-                            for idx, (index, row) in enumerate(df_experiment_variant_variable.iterrows()):
-                                source_id, activity_id, experiment_id, variant_label, variable, grid_label, filename, filesize, download_url, opendap_url = list(row)
-                                filesize_total += int(filesize)
-                                lines.append(f"{source_id},{activity_id},{experiment_id},{variant_label},{variable},{grid_label},{idx+1}/{num_files},{filename},{filesize},{download_url},{opendap_url}")
-                if lines:
-                    output = headers + lines
-                    file_path_out = f"{output_dir}/{source_id}.csv"
-                    with open(file_path_out, 'w') as f:
-                        f.write('\n'.join(output))
-                    print(f"Saved: {file_path_out}")
-                    storage_required += filesize_total
-
-                # file size variable in the data file is in byte
-                # convert it into gigabytes (* 1.0e-9 # in gigabytes)
-                # filesize * 8 # in bits
-                # filesize * 1 # in bytes
-                # filesize * 1.0e-3 # in kilobytes
-                # filesize * 1.0e-6 # in megabytes
-                # filesize * 1.0e-9 # in gigabytes
-                storage_lines.append(f"{source_id},{float(filesize_total * 1.0e-9):.3f}GB")
+    store = MetadataStore()
+    if not store.count('files'):
+        import_csv_files(store)
+    selected, sources = select_files(store.frame('files'), profile)
+    if args.budget is not None:
+        selected, plan_lines = plan_queue(selected, args.budget * 1.0e9, load_priorities(args.priorities))
+        with open(f"{output_dir}/plan.txt", 'w') as f:
+            f.write('\n'.join(plan_lines))
+
+    # file size variable in the data file is in byte
+    # convert it into gigabytes (* 1.0e-9 # in gigabytes)
+    filesize_total = selected.groupby('source_id')['filesize'].sum()
+    storage_required = filesize_total.sum()
+    storage_lines = [f"{source_id},{float(filesize_total.get(source_id, 0) * 1.0e-9):.3f}GB" for source_id in sources]
+
+    for source_id, rows in selected.groupby('source_id', sort=False):
+        file_path_out = f"{output_dir}/{source_id}.csv"
+        write_csv(file_path_out, headers, headers, rows.to_dict('records'))
+        print(f"Saved: {file_path_out}")
+
+    store.replace('queue', selected.to_dict('records'))
+    store.close()
     storage_lines.append(f"total,{float(storage_required * 1.0e-9):.3f}GB")
     with open(f"{output_dir}/storage_requirement.txt", 'w') as f:
         f.write('\n'.join(storage_lines))
     print(f"===> {float(storage_required * 1.0e-9):.3f} GB of storage required for downloading all files")
+    metrics.set('queue_files', len(selected))
+    metrics.set('queue_bytes', int(storage_required))
+    metrics.set('sources', len(sources))
+    metrics.export()
 
 if __name__ == "__main__":
     main()
@@ -1,90 +1,196 @@
 import sys, os
-import time
+import argparse
 
-import requests
-from requests.exceptions import HTTPError
-
-import xarray as xr
+from downloader import DownloadEngine, MirrorStats, TransferLayer, remote_aggregate
+from download_journal import DownloadJournal
+from metadata_store import MetadataStore, read_csv, tables
+from metrics import metrics
 
 data_dir = 'queue_for_download'
 output_dir = 'downloaded'
+aggregated_dir = 'data_aggregated'
 os.makedirs(output_dir, exist_ok=True)
 
-def download(filename, download_url, output_dir=output_dir):
-    retries = 3
-    for attempt in range(retries):
-        try:
-            # http download
-            response = requests.get(download_url, stream=True, timeout=30)
-            response.raise_for_status()
-            with open(os.path.join(output_dir, filename), 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
-            break  # Break out of the loop if successful
-        except HTTPError as e:
-            if attempt < retries - 1:
-                #print(f"Retrying... ({attempt + 1})")
-                time.sleep(2)  # Wait before retrying
-            else:
-                raise
-
-def opendap(filename, opendap_url, output_dir=output_dir):
-    retries = 3
-    for attempt in range(retries):
-        try:
-            dataset = xr.open_dataset(opendap_url)
-            dataset.to_netcdf(os.path.join(output_dir, filename))
-        except Exception as e:
-            if attempt < retries - 1:
-                time.sleep(2)  # Wait before retrying
-            else:
-                raise
+def parse_args():
+    parser = argparse.ArgumentParser(description="Download the files listed in the download queue")
+    parser.add_argument('--workers', type=int, default=8,
+                        help="maximum number of files downloaded at the same time")
+    parser.add_argument('--per-node', type=int, default=2,
+                        help="maximum number of simultaneous transfers from one data node")
+    parser.add_argument('--segment-threshold', type=float, default=1000,
+                        help="files of at least this size (MB) are downloaded in segments from several mirrors at once")
+    parser.add_argument('--segments', type=int, default=4,
+                        help="number of simultaneous connections for a segmented download")
+    parser.add_argument('--chunk-size', type=float, default=4,
+                        help="read size per network call in MB")
+    parser.add_argument('--write-buffer', type=float, default=16,
+                        help="file write buffer in MB")
+    parser.add_argument('--connect-timeout', type=float, default=30,
+                        help="seconds to wait for a connection to a data node")
+    parser.add_argument('--read-timeout', type=float, default=60,
+                        help="seconds to wait for data from an open connection")
+    parser.add_argument('--remote-aggregate', action='store_true',
+                        help="instead of falling back to opendap downloads, compute the annual global means "
+                             "of runs with failed files over opendap and write them to data_aggregated")
+    parser.add_argument('--memory-budget', type=float, default=512,
+                        help="peak memory per chunk in megabytes for --remote-aggregate and --aggregate --stream")
+    parser.add_argument('--sources', nargs='+', default=None,
+                        help="download only the queued files of these sources")
+    parser.add_argument('--rescan', action='store_true',
+                        help="queue again the files that the download journal marks done but are missing in downloaded/")
+    parser.add_argument('--aggregate', action='store_true',
+                        help="aggregate each (source_id, experiment_id, variable) into data_aggregated as soon as "
+                             "its files and areacella are downloaded, while the other downloads go on")
+    parser.add_argument('--aggregate-workers', type=int, default=1,
+                        help="number of worker processes for --aggregate")
+    parser.add_argument('--stream', action='store_true',
+                        help="read the files of a (source_id, experiment_id, variable) in chunks for --aggregate")
+    parser.add_argument('--evict', action='store_true',
+                        help="with --aggregate, remove the raw files of a (source_id, experiment_id, variable) once its csv file is written")
+    parser.add_argument('--high-water-mark', type=float, default=None,
+                        help="with --evict, pause downloads while the raw files in downloaded/ would exceed this size in GB")
+    args = parser.parse_args()
+    if args.evict and not args.aggregate:
+        parser.error("--evict requires --aggregate")
+    if args.high_water_mark is not None and not args.evict:
+        parser.error("--high-water-mark requires --evict (raw files are never removed otherwise)")
+    return args
 
-def main():
+def import_csv_files(store):
+    '''
+    Load the csv files of a download queue generated before the metadata store into it
+    '''
+    rows = []
+    for filename in sorted(os.listdir(data_dir)):
+        if filename.endswith('.csv') and not filename.startswith('.'):
+            rows += read_csv(os.path.join(data_dir, filename), tables['queue'])
+    store.replace('queue', rows)
 
-    failed_filenames = []
-    for filename in os.listdir(data_dir):
-        if filename.startswith('.'):
+def aggregate_failed(bundles, area_urls, failed_filenames, stats, memory_budget):
+    '''
+    Aggregate over opendap every (source_id, experiment_id, variable) with a file
+    that failed over HTTP, and return the failed files not covered this way
+    '''
+    os.makedirs(aggregated_dir, exist_ok=True)
+    failed = set(failed_filenames)
+    for (source_id, experiment_id, variable), files in bundles.items():
+        if not failed.intersection(filename for filename, *_ in files):
             continue
-        elif filename.endswith('.csv'):
-            source_id, ext = os.path.splitext(filename)
-            print(f"--- {source_id}")
-            with open(os.path.join(data_dir, filename), 'r') as f:
-                next(f)
-                lines = [line for line in f]
-                num_lines = len(lines)
-                for idx, line in enumerate(lines):
-                    source_id, activity_id, experiment_id, variant_label, variable, grid_label, filenum, filename, filesize, download_urls, opendap_urls = line.split(',')
-                    success = False
-                    if os.path.isfile(os.path.join(output_dir, filename)):
-                        #print(f'{idx+1:>3d}/{num_lines}: Found {filename}')
-                        continue
-                    print(f'{idx+1:>3d}/{num_lines}: Downloading {filename}')
-                    for download_url in download_urls.split('|'):
-                        try:
-                            download(filename, download_url)
-                            success = True
-                            break
-                        except Exception as e:
-                            #print(f"Error downloading {filename} from {download_url}: {e}")
-                            pass
-                    if not success:
-                        failed_filenames.append(filename)
-                        print(f"===> Failed to download {filename}")
-                        print(f"===> Trying opendap download")
-                        for opendap_url in opendap_urls.split('|'):
-                            try:
-                                #print(f' - {opendap_url}')
-                                opendap(filename, opendap_url)
-                                success = True
-                                print('===> Done!')
-                                break
-                            except Exception as e:
-                                pass
-                        print(f'===> Options exhausted!: {filename}')
+        output_file_path = os.path.join(aggregated_dir, f"{variable}_{source_id}_{experiment_id}.csv")
+        if not os.path.exists(output_file_path):
+            _, variant_label, grid_label, _ = files[0]
+            print(f"===> Aggregating {variable}_{source_id}_{experiment_id} over opendap")
+            try:
+                remote_aggregate(variable, [urls for *_, urls in sorted(files)], output_file_path,
+                                 area_urls.get((source_id, experiment_id, variant_label, grid_label)),
+                                 memory_budget, stats)
+            except Exception as e:
+                print(f"===> Remote aggregation failed for {variable}_{source_id}_{experiment_id}: {e}")
+                continue
+        failed.difference_update(filename for filename, *_ in files)
+    return [filename for filename in failed_filenames if filename in failed]
+
+def main():
+
+    args = parse_args()
+
+    store = MetadataStore()
+    if not store.count('queue'):
+        import_csv_files(store)
+
+    where = {} if args.sources is None else {'source_id': args.sources}
+    rows = store.select('queue', **where)
+    store.close()
+
+    # download state of every queued file (files already in downloaded/ are taken as done when first added)
+    journal = DownloadJournal()
+    journal.enqueue(rows, output_dir)
+    journal.recover()
+    if args.rescan:
+        journal.rescan(output_dir)
+
+    bundles = {}
+    area_urls = {}
+    num_files = {}
+    for row in rows:
+        filename, source_id, experiment_id, variant_label, variable, grid_label = (row[column] for column in
+            ['filename', 'source_id', 'experiment_id', 'variant_label', 'variable', 'grid_label'])
+        if variable == 'areacella':
+            area_urls[(source_id, experiment_id, variant_label, grid_label)] = row['opendap_url']
+        else:
+            bundle = bundles.setdefault((source_id, experiment_id, variable), [])
+            bundle.append((filename, variant_label, grid_label, row['opendap_url']))
+        num_files.setdefault(source_id, [0, 0])[1] += 1
+
+    # files queued or failed before, in queue order, which stage 3 may have planned (--budget)
+    queue_order = {row['filename']: idx for idx, row in enumerate(rows)}
+    pending = [entry for entry in journal.select(['queued', 'failed'], args.sources) if entry['filename'] in queue_order]
+    if args.aggregate:
+        # keep the queue order of the bundles, but fetch the areacella files of a bundle before its first file,
+        # so that each bundle is complete (and can be evicted) as early as possible
+        bundle_order = {}
+        area_order = {}
+        for idx, row in enumerate(rows):
+            if row['variable'] != 'areacella':
+                first = bundle_order.setdefault((row['source_id'], row['experiment_id'], row['variable']), idx)
+                area_key = (row['source_id'], row['experiment_id'], row['variant_label'], row['grid_label'])
+                area_order[area_key] = min(area_order.get(area_key, first), first)
+        sort_keys = {}
+        for row in rows:
+            if row['variable'] == 'areacella':
+                area_key = (row['source_id'], row['experiment_id'], row['variant_label'], row['grid_label'])
+                sort_keys[row['filename']] = (area_order.get(area_key, queue_order[row['filename']]), 0, queue_order[row['filename']])
+            else:
+                bundle = (row['source_id'], row['experiment_id'], row['variable'])
+                sort_keys[row['filename']] = (bundle_order[bundle], 1, queue_order[row['filename']])
+        pending.sort(key=lambda entry: sort_keys[entry['filename']])
+    else:
+        pending.sort(key=lambda entry: queue_order[entry['filename']])
+    items = []
+    for entry in pending:
+        num_files[entry['source_id']][0] += 1
+        items.append((entry['filename'], entry['download_url'], entry['opendap_url'], entry['filesize'], entry['checksum'], entry['checksum_type']))
+    for source_id, (num_missing, num_total) in num_files.items():
+        print(f"--- {source_id}: {num_missing} of {num_total} files to download")
+
+    stats = MirrorStats(os.path.join(output_dir, 'mirror_stats.json'))
+    transfer = TransferLayer(chunk_size=int(args.chunk_size * 2**20), write_buffer=int(args.write_buffer * 2**20),
+                             connect_timeout=args.connect_timeout, read_timeout=args.read_timeout,
+                             pool_size=max(args.per_node, args.segments))
+
+    scheduler = None
+    if args.aggregate:
+        # imported here: aggregate_cmip_data sets up its log file when imported
+        from aggregation_scheduler import AggregationScheduler
+        high_water_mark = None if args.high_water_mark is None else args.high_water_mark * 1e9
+        scheduler = AggregationScheduler(rows, journal, output_dir, aggregated_dir, args.aggregate_workers, args.stream,
+                                         args.memory_budget, evict=args.evict, high_water_mark=high_water_mark)
+        scheduler.start()
+
+    engine = DownloadEngine(output_dir, max_workers=args.workers, per_node=args.per_node, stats=stats,
+                            segment_threshold=args.segment_threshold * 1e6, segment_connections=args.segments,
+                            transfer=transfer, opendap_fallback=not args.remote_aggregate, journal=journal, gate=scheduler)
+    # metrics/4_download_datasets.prom is rewritten during the downloads (see metrics.py)
+    metrics.start_exporter()
+    failed_filenames = engine.run(items, on_finish=scheduler.file_done if scheduler is not None else None)
+    if scheduler is not None:
+        num_left = scheduler.close()
+        if num_left:
+            print(f"===> {num_left} (source_id, experiment_id, variable) left to aggregate: files missing or failed")
+
+    if args.remote_aggregate:
+        remaining = aggregate_failed(bundles, area_urls, failed_filenames, stats, args.memory_budget)
+        for filename in set(failed_filenames) - set(remaining):
+            journal.finish(filename, 'remote')
 
+    # export of the failed files of all sources, for stage 5 and run_pipeline.py
     with open(os.path.join(output_dir, 'failed_download.txt'), 'w') as f:
-        f.write('\n'.join(failed_filenames))
+        f.write('\n'.join(entry['filename'] for entry in journal.select(['failed'])))
+    for state, count in journal.counts().items():
+        metrics.set('journal_files', count, state=state)
+    journal.close()
+    metrics.stop_exporter()
+    metrics.export()
 
 if __name__ == "__main__":
     main()
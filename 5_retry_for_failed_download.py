@@ -1,46 +1,24 @@
 import sys, os
 import time
+import argparse
+import threading
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from pyesgf.search import SearchConnection
 import requests
+from pyesgf.search import SearchConnection
 from requests.exceptions import HTTPError
 
-import xarray as xr
+from config import search_domains, search_url
+from downloader import DownloadEngine, MirrorStats
+from download_journal import DownloadJournal
+from metadata_store import MetadataStore, dataset_facets, write_csv
+from metrics import metrics, instrument_session
 
 data_dir = 'downloaded'
 os.makedirs(data_dir, exist_ok=True)
 
-def download(filename, download_url, output_dir=data_dir):
-    retries = 3
-    for attempt in range(retries):
-        try:
-            # http download
-            response = requests.get(download_url, stream=True, timeout=30)
-            response.raise_for_status()
-            with open(os.path.join(output_dir, filename), 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
-            break  # Break out of the loop if successful
-        except HTTPError as e:
-            if attempt < retries - 1:
-                #print(f"Retrying... ({attempt + 1})")
-                time.sleep(2)  # Wait before retrying
-            else:
-                raise
-
-def opendap(filename, opendap_url, output_dir=data_dir):
-    retries = 3
-    for attempt in range(retries):
-        try:
-            dataset = xr.open_dataset(opendap_url)
-            dataset.to_netcdf(os.path.join(output_dir, filename))
-        except Exception as e:
-            if attempt < retries - 1:
-                time.sleep(2)  # Wait before retrying
-            else:
-                raise
-
-def search_cmip_data(experiment_id, variable, conn, source_id=None):
+def search_cmip_data(experiment_id, variable, conn, source_id=None, variant_label=None):
 
     facets = 'project,source_id,experiment_id,variable,frequency,latest'
     project = 'CMIP6'
@@ -59,6 +37,8 @@ def search_cmip_data(experiment_id, variable, conn, source_id=None):
 
     if source_id is not None:
         kwargs['source_id'] = source_id
+    if variant_label is not None:
+        kwargs['variant_label'] = variant_label
 
     ctx = conn.new_context(**kwargs)
     results = ctx.search()
@@ -71,7 +51,7 @@ def search_cmip_data(experiment_id, variable, conn, source_id=None):
             continue
         datasets.setdefault(master_id, []).append((result, data_node))
 
-    print(f"{len(datasets)} datasets found for {experiment_id}.{variable}")
+    print(f"{len(datasets)} datasets found for {experiment_id}.{variable} ({source_id}, {variant_label})")
     master_ids = sorted(datasets.keys())
     lines = []
     for master_id in master_ids:
@@ -89,100 +69,160 @@ def search_cmip_data(experiment_id, variable, conn, source_id=None):
                 except HTTPError as e:
                     if attempt < retries - 1:
                         print(f"Retrying... ({attempt + 1})")
+                        metrics.inc('search_retries_total', node=urlparse(conn.url).netloc)
                         time.sleep(2)  # Wait before retrying
                     else:
                         raise
 
             for f in files:
-                file_id = f.file_id
-                filename = f.filename
-                download_url = f.download_url
-                opendap_url = f.opendap_url
-                size = str(f.size)
-                l = []
-                for itm in [master_id, data_node, filename, size, download_url, opendap_url]:
-                    if itm == None:
-                        itm = ''
-                    else:
-                        l.append(str(itm))
-                lines.append(','.join(l))
+                lines.append({'master_id': master_id,
+                              'data_node': [data_node],
+                              'filename': f.filename,
+                              'size': f.size,
+                              'download_url': [f.download_url] if f.download_url else [],
+                              'opendap_url': [f.opendap_url] if f.opendap_url else [],
+                              'checksum': f.checksum or '',
+                              'checksum_type': f.checksum_type or ''})
     return lines
 
-target_files = []
-with open(os.path.join(data_dir, 'failed_download.txt'), 'r') as f:
-    for line in f:
-        if line.strip().endswith('.nc'):
-            filename = line.strip()
-            # skip if the file already exists
-            if os.path.isfile(os.path.join(data_dir, filename)):
-                continue
-            target_files.append(filename)
-
-print('===> Try to find urls for:')
-print('\n'.join(target_files))
-
-search_domains = ["esgf-node.llnl.gov", "esgf-data.dkrz.de", "esgf-index1.ceda.ac.uk"]
-output_base_dir = "database/extra"
-
-headers = ['master_id,data_node,filename,size,download_url,opendap_url']
-dct_download_urls = {}
-dct_opendap_urls = {}
-for target_file in target_files:
-    variable, freq, source_id, experiment_id, variant_label, grid_label, *_ = target_file.split('_')
-
-    attempt = 0
+class ConnectionPool:
+    '''
+    One SearchConnection per index node and thread, reused by all the searches of that thread,
+    with the latency of every request observed per node (see metrics.instrument_session)
+    '''
+
+    def __init__(self, timeout=120):
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def get(self, search_domain):
+        connections = self._local.__dict__.setdefault('connections', {})
+        if search_domain not in connections:
+            session = instrument_session(requests.Session(), 'search_request_seconds')
+            connections[search_domain] = SearchConnection(search_url(search_domain), distrib=True, timeout=self.timeout, session=session)
+        return connections[search_domain]
+
+def resolve_group(group, pool, search_domains=search_domains):
+    '''
+    Find the file metadata of a (source_id, experiment_id, variable, variant_label) group with one search,
+    trying the search domains in order
+
+    Returns:
+        list: File metadata records of the group (empty if the search found nothing), or None if every search domain failed
+    '''
+    source_id, experiment_id, variable, variant_label = group
     for search_domain in search_domains:
+        start = time.perf_counter()
         try:
-            conn = SearchConnection(f"https://{search_domain}/esg-search", distrib=True)
-            lines = search_cmip_data(experiment_id, variable, conn, source_id=source_id)
-            break
+            lines = search_cmip_data(experiment_id, variable, pool.get(search_domain), source_id=source_id, variant_label=variant_label)
         except Exception as e:
             print(f"Error in connecting to {search_domain}: {e}")
-    for line in lines:
-        master_id, data_node, filename, size, download_url, opendap_url = line.split(',')
-        if filename == target_file:
-            dct_download_urls.setdefault(target_file, []).append(download_url)
-            dct_opendap_urls.setdefault(target_file, []).append(download_url)
-    output = headers + lines
-    out_dir = os.path.join(output_base_dir, f"{experiment_id}.{variable}")
-    os.makedirs(out_dir, exist_ok=True)
-    with open(f"{out_dir}/{experiment_id}.{variable}.{source_id}.csv", 'w') as f:
-        f.write('\n'.join(output))
-
-failed_filenames = []
-for filename in target_files:
-    print(f'===> Try downloading {filename}')
-    download_urls = list(set(dct_download_urls.get(filename, [])))
-    opendap_urls = list(set(dct_opendap_urls.get(filename, [])))
-    if not download_urls:
-        print('No url is found')
-        continue
-    print('URLS:')
-    for download_url in download_urls:
-        print(f' - {download_url}')
-    success = False
-    for download_url in download_urls:
-        try:
-            download(filename, download_url)
-            success = True
-            break
-        except Exception as e:
-            #print(f"Error downloading {filename} from {download_url}: {e}")
-            pass
-    if not success:
-        failed_filenames.append(filename)
-        print(f"===> Failed to download {filename}")
-        print(f"===> Trying opendap download")
-        for opendap_url in opendap_urls:
-            try:
-                #print(f' - {opendap_url}')
-                opendap(filename, opendap_url)
-                success = True
-                print('===> Done!')
-                break
-            except Exception as e:
-                pass
-        print(f'===> Options exhausted!: {filename}')
-
-with open(os.path.join(data_dir, 'still_failed_download.txt'), 'w') as f:
-    f.write('\n'.join(failed_filenames))
+            metrics.inc('search_failures_total', node=search_domain)
+            continue
+        metrics.record('searches', search='.'.join(group), node=search_domain,
+                       seconds=time.perf_counter() - start, files=len(lines))
+        return lines
+    return None
+
+def unique(urls):
+    return list(dict.fromkeys(url for url in urls if url))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Find new urls for the files that failed to download and download them")
+    parser.add_argument('--workers', type=int, default=4,
+                        help="number of (source, experiment, variable, variant) searches run at the same time")
+    parser.add_argument('--timeout', type=float, default=120,
+                        help="seconds to wait for a response from an index node")
+    parser.add_argument('--search-domains', nargs='+', default=search_domains,
+                        help="index nodes to search in order, as host names or esg-search urls (default: search_domains in config.py)")
+    parser.add_argument('--download-workers', type=int, default=8,
+                        help="maximum number of files downloaded at the same time")
+    parser.add_argument('--per-node', type=int, default=2,
+                        help="maximum number of simultaneous transfers from one data node")
+    return parser.parse_args()
+
+def main():
+    '''
+    Search ESGF again for the files that the download journal marks failed and download them
+
+    Failed files are grouped by (source_id, experiment_id, variable, variant_label), so that each group
+    is resolved with one search; the groups are searched concurrently over pooled connections and the
+    mirrors found are downloaded with the same engine as stage 4
+    '''
+
+    args = parse_args()
+
+    journal = DownloadJournal()
+    journal.recover()
+    target_files = [entry['filename'] for entry in journal.select(['failed'])]
+
+    print('===> Try to find urls for:')
+    print('\n'.join(target_files))
+
+    groups = {}
+    for target_file in target_files:
+        variable, freq, source_id, experiment_id, variant_label, grid_label, *_ = target_file.split('_')
+        groups.setdefault((source_id, experiment_id, variable, variant_label), []).append(target_file)
+
+    output_base_dir = "database/extra"
+    headers = ['master_id', 'data_node', 'filename', 'size', 'download_url', 'opendap_url', 'checksum', 'checksum_type']
+    store = MetadataStore()
+    dct_download_urls = {}
+    dct_opendap_urls = {}
+    dct_filesize = {}
+    dct_checksum = {}
+    pool = ConnectionPool(timeout=args.timeout)
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        future_to_group = {executor.submit(resolve_group, group, pool, args.search_domains): group for group in groups}
+        for future in as_completed(future_to_group):
+            source_id, experiment_id, variable, variant_label = group = future_to_group[future]
+            lines = future.result()
+            if lines is None:
+                # a search outage, not an empty answer: keep the replicas found by earlier runs
+                print(f"===> Search failed on every index node for {'.'.join(group)}, keeping its known replicas")
+                continue
+            filenames = set(groups[group])
+            for line in lines:
+                if line['filename'] in filenames:
+                    target_file = line['filename']
+                    dct_download_urls.setdefault(target_file, []).extend(line['download_url'])
+                    dct_opendap_urls.setdefault(target_file, []).extend(line['opendap_url'])
+                    dct_filesize[target_file] = int(line['size'])
+                    if line['checksum']:
+                        dct_checksum[target_file] = (line['checksum'], line['checksum_type'])
+
+            # keep the metadata found as an extra data source of the source (see stage 2)
+            search = f"{experiment_id}.{variable}"
+            rows = [dict(line, search=search, origin=source_id, **dataset_facets(line['master_id'])) for line in lines]
+            store.replace('replicas', rows, search=search, origin=source_id, variant_label=variant_label)
+            out_dir = os.path.join(output_base_dir, search)
+            os.makedirs(out_dir, exist_ok=True)
+            write_csv(f"{out_dir}/{search}.{source_id}.csv", headers, headers, store.select('replicas', search=search, origin=source_id))
+    store.close()
+
+    items = []
+    for filename in target_files:
+        if not dct_download_urls.get(filename):
+            print(f'===> No url is found for {filename}')
+            continue
+        checksum, checksum_type = dct_checksum.get(filename, (None, None))
+        items.append((filename, unique(dct_download_urls[filename]), unique(dct_opendap_urls.get(filename, [])),
+                      dct_filesize.get(filename), checksum, checksum_type))
+
+    stats = MirrorStats(os.path.join(data_dir, 'mirror_stats.json'))
+    engine = DownloadEngine(data_dir, max_workers=args.download_workers, per_node=args.per_node, stats=stats, journal=journal)
+    metrics.start_exporter()
+    engine.run(items)
+    stats.save()
+
+    # export of the files that are still failed (including those without urls)
+    with open(os.path.join(data_dir, 'still_failed_download.txt'), 'w') as f:
+        f.write('\n'.join(entry['filename'] for entry in journal.select(['failed'])))
+    for state, count in journal.counts().items():
+        metrics.set('journal_files', count, state=state)
+    journal.close()
+    metrics.stop_exporter()
+    metrics.export()
+
+if __name__ == "__main__":
+    main()
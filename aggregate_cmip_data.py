@@ -1,12 +1,21 @@
 import os
+import argparse
+from time import perf_counter
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import xarray as xr
 import numpy as np
 
-from utils import area, make_logger
+from metadata_store import MetadataStore
+from utils import AreaWeightCache, global_mean, annual_mean, stream_annual_mean, save_output, make_logger, make_log_listener
+from metrics import metrics, Progress, format_duration
 
 logger = make_logger()
 
+# normalized area weights shared across files, variables and experiments
+area_cache = AreaWeightCache()
+
 def build_data(input_dir, output_dir, file_names):
     """
     Build processed data from raw data files.
@@ -17,12 +26,14 @@ def build_data(input_dir, output_dir, file_names):
         file_names (lst): List of netCDF file names for a particular (source_id, experiment_id, variable) in input_dir
 
     Returns:
-        None
+        list: (file name, seconds) of each file
     """
 
     output_data = []
+    timings = []
     for file_name in file_names:
         logger.info(f"Processing {file_name}")
+        start = perf_counter()
 
         file_path = os.path.join(input_dir, file_name)
         ds = xr.open_dataset(file_path)
@@ -32,97 +43,165 @@ def build_data(input_dir, output_dir, file_names):
         # for output file name
         var_id, _, model_id, experiment_id, variant_id, grid_type, duration = file_name.split('_')
 
-        try:
-            # load areacella file
-            area_file_name = f"areacella_fx_{model_id}_{experiment_id}_{variant_id}_{grid_type}.nc"
-            area_file_path = os.path.join(input_dir, area_file_name)
-            area_ds = xr.open_dataset(area_file_path)
-            area_da = area_ds[area_ds.variable_id]
-            area_da.data = area_da.data * 1e-6 # convert m2 to km2
-            area_da.attrs["units"] = "km2"
-        except FileNotFoundError:
-            logger.warning(f"areacella file not found: {area_file_name}. Generating area data array.")
-            area_da = area(da)
-
-        # compute annual mean
-        years = []
-        annual_values = []
+        # normalized area weights, shared by all files on the same grid
+        weights = load_weights(input_dir, file_name, da)
 
-        # for month weight
-        numdays_of_month = {1:31,2:28,3:31,4:30,5:31,6:30,7:31,8:31,9:30,10:31,11:30,12:31}
+        # spatial aggregation of all timesteps at once
+        month_values = global_mean(da.values, weights)
 
+        # compute annual mean
         time = da['time']
-        current_year = int(time[0].dt.year.values)
-        month_values = []
-        for idx_t, t in enumerate(time):
-            year = int(t.dt.year.values)
-            month = int(t.dt.month.values)
-
-            # spatial aggregation
-            month_value = np.nansum(da.sel(time=t).data * area_da.data/area_da.values.sum())
-            month_weight = numdays_of_month[month]/365
-            month_value *= month_weight
-
-            if year == current_year:
-                # keep adding month_value until year switch
-                month_values.append(month_value)
-            else:
-                # switch to next year
-                if len(month_values) == 12:
-                    annual_value = sum(month_values)
-                    annual_values.append(annual_value)
-                    years.append(current_year)
-                month_values = [month_value]
-                current_year = year
-
-            # last index
-            if idx_t == len(time)-1:
-                # save only if values exist for full year
-                if len(month_values) == 12:
-                    annual_values.append(sum(month_values))
-                    years.append(year)
+        years, annual_values = annual_mean(month_values, time.dt.year.values, time.dt.month.values)
 
         # generate output file
-        lines = [f"{year},{annual_value}" for year, annual_value in zip(years, annual_values)]
-        output_data.append((years[0], lines))
+        output_data.append((years[0], years, annual_values))
+        timings.append((file_name, perf_counter() - start))
 
     # save
-    output_data.sort()
-    output = []
-    for _, lines in output_data:
-        output += lines
-    if output:
+    output_data.sort(key=lambda itm: itm[0])
+    if output_data:
+        years = np.concatenate([itm[1] for itm in output_data])
+        annual_values = np.concatenate([itm[2] for itm in output_data])
+        file_name = f"{var_id}_{model_id}_{experiment_id}.csv"
+        save_output(os.path.join(output_dir, file_name), var_id, years, annual_values)
+    return timings
+
+def build_data_streaming(input_dir, output_dir, file_names, memory_budget=512):
+    """
+    Build processed data from raw data files without loading them whole.
+
+    All files of the (source_id, experiment_id, variable) are treated as one
+    time series: they are opened lazily, ordered by their first timestep, and
+    only the target variable is read, in time chunks sized so that the raw and
+    working copies of a chunk fit in memory_budget. Timesteps repeated at a file
+    boundary are taken from the earlier file, and years spanning two files are
+    stitched into one annual value.
+
+    Args:
+        input_dir (str): Input directory containing raw data files.
+        output_dir (str): Output directory to save processed data files.
+        file_names (lst): List of netCDF file names for a particular (source_id, experiment_id, variable) in input_dir
+        memory_budget (float): Peak memory for one chunk in megabytes.
+
+    Returns:
+        list: (file name, seconds) of each file; the files are read together,
+              so the time of the whole series is split evenly across them
+    """
+
+    start = perf_counter()
+    datasets = [xr.open_dataset(os.path.join(input_dir, file_name)) for file_name in file_names]
+    try:
+        for file_name in file_names:
+            logger.info(f"Processing {file_name}")
+        das = [ds[ds.variable_id] for ds in datasets]
+        weights = load_weights(input_dir, file_names[0], das[0])
+        years, annual_values = stream_annual_mean(das, weights, memory_budget)
+    finally:
+        for ds in datasets:
+            ds.close()
+
+    if len(years):
+        var_id, _, model_id, experiment_id, *_ = file_names[0].split('_')
         file_name = f"{var_id}_{model_id}_{experiment_id}.csv"
-        file_path = os.path.join(output_dir, file_name)
-        with open(file_path, 'w') as f:
-            f.write(f"year,{var_id}\n")
-            f.write('\n'.join(output))
+        save_output(os.path.join(output_dir, file_name), var_id, years, annual_values)
+    seconds = (perf_counter() - start) / len(file_names)
+    return [(file_name, seconds) for file_name in file_names]
+
+def load_weights(input_dir, file_name, da):
+    """
+    Get normalized area weights for a data file from the area cache,
+    using the matching areacella file in input_dir if there is one.
+
+    Args:
+        input_dir (str): Input directory containing raw data files.
+        file_name (str): NetCDF file name of the data file.
+        da (xarray.DataArray): Data array of the data file.
+
+    Returns:
+        numpy.ndarray: Area weights summing to one.
+    """
+    _, _, model_id, experiment_id, variant_id, grid_type, *_ = file_name.split('_')
+    area_file_name = f"areacella_fx_{model_id}_{experiment_id}_{variant_id}_{grid_type}.nc"
+    area_file_path = os.path.join(input_dir, area_file_name)
+    if not os.path.isfile(area_file_path):
+        logger.warning(f"areacella file not found: {area_file_name}. Using cached or generated area weights.")
+    return area_cache.get(model_id, grid_type, da, area_file_path)
+
+def process(input_dir, output_dir, file_names, stream=False, memory_budget=512):
+    """
+    Run build_data (or build_data_streaming) for a (source_id, experiment_id, variable) and log errors instead of raising.
+    Returns the (file name, seconds) of each file, or None on error, for the metrics of the parent process.
+    """
+    try:
+        if stream:
+            return build_data_streaming(input_dir, output_dir, file_names, memory_budget)
+        return build_data(input_dir, output_dir, file_names)
+    except Exception as e:
+        logger.warning(f"Error in processing {file_names}: {e}")
+        return None
+
+def record_timings(file_names, timings, progress):
+    """
+    Record the aggregation time of each file of a (source_id, experiment_id, variable) in the metrics.
+    """
+    if timings is None:
+        metrics.inc('aggregate_failures_total')
+    else:
+        for file_name, seconds in timings:
+            variable = file_name.split('_')[0]
+            metrics.observe('aggregate_file_seconds', seconds, variable=variable)
+            metrics.record('aggregated_files', file=file_name, seconds=seconds)
+        metrics.inc('aggregate_files_total', len(timings))
+    eta = progress.done(tuple(file_names))
+    logger.info(f"{len(progress.remaining)} bundles left, ETA {format_duration(eta)}")
+
+def init_worker(queue, area_cache_dir):
+    """
+    Set up a worker process: route log records to the parent and share the area weights on disk.
+    """
+    global area_cache
+    make_logger(logger.name, queue=queue)
+    area_cache = AreaWeightCache(cache_dir=area_cache_dir)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Aggregate downloaded CMIP data into annual global means")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of worker processes for the (source_id, experiment_id, variable) tasks")
+    parser.add_argument('--area-cache-dir', default=None,
+                        help="directory to keep area weights as .npy files across runs and workers")
+    parser.add_argument('--stream', action='store_true',
+                        help="read all files of a (source_id, experiment_id, variable) as one time series in chunks")
+    parser.add_argument('--memory-budget', type=float, default=512,
+                        help="peak memory per chunk in megabytes for --stream")
+    parser.add_argument('--sources', nargs='+', default=None,
+                        help="aggregate only these sources")
+    parser.add_argument('--experiments', nargs='+', default=None,
+                        help="aggregate only these experiments")
+    return parser.parse_args()
 
 def main():
 
-    database_dir = './queue_for_download'
+    args = parse_args()
+
     input_dir = './downloaded'
     output_dir = './data_aggregated'
 
     source_ids = {}
-    for fname in os.listdir(database_dir):
-        if not fname.endswith('.csv'):
-            continue
-        source_id, _ = os.path.splitext(fname)
-        experiments = {}
-        with open(os.path.join(database_dir, fname), 'r') as f:
-            next(f)
-            for line in f:
-                lst = [itm.strip() for itm in line.split(',')]
-                source_id, activity_id, experiment_id, variant_label, variable, grid_label, filenum, filename, filesize, download_url, opendap_url = lst
-                if variable == 'areacella':
-                    continue
-                variables = experiments.setdefault(experiment_id, {})
-                variables.setdefault(variable, []).append(filename)
-        source_ids[source_id] = experiments
+    with MetadataStore() as store:
+        for row in store.select('queue'):
+            if row['variable'] == 'areacella':
+                continue
+            if args.sources is not None and row['source_id'] not in args.sources:
+                continue
+            if args.experiments is not None and row['experiment_id'] not in args.experiments:
+                continue
+            experiments = source_ids.setdefault(row['source_id'], {})
+            variables = experiments.setdefault(row['experiment_id'], {})
+            variables.setdefault(row['variable'], []).append(row['filename'])
 
     os.makedirs(output_dir, exist_ok=True)
 
+    tasks = []
     for source_id in source_ids:
         experiments = source_ids[source_id]
         for experiment in experiments:
@@ -132,11 +211,37 @@ def main():
                 if os.path.exists(output_file_path):
                     #print(f"Already exists: {output_file_path}")
                     continue
-                file_names = variables[variable]
+                tasks.append(variables[variable])
+
+    # queue depth and ETA counted in files (see metrics.Progress)
+    progress = Progress('aggregate', {tuple(file_names): len(file_names) for file_names in tasks})
+
+    if args.workers <= 1:
+        global area_cache
+        area_cache = AreaWeightCache(cache_dir=args.area_cache_dir)
+        for file_names in tasks:
+            timings = process(input_dir, output_dir, file_names, args.stream, args.memory_budget)
+            record_timings(file_names, timings, progress)
+        metrics.export()
+        return
+
+    # worker processes send their log records to a single listener in this process
+    queue = multiprocessing.Queue()
+    listener = make_log_listener(logger, queue)
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                                 initargs=(queue, args.area_cache_dir)) as executor:
+            futures = {executor.submit(process, input_dir, output_dir, file_names, args.stream, args.memory_budget): file_names for file_names in tasks}
+            for future in as_completed(futures):
                 try:
-                    build_data(input_dir, output_dir, file_names)
+                    timings = future.result()
                 except Exception as e:
-                    logger.warning(f"Error in processing {file_names}: {e}")
+                    logger.warning(f"Error in processing {futures[future]}: {e}")
+                    timings = None
+                record_timings(futures[future], timings, progress)
+    finally:
+        listener.stop()
+    metrics.export()
 
 if __name__ == '__main__':
     main()
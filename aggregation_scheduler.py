@@ -0,0 +1,254 @@
+import os
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import aggregate_cmip_data
+from aggregate_cmip_data import process, init_worker, record_timings
+from metrics import metrics, Progress
+from utils import make_log_listener
+
+class AggregationScheduler:
+    '''
+    Aggregate the downloads of stage 4 while they are still going on (stage 4 --aggregate)
+
+    Each (source_id, experiment_id, variable) bundle is aggregated in a worker process
+    (see aggregate_cmip_data.process) as soon as all its files are downloaded and its
+    matching areacella files are finished (downloaded, or failed so that the area weights
+    are computed instead). With evict=True, the raw files of a bundle are removed once its
+    csv file is written, and an areacella file once every bundle using it is aggregated;
+    evicted files are marked 'evicted' in the download journal
+
+    The scheduler is also the gate of the download engine (acquire/release): with a
+    high_water_mark, a download only starts while the raw files on disk (downloaded,
+    being downloaded or waiting for aggregation) stay below it. If nothing is being
+    downloaded or aggregated, i.e., no space will be freed by waiting, the next file is
+    let through anyway so that a bundle larger than the mark can still complete.
+    A bundle with a file that failed can no longer complete in this run: its files
+    (and areacella files no other bundle waits for) are kept on disk for stage 5 but no
+    longer count against the mark, as waiting would never free them
+    '''
+
+    def __init__(self, rows, journal, input_dir, output_dir, workers=1, stream=False, memory_budget=512,
+                 area_cache_dir=None, evict=False, high_water_mark=None):
+        '''
+        Args:
+            rows (list): Queue rows of the files to download and aggregate (see metadata_store)
+            journal (DownloadJournal): Download journal of the files
+            input_dir (str): Download directory
+            output_dir (str): Directory of the aggregated csv files
+            workers (int): Number of aggregation worker processes
+            stream (bool): Use build_data_streaming (see aggregate_cmip_data)
+            memory_budget (float): Peak memory per chunk in megabytes for stream
+            area_cache_dir (str): Directory to keep area weights as .npy files across runs and workers
+            evict (bool): Remove raw files once their bundle is aggregated
+            high_water_mark (float): Cap in bytes on the raw files on disk, or None for no cap
+        '''
+        self.journal = journal
+        self.input_dir = input_dir
+        self.output_dir = output_dir
+        self.workers = workers
+        self.stream = stream
+        self.memory_budget = memory_budget
+        self.area_cache_dir = area_cache_dir
+        self.evict = evict
+        self.high_water_mark = high_water_mark
+
+        self.sizes = {row['filename']: row['filesize'] or 0 for row in rows}
+        area_files = {row['filename'] for row in rows if row['variable'] == 'areacella'}
+        self.bundles = {}
+        for row in rows:
+            if row['variable'] != 'areacella':
+                bundle = (row['source_id'], row['experiment_id'], row['variable'])
+                self.bundles.setdefault(bundle, []).append(row['filename'])
+        # areacella files matching the files of each bundle (as aggregate_cmip_data.load_weights), if queued
+        self.bundle_areas = {}
+        self.area_users = {}
+        for bundle, file_names in self.bundles.items():
+            areas = {self.area_file(file_name) for file_name in file_names} & area_files
+            self.bundle_areas[bundle] = areas
+            for area_file in areas:
+                self.area_users.setdefault(area_file, set()).add(bundle)
+
+        states = {entry['filename']: entry['state'] for entry in journal.select(['done', 'evicted', 'failed'])}
+        # downloaded files, and files that will not be downloaded in this run (done, evicted or failed)
+        self.done = {filename for filename, state in states.items() if state in ['done', 'evicted'] and filename in self.sizes}
+        self.finished = {filename for filename in states if filename in self.sizes}
+        self.evicted = {filename for filename, state in states.items() if state == 'evicted'}
+        self.aggregated = {bundle for bundle in self.bundles if os.path.exists(self.output_path(bundle))}
+        self.pending = set(self.bundles) - self.aggregated
+
+        # raw bytes on disk or reserved by downloads in progress
+        self.used = sum(self.sizes[filename] for filename in self.done - self.evicted
+                        if os.path.isfile(os.path.join(input_dir, filename)))
+        self.in_flight = 0
+        # downloaded files not yet handed over by file_done
+        self.settling = set()
+        self.running = 0
+        self.failed_bundles = 0
+        # bundles with a file that failed in this run, and the files whose bytes no longer count in used
+        self.dead = set()
+        self.released = set()
+        self.progress = Progress('aggregate', {tuple(self.bundles[bundle]): len(self.bundles[bundle]) for bundle in self.pending})
+        self._cond = threading.Condition()
+        self._executor = None
+        self._listener = None
+
+    @staticmethod
+    def area_file(file_name):
+        _, _, model_id, experiment_id, variant_id, grid_type, *_ = file_name.split('_')
+        return f"areacella_fx_{model_id}_{experiment_id}_{variant_id}_{grid_type}.nc"
+
+    def output_path(self, bundle):
+        source_id, experiment_id, variable = bundle
+        return os.path.join(self.output_dir, f"{variable}_{source_id}_{experiment_id}.csv")
+
+    def start(self):
+        '''
+        Start the worker processes and aggregate the bundles already complete (and evict those already aggregated)
+        '''
+        os.makedirs(self.output_dir, exist_ok=True)
+        # worker processes send their log records to a single listener in this process
+        queue = multiprocessing.Queue()
+        self._listener = make_log_listener(aggregate_cmip_data.logger, queue)
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker,
+                                             initargs=(queue, self.area_cache_dir))
+        # the workers are forked on the first task: do it now, before the download threads start
+        self._executor.submit(os.getpid).result()
+        with self._cond:
+            if self.evict:
+                for bundle in self.aggregated:
+                    self._evict_bundle(bundle)
+            self._submit_ready(self.pending)
+            self._update_gauges()
+
+    def close(self):
+        '''
+        Wait for the running aggregations and stop the worker processes
+
+        Returns:
+            int: Number of bundles left to aggregate (files missing or failed)
+        '''
+        self._executor.shutdown(wait=True)
+        self._listener.stop()
+        return len(self.pending) + self.failed_bundles
+
+    def acquire(self, filename, filesize):
+        '''
+        Wait until the download of a file of filesize bytes may start (see the class docstring)
+        '''
+        filesize = filesize or 0
+        with self._cond:
+            start = time.monotonic()
+            paused = False
+            while (self.high_water_mark is not None and self.used + filesize > self.high_water_mark
+                   and (self.in_flight or self.settling or self.running)):
+                paused = True
+                self._cond.wait()
+            if paused:
+                metrics.inc('download_pauses_total')
+                metrics.observe('download_pause_seconds', time.monotonic() - start)
+            self.used += filesize
+            self.in_flight += 1
+            self._update_gauges()
+
+    def release(self, filename, filesize, done):
+        '''
+        End a download started with acquire; a downloaded file keeps its bytes until it is evicted
+        '''
+        with self._cond:
+            self.in_flight -= 1
+            if done:
+                # held until file_done hands the file over, so that waiting downloads see the coming aggregation
+                self.settling.add(filename)
+            else:
+                self.used -= filesize or 0
+            self._update_gauges()
+            self._cond.notify_all()
+
+    def file_done(self, filename, done):
+        '''
+        Take note of a file that finished downloading (or failed) and aggregate the bundles it completes
+        '''
+        with self._cond:
+            if filename in self.settling:
+                self.settling.remove(filename)
+                if not done:
+                    self.used -= self.sizes.get(filename, 0)
+            if done:
+                self.done.add(filename)
+            self.finished.add(filename)
+            bundles = self.area_users.get(filename, set()) | {bundle for bundle in self.pending if filename in self.bundles[bundle]}
+            if not done and filename not in self.area_users:
+                # (a missing areacella file only means computed area weights)
+                self.dead |= bundles
+            self._submit_ready(bundles)
+            self._release_dead()
+            self._update_gauges()
+            self._cond.notify_all()
+
+    def _ready(self, bundle):
+        return (bundle in self.pending and bundle not in self.dead and all(file_name in self.done for file_name in self.bundles[bundle])
+                and self.bundle_areas[bundle] <= self.finished)
+
+    def _submit_ready(self, bundles):
+        for bundle in sorted(bundles):
+            if not self._ready(bundle):
+                continue
+            self.pending.remove(bundle)
+            self.running += 1
+            print(f"===> Aggregating {bundle[2]}_{bundle[0]}_{bundle[1]} while downloading")
+            future = self._executor.submit(process, self.input_dir, self.output_dir, self.bundles[bundle],
+                                           self.stream, self.memory_budget)
+            future.add_done_callback(lambda future, bundle=bundle: self._aggregated(bundle, future))
+
+    def _aggregated(self, bundle, future):
+        try:
+            timings = future.result()
+        except Exception as e:
+            aggregate_cmip_data.logger.warning(f"Error in processing {self.bundles[bundle]}: {e}")
+            timings = None
+        record_timings(self.bundles[bundle], timings, self.progress)
+        with self._cond:
+            self.running -= 1
+            if timings is not None and os.path.exists(self.output_path(bundle)):
+                self.aggregated.add(bundle)
+                if self.evict:
+                    self._evict_bundle(bundle)
+                self._release_dead()
+            else:
+                self.failed_bundles += 1
+            self._update_gauges()
+            self._cond.notify_all()
+
+    def _evict_bundle(self, bundle):
+        # raw files of an aggregated bundle, and the areacella files no other bundle still needs
+        file_names = list(self.bundles[bundle])
+        file_names += [area_file for area_file in self.bundle_areas[bundle]
+                       if self.area_users[area_file] <= self.aggregated]
+        for file_name in file_names:
+            if file_name in self.evicted or file_name not in self.done:
+                continue
+            file_path = os.path.join(self.input_dir, file_name)
+            if os.path.isfile(file_path):
+                os.remove(file_path)
+                if file_name not in self.released:
+                    self.used -= self.sizes[file_name]
+                metrics.inc('evicted_bytes_total', self.sizes[file_name])
+            self.evicted.add(file_name)
+            self.journal.finish(file_name, 'evicted')
+
+    def _release_dead(self):
+        # downloaded files of dead bundles, and the areacella files whose bundles are all aggregated or dead
+        settled = self.aggregated | self.dead
+        file_names = [file_name for bundle in self.dead for file_name in self.bundles[bundle]]
+        file_names += [area_file for area_file, users in self.area_users.items() if users & self.dead and users <= settled]
+        for file_name in file_names:
+            if file_name in self.done and file_name not in self.evicted and file_name not in self.released:
+                self.released.add(file_name)
+                self.used -= self.sizes[file_name]
+
+    def _update_gauges(self):
+        metrics.set('raw_bytes', self.used)
+        metrics.set('aggregations_running', self.running)
@@ -0,0 +1,227 @@
+import os
+import sys
+import csv
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import resource
+import tracemalloc
+import statistics
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import xarray as xr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fixtures import make_fixtures
+
+cases = ['build_data', 'build_data_streaming', 'area']
+
+# allowance in MB over --memory-budget for what stream_annual_mean keeps besides its chunks
+# (time coordinates, one global mean per timestep)
+stream_overhead = 1
+
+def peak_rss():
+    '''
+    Return the peak resident memory of this process in megabytes
+    '''
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return usage / 2**20 if sys.platform == 'darwin' else usage / 2**10
+
+def run_case(case, workdir, file_names, memory_budget):
+    '''
+    Time one run of a case in this (fresh) process
+
+    Returns:
+        tuple: (seconds, peak memory before the run in MB, peak memory after the run in MB)
+    '''
+    # aggregate_cmip_data logs to log.txt in the working directory
+    os.chdir(workdir)
+    import aggregate_cmip_data
+    from utils import area
+    aggregate_cmip_data.logger.setLevel(logging.ERROR)
+
+    input_dir = os.path.join(workdir, 'input')
+    output_dir = os.path.join(workdir, case)
+    os.makedirs(output_dir, exist_ok=True)
+
+    if case == 'area':
+        ds = xr.open_dataset(os.path.join(input_dir, file_names[0]))
+        da = ds[ds.variable_id]
+        before = peak_rss()
+        start = time.perf_counter()
+        area(da)
+        seconds = time.perf_counter() - start
+        ds.close()
+        return seconds, before, peak_rss()
+
+    before = peak_rss()
+    start = time.perf_counter()
+    if case == 'build_data':
+        aggregate_cmip_data.build_data(input_dir, output_dir, file_names)
+    else:
+        aggregate_cmip_data.build_data_streaming(input_dir, output_dir, file_names, memory_budget)
+    return time.perf_counter() - start, before, peak_rss()
+
+def stream_peak(workdir, file_names, memory_budget):
+    '''
+    Return the peak memory in MB allocated (as traced by tracemalloc) while stream_annual_mean
+    reads the fixtures chunk by chunk, with the area weights computed beforehand
+    '''
+    os.chdir(workdir)
+    from utils import area, stream_annual_mean
+
+    datasets = [xr.open_dataset(os.path.join(workdir, 'input', file_name)) for file_name in file_names]
+    das = [ds[ds.variable_id] for ds in datasets]
+    weights = area(das[0]).values
+    weights = weights / weights.sum()
+    tracemalloc.start()
+    stream_annual_mean(das, weights, memory_budget)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    for ds in datasets:
+        ds.close()
+    return peak / 1e6
+
+def measure(case, workdir, file_names, memory_budget):
+    '''
+    Run a case in a new process, so that caches and peak memory start afresh
+    '''
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(run_case, case, workdir, file_names, memory_budget).result()
+
+def read_output(file_path):
+    with open(file_path, 'r') as f:
+        reader = csv.reader(f)
+        next(reader)
+        return [(int(year), float(value)) for year, value in reader]
+
+def compare(values, expected):
+    '''
+    Return the largest relative difference between two annual series, or None if their years differ
+    '''
+    if [year for year, _ in values] != [year for year, _ in expected]:
+        return None
+    if not values:
+        return 0.0
+    a = np.array([value for _, value in values])
+    b = np.array([value for _, value in expected])
+    return float(np.max(np.abs(a - b) / np.maximum(np.abs(b), 1e-300)))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the aggregation of CMIP-shaped NetCDF fixtures")
+    parser.add_argument('--nlat', type=int, default=96, help="number of latitudes")
+    parser.add_argument('--nlon', type=int, default=144, help="number of longitudes")
+    parser.add_argument('--years', type=int, default=50, help="number of years of the series")
+    parser.add_argument('--files', type=int, default=2, help="number of files the series is split into")
+    parser.add_argument('--no-areacella', action='store_true', help="do not write the areacella file (area weights are computed)")
+    parser.add_argument('--cases', nargs='+', default=cases, choices=cases, help="what to time")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per case")
+    parser.add_argument('--memory-budget', type=float, default=64,
+                        help="peak memory per chunk in megabytes for build_data_streaming")
+    parser.add_argument('--no-reference', action='store_true', help="skip the check against the reference implementation")
+    # areacella is stored as float32, and the reference scales it to km2 before normalizing,
+    # so with an areacella file the weights only agree to float32 precision
+    parser.add_argument('--rtol', type=float, default=1e-6, help="relative tolerance of the check")
+    parser.add_argument('--workdir', default=None, help="directory for the fixtures and outputs (default: a temporary one)")
+    parser.add_argument('--json', default=None, help="write the results to this json file")
+    return parser.parse_args()
+
+def main():
+    '''
+    Generate fixtures, time each case, and check the outputs against the reference implementation
+    '''
+
+    args = parse_args()
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix='bench_aggregate_')
+    input_dir = os.path.join(workdir, 'input')
+    shutil.rmtree(input_dir, ignore_errors=True)
+
+    print(f"===> Generating fixtures in {input_dir}")
+    file_names = make_fixtures(input_dir, args.nlat, args.nlon, args.years, args.files, not args.no_areacella)
+    num_bytes = sum(os.path.getsize(os.path.join(input_dir, file_name)) for file_name in file_names)
+    num_timesteps = args.years * 12
+    print(f"{len(file_names)} files, {num_timesteps} timesteps on a {args.nlat}x{args.nlon} grid, "
+          f"{num_bytes * 1e-6:.1f} MB, areacella: {not args.no_areacella}")
+
+    results = {'config': {key: value for key, value in vars(args).items() if key not in ['json', 'workdir']}, 'cases': {}}
+    ok = True
+    for case in args.cases:
+        runs = [measure(case, workdir, file_names, args.memory_budget) for _ in range(args.repeat)]
+        seconds = [run[0] for run in runs]
+        result = {
+            'seconds_min': min(seconds),
+            'seconds_median': statistics.median(seconds),
+            'peak_memory_mb': max(run[2] for run in runs),
+            'peak_memory_increase_mb': max(run[2] - run[1] for run in runs),
+        }
+        line = f"{case:<22s} {result['seconds_min']:8.3f} s (median {result['seconds_median']:.3f} s)"
+        if case != 'area':
+            result['timesteps_per_s'] = num_timesteps / result['seconds_min']
+            result['mb_per_s'] = num_bytes * 1e-6 / result['seconds_min']
+            line += f", {result['timesteps_per_s']:9.1f} timesteps/s, {result['mb_per_s']:8.1f} MB/s"
+        line += f", peak memory {result['peak_memory_mb']:.0f} MB (+{result['peak_memory_increase_mb']:.0f} MB)"
+        print(line)
+        results['cases'][case] = result
+
+    if 'build_data_streaming' in args.cases:
+        # the one promise of --memory-budget: the chunks never take more than it
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            peak = executor.submit(stream_peak, workdir, file_names, args.memory_budget).result()
+        results['cases']['build_data_streaming']['stream_peak_traced_mb'] = peak
+        within = peak <= args.memory_budget + stream_overhead
+        ok &= within
+        print(f"{'build_data_streaming':<22s} stream_annual_mean peak {peak:.1f} MB traced, "
+              f"{'within' if within else 'FAILED: over'} the {args.memory_budget:g} MB budget")
+
+    if not args.no_reference:
+        # imported here: utils needs the __main__ module, which the spawned processes set up late
+        from reference import reference_area, reference_annual_means
+        print("===> Checking against the reference implementation")
+        with xr.open_dataset(os.path.join(input_dir, file_names[0])) as ds:
+            da = ds[ds.variable_id]
+            start = time.perf_counter()
+            expected_area = reference_area(da)
+            area_seconds = time.perf_counter() - start
+            if 'area' in args.cases:
+                from utils import area
+                difference = float(np.max(np.abs(area(da).values - expected_area) / expected_area))
+                results['cases']['area'].update(reference_seconds=area_seconds, max_relative_difference=difference)
+                ok &= difference <= args.rtol
+                print(f"area                   max relative difference {difference:.2e}, reference {area_seconds:.3f} s")
+
+        start = time.perf_counter()
+        expected = reference_annual_means(input_dir, file_names)
+        reference_seconds = time.perf_counter() - start
+        variable, _, model_id, experiment_id, *_ = file_names[0].split('_')
+        for case in args.cases:
+            if case == 'area':
+                continue
+            output_file_path = os.path.join(workdir, case, f"{variable}_{model_id}_{experiment_id}.csv")
+            difference = compare(read_output(output_file_path), expected) if os.path.isfile(output_file_path) else None
+            results['cases'][case].update(reference_seconds=reference_seconds, max_relative_difference=difference)
+            if difference is None:
+                ok = False
+                print(f"{case:<22s} FAILED: years differ from the reference")
+                continue
+            ok &= difference <= args.rtol
+            speedup = reference_seconds / results['cases'][case]['seconds_min']
+            print(f"{case:<22s} max relative difference {difference:.2e}, {speedup:.1f}x the reference ({reference_seconds:.3f} s)")
+        print("===> OK" if ok else f"===> FAILED: outputs differ from the reference by more than {args.rtol} "
+                                      "or the memory budget was exceeded")
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main()
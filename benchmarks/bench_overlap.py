@@ -0,0 +1,165 @@
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+from fixtures import make_fixtures
+
+def make_queue(source_dir, sources, experiments, variables, nlat, nlon, years, files):
+    '''
+    Generate the fixtures of every (source, experiment, variable) with the areacella file of each run,
+    and return their queue rows in queue order (see metadata_store)
+    '''
+    for source_id in sources:
+        for experiment_id in experiments:
+            for idx, variable in enumerate(variables):
+                make_fixtures(source_dir, nlat, nlon, years, files, areacella=(idx == 0), variable=variable,
+                              source_id=source_id, experiment_id=experiment_id)
+    rows = []
+    for file_name in sorted(os.listdir(source_dir)):
+        variable, _, source_id, experiment_id, variant_label, grid_label, *_ = file_name[:-len('.nc')].split('_')
+        rows.append({'source_id': source_id, 'activity_id': 'CMIP', 'experiment_id': experiment_id, 'variant_label': variant_label,
+                     'variable': variable, 'grid_label': grid_label, 'filenum': '1/1', 'filename': file_name,
+                     'filesize': os.path.getsize(os.path.join(source_dir, file_name)), 'download_url': [], 'opendap_url': [],
+                     'checksum': '', 'checksum_type': ''})
+    # bundle by bundle, areacella first (the order stage 4 --aggregate downloads a queue of bundles in)
+    rows.sort(key=lambda row: (row['source_id'], row['experiment_id'], row['variable'] != 'areacella', row['variable'], row['filename']))
+    return rows
+
+def disk_usage(directory):
+    return sum(entry.stat().st_size for entry in os.scandir(directory) if entry.name.endswith('.nc'))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark stage 4 --aggregate --evict with simulated downloads of NetCDF fixtures")
+    parser.add_argument('--sources', type=int, default=3, help="number of sources")
+    parser.add_argument('--variables', nargs='+', default=['tas', 'rsdt', 'rsut'], help="variables of every (source, experiment)")
+    parser.add_argument('--nlat', type=int, default=48, help="number of latitudes")
+    parser.add_argument('--nlon', type=int, default=96, help="number of longitudes")
+    parser.add_argument('--years', type=int, default=20, help="number of years of every series")
+    parser.add_argument('--files', type=int, default=2, help="files per (source, experiment, variable)")
+    parser.add_argument('--workers', type=int, default=4, help="simultaneous downloads")
+    parser.add_argument('--aggregate-workers', type=int, default=2, help="aggregation worker processes")
+    parser.add_argument('--bandwidth', type=float, default=20, help="simulated MB/s of every download")
+    parser.add_argument('--high-water-mark', type=float, default=12, help="cap on the raw files in MB")
+    parser.add_argument('--fail', type=int, default=1,
+                        help="number of bundles whose first file fails to download (the bundle can no longer complete)")
+    parser.add_argument('--workdir', default=None, help="directory for the fixtures and outputs (default: a temporary one)")
+    parser.add_argument('--json', default=None, help="write the results to this json file")
+    return parser.parse_args()
+
+def main():
+    '''
+    Download (by copying, at a simulated bandwidth) a queue of NetCDF fixtures through the aggregation
+    scheduler of stage 4 --aggregate --evict, failing the first file of some bundles, and check that
+    every other bundle is aggregated and evicted and that no bytes stay counted against the high-water
+    mark at the end (those of the failed bundles are released, or the downloads would serialize)
+    '''
+
+    args = parse_args()
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix='bench_overlap_')
+    json_path = os.path.abspath(args.json) if args.json is not None else None
+    source_dir = os.path.join(workdir, 'source')
+    input_dir = os.path.join(workdir, 'downloaded')
+    output_dir = os.path.join(workdir, 'data_aggregated')
+    for directory in [source_dir, input_dir, output_dir]:
+        shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(input_dir)
+
+    # aggregate_cmip_data logs to log.txt and the metrics go to metrics/ in the working directory
+    os.chdir(workdir)
+    import aggregate_cmip_data
+    from download_journal import DownloadJournal
+    from aggregation_scheduler import AggregationScheduler
+    from metrics import metrics
+    aggregate_cmip_data.logger.setLevel(logging.ERROR)
+
+    print(f"===> Generating fixtures in {source_dir}")
+    rows = make_queue(source_dir, [f"BENCH-{idx}" for idx in range(args.sources)], ['piControl', 'abrupt-4xCO2'],
+                      args.variables, args.nlat, args.nlon, args.years, args.files)
+    journal = DownloadJournal(os.path.join(input_dir, 'journal.db'))
+    journal.enqueue(rows, input_dir)
+
+    scheduler = AggregationScheduler(rows, journal, input_dir, output_dir, args.aggregate_workers, evict=True,
+                                     high_water_mark=args.high_water_mark * 1e6)
+    bundles = sorted(scheduler.bundles)
+    failed_bundles = bundles[::max(1, len(bundles) // args.fail)][:args.fail] if args.fail else []
+    failed_files = {scheduler.bundles[bundle][0] for bundle in failed_bundles}
+    print(f"{len(rows)} files, {sum(row['filesize'] for row in rows) * 1e-6:.1f} MB in {len(bundles)} bundles, "
+          f"high-water mark {args.high_water_mark:g} MB, failing {', '.join(sorted(failed_files)) or 'nothing'}")
+
+    peak = {'counted': 0, 'disk': 0}
+    lock = threading.Lock()
+
+    def fetch(row):
+        filename, filesize = row['filename'], row['filesize']
+        scheduler.acquire(filename, filesize)
+        with lock:
+            peak['counted'] = max(peak['counted'], scheduler.used)
+        time.sleep(filesize * 1e-6 / args.bandwidth)
+        done = filename not in failed_files
+        if done:
+            shutil.copy(os.path.join(source_dir, filename), os.path.join(input_dir, filename))
+        scheduler.release(filename, filesize, done)
+        # as DownloadEngine.run: the journal first, then on_finish
+        journal.finish(filename, 'done' if done else 'failed')
+        scheduler.file_done(filename, done)
+        with lock:
+            peak['disk'] = max(peak['disk'], disk_usage(input_dir))
+
+    start = time.perf_counter()
+    scheduler.start()
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        list(executor.map(fetch, rows))
+    num_left = scheduler.close()
+    seconds = time.perf_counter() - start
+    journal_counts = journal.counts()
+    journal.close()
+
+    expected = [bundle for bundle in bundles if bundle not in failed_bundles]
+    missing = [bundle for bundle in expected if not os.path.isfile(scheduler.output_path(bundle))]
+    # the files of the failed bundles that did download are kept for stage 5
+    removed = [filename for bundle in failed_bundles for filename in scheduler.bundles[bundle]
+            if filename not in failed_files and not os.path.isfile(os.path.join(input_dir, filename))]
+    summary = metrics.summary()
+    pauses = sum(item['value'] for item in summary['counters'].get('download_pauses_total', []))
+    results = {
+        'config': {key: value for key, value in vars(args).items() if key not in ['json', 'workdir']},
+        'seconds': seconds, 'bundles': len(bundles), 'bundles_left': num_left, 'bundles_missing': len(missing),
+        'failed_bundle_files_removed': len(removed), 'counted_bytes_left': scheduler.used,
+        'peak_counted_mb': peak['counted'] * 1e-6, 'peak_disk_mb': peak['disk'] * 1e-6,
+        'download_pauses': pauses, 'journal': journal_counts,
+    }
+    print(f"overlapped             {seconds:8.2f} s, {len(bundles) - num_left}/{len(bundles)} bundles aggregated, "
+          f"{pauses} pauses, peak raw files {results['peak_counted_mb']:.1f} MB counted "
+          f"({results['peak_disk_mb']:.1f} MB on disk), journal {journal_counts}")
+
+    ok = True
+    if missing:
+        ok = False
+        print(f"FAILED: {len(missing)} bundles without a failed file were not aggregated")
+    if removed:
+        ok = False
+        print(f"FAILED: {len(removed)} files of the failed bundles were removed")
+    if scheduler.used != 0:
+        ok = False
+        print(f"FAILED: {scheduler.used * 1e-6:.1f} MB still counted against the high-water mark at the end")
+    print("===> OK" if ok else "===> FAILED")
+
+    if json_path is not None:
+        with open(json_path, 'w') as f:
+            json.dump(results, f, indent=1)
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+import os
+import sys
+import json
+import time
+import shlex
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+from esgf_standin import StandIn, make_catalog, load_catalog
+
+def run_stage(script, options, workdir):
+    '''
+    Run a stage of the pipeline in workdir, with its output in workdir/logs
+
+    Returns:
+        tuple: (seconds, exit code)
+    '''
+    os.makedirs(os.path.join(workdir, 'logs'), exist_ok=True)
+    log_path = os.path.join(workdir, 'logs', f"{os.path.splitext(script)[0]}.out")
+    start = time.perf_counter()
+    with open(log_path, 'w') as log:
+        returncode = subprocess.run([sys.executable, os.path.join(repo_dir, script)] + options,
+                                    cwd=workdir, stdout=log, stderr=subprocess.STDOUT).returncode
+    return time.perf_counter() - start, returncode
+
+def download_summary(workdir, rows):
+    '''
+    Return the bytes and number of files in workdir/downloaded, the state counts of the download journal,
+    and the failed attempts it records, with those that claim the whole file was received (a failed transfer
+    never has all its bytes, so these are misreported)
+    '''
+    from download_journal import DownloadJournal
+    download_dir = os.path.join(workdir, 'downloaded')
+    expected = {row['filename']: row['filesize'] for row in rows}
+    complete = [filename for filename, filesize in expected.items()
+                if os.path.isfile(os.path.join(download_dir, filename))
+                and os.path.getsize(os.path.join(download_dir, filename)) == filesize]
+    counts = {}
+    failed = []
+    journal_path = os.path.join(download_dir, 'journal.db')
+    if os.path.isfile(journal_path):
+        journal = DownloadJournal(journal_path)
+        counts = journal.counts()
+        failed = [attempt for filename in expected for attempt in journal.attempts(filename) if attempt['outcome'] == 'failed']
+        journal.close()
+    return {'files_expected': len(expected), 'files_complete': len(complete),
+            'bytes_complete': sum(expected[filename] for filename in complete), 'journal': counts,
+            'failed_attempts': len(failed),
+            'failed_attempts_misreported': sum(1 for attempt in failed if attempt['bytes_received'] >= expected[attempt['filename']])}
+
+def node_config(args):
+    '''
+    Build the node behaviour (see esgf_standin.StandIn) from a json file and the command line
+    '''
+    config = {'index_nodes': {}, 'data_nodes': {}}
+    if args.config is not None:
+        with open(args.config, 'r') as f:
+            config.update(json.load(f))
+    data_default = config['data_nodes'].setdefault('default', {})
+    for key in ['latency', 'bandwidth', 'error_rate', 'burst', 'drop_rate']:
+        value = getattr(args, key)
+        if value is not None:
+            data_default.setdefault(key, value)
+    if args.search_latency is not None:
+        config['index_nodes'].setdefault('default', {}).setdefault('latency', args.search_latency)
+    for idx in range(args.dead_nodes):
+        config['data_nodes'].setdefault(f"node{idx}.example", {})['dead'] = True
+    if args.dead_index:
+        config['index_nodes'].setdefault('index0', {})['dead'] = True
+    return config
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark stages 1-5 end to end against a local ESGF stand-in")
+    parser.add_argument('--catalog', default=None,
+                        help="directory of queue csv files to serve (default: a generated catalog)")
+    parser.add_argument('--max-filesize', type=float, default=None, help="cap on the file sizes of --catalog in MB")
+    parser.add_argument('--sources', type=int, default=4, help="sources of the generated catalog")
+    parser.add_argument('--files', type=int, default=2, help="files per (source, experiment, variable) of the generated catalog")
+    parser.add_argument('--filesize', type=float, default=10, help="mean file size of the generated catalog in MB")
+    parser.add_argument('--data-nodes', type=int, default=3, help="data nodes of the generated catalog")
+    parser.add_argument('--replicas', type=int, default=2, help="data nodes publishing each file of the generated catalog")
+    parser.add_argument('--index-nodes', type=int, default=2, help="number of index nodes")
+    parser.add_argument('--config', default=None, help="json file with the behaviour of the nodes (see esgf_standin.py)")
+    parser.add_argument('--latency', type=float, default=None, help="seconds before each data node response")
+    parser.add_argument('--search-latency', type=float, default=None, help="seconds before each index node response")
+    parser.add_argument('--bandwidth', type=float, default=None, help="bandwidth of each data node in MB/s")
+    parser.add_argument('--error-rate', type=float, default=None, help="probability that a request starts a burst of 503s")
+    parser.add_argument('--burst', type=int, default=None, help="length of the bursts of 503s")
+    parser.add_argument('--drop-rate', type=float, default=None, help="probability that a transfer is cut off part way")
+    parser.add_argument('--dead-nodes', type=int, default=0, help="number of data nodes refusing connections")
+    parser.add_argument('--dead-index', action='store_true', help="make the first index node refuse connections")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the catalog and of the failure injection")
+    parser.add_argument('--retry', action='store_true', help="also run stage 5 after stage 4")
+    parser.add_argument('--search-args', default='', help="extra options of stage 1, e.g. '--bulk --hedge-delay 2'")
+    parser.add_argument('--download-args', default='', help="extra options of stage 4, e.g. '--workers 16 --read-timeout 10'")
+    parser.add_argument('--retry-args', default='', help="extra options of stage 5, e.g. '--download-workers 16'")
+    parser.add_argument('--workdir', default=None, help="directory to run the pipeline in (default: a temporary one)")
+    parser.add_argument('--json', default=None, help="write the results to this json file")
+    return parser.parse_args()
+
+def main():
+    '''
+    Serve a catalog from a local ESGF stand-in, run stages 1-4 (and 5) against it, and report
+    the time of each stage, the download throughput, the failures and the requests each node saw
+    '''
+
+    args = parse_args()
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix='bench_pipeline_')
+    os.makedirs(workdir, exist_ok=True)
+
+    if args.catalog is None:
+        catalog_dir = os.path.join(workdir, 'catalog')
+        print(f"===> Generating a catalog in {catalog_dir}")
+        make_catalog(catalog_dir, args.sources, files=args.files, filesize=args.filesize * 1e6,
+                     data_nodes=args.data_nodes, replicas=args.replicas, seed=args.seed)
+    else:
+        catalog_dir = args.catalog
+    rows = load_catalog(catalog_dir, None if args.max_filesize is None else args.max_filesize * 1e6)
+    experiments = sorted({row['experiment_id'] for row in rows})
+    variables = sorted({row['variable'] for row in rows})
+
+    standin = StandIn(rows, [f"index{idx}" for idx in range(args.index_nodes)], node_config(args), args.seed)
+    urls = standin.start()
+    print(f"{len(rows)} files, {sum(row['filesize'] for row in rows) * 1e-6:.1f} MB on {len(standin.data_nodes)} data nodes, "
+          f"{len(urls)} index nodes")
+
+    search_options = ['--search-domains'] + urls + ['--experiments'] + experiments + ['--variables'] + variables
+    stages = [
+        ('search', '1_retrieve_database_from_esgf.py', search_options + shlex.split(args.search_args)),
+        ('process', '2_process_database.py', []),
+        ('queue', '3_generate_queue_for_download.py', []),
+        ('download', '4_download_datasets.py', shlex.split(args.download_args)),
+    ]
+    if args.retry:
+        stages.append(('retry', '5_retry_for_failed_download.py', ['--search-domains'] + urls + shlex.split(args.retry_args)))
+
+    results = {'config': {key: value for key, value in vars(args).items() if key not in ['json', 'workdir']}, 'stages': {}}
+    ok = True
+    try:
+        for stage, script, options in stages:
+            seconds, returncode = run_stage(script, options, workdir)
+            result = {'seconds': seconds, 'returncode': returncode}
+            line = f"{stage:<10s} {seconds:8.2f} s"
+            if stage in ['download', 'retry']:
+                result.update(download_summary(workdir, rows))
+                result['mb_per_s'] = result['bytes_complete'] * 1e-6 / seconds
+                line += (f", {result['files_complete']}/{result['files_expected']} files complete "
+                         f"({result['bytes_complete'] * 1e-6:.1f} MB), journal {result['journal']}")
+                if result['failed_attempts_misreported']:
+                    line += (f", FAILED: {result['failed_attempts_misreported']} of {result['failed_attempts']} "
+                             f"failed attempts journaled with all bytes received")
+                    ok = False
+            if returncode != 0:
+                line += f", FAILED with exit code {returncode} (see {os.path.join(workdir, 'logs')})"
+            print(line)
+            results['stages'][stage] = result
+            if returncode != 0:
+                ok = False
+                break
+    finally:
+        standin.stop()
+
+    download = results['stages'].get('download')
+    if download is not None:
+        print(f"===> Stage 4: {download['mb_per_s']:.1f} MB/s")
+    results['nodes'] = standin.counters()
+    for kind, nodes in results['nodes'].items():
+        for name, counters in nodes.items():
+            print(f"{name:<16s} {counters['requests']:6d} requests, {counters['errors_503']:4d} 503s, "
+                  f"{counters['drops']:4d} drops, {counters['bytes_sent'] * 1e-6:9.1f} MB sent")
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,451 @@
+import os
+import re
+import sys
+import json
+import time
+import random
+import socket
+import hashlib
+import argparse
+import threading
+from functools import lru_cache
+from urllib.parse import urlparse, parse_qs, unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metadata_store import read_csv, write_csv, tables
+
+# behaviour of a node unless configured otherwise
+#  - latency: seconds before each response
+#  - bandwidth: cap on the bytes/s sent by the node over all its connections in MB/s (None for no cap)
+#  - error_rate: probability that a request starts a burst of 503 responses
+#  - burst: number of consecutive requests answered with 503 in a burst
+#  - drop_rate: probability that a file transfer is cut off part way (data nodes)
+#  - dead: refuse all connections
+default_behaviour = {'latency': 0.0, 'bandwidth': None, 'error_rate': 0.0, 'burst': 1, 'drop_rate': 0.0, 'dead': False}
+
+facet_names = ['project', 'activity_id', 'source_id', 'experiment_id', 'variant_label', 'variable', 'grid_label',
+               'frequency', 'table_id']
+
+chunk_size = 2**20
+
+@lru_cache(maxsize=64)
+def content_pattern(filename):
+    '''
+    Return one chunk of the synthetic content of a file; byte i of the file is pattern[i % 32]
+    '''
+    return hashlib.sha256(filename.encode()).digest() * (chunk_size // 32 + 1)
+
+def content(filename, start, end):
+    '''
+    Yield the synthetic bytes [start, end) of a file in chunks
+    '''
+    pattern = content_pattern(filename)
+    offset = start
+    while offset < end:
+        size = min(chunk_size, end - offset)
+        yield pattern[offset % 32:offset % 32 + size]
+        offset += size
+
+@lru_cache(maxsize=None)
+def content_checksum(filename, filesize):
+    '''
+    Return the SHA256 checksum of the synthetic content of a file
+    '''
+    h = hashlib.sha256()
+    for chunk in content(filename, 0, filesize):
+        h.update(chunk)
+    return h.hexdigest()
+
+def dataset_facets(row):
+    table_id = 'fx' if row['variable'] == 'areacella' else 'Amon'
+    return {'project': 'CMIP6', 'activity_id': row['activity_id'], 'source_id': row['source_id'],
+            'experiment_id': row['experiment_id'], 'variant_label': row['variant_label'], 'variable': row['variable'],
+            'grid_label': row['grid_label'], 'table_id': table_id, 'frequency': 'fx' if table_id == 'fx' else 'mon'}
+
+def make_catalog(output_dir, sources=4, experiments=('piControl', 'abrupt-4xCO2'),
+                 variables=('areacella', 'tas', 'rsdt', 'rsut', 'rlut'), files=2, filesize=10e6,
+                 data_nodes=3, replicas=2, seed=0):
+    '''
+    Write a fixture catalog as queue_for_download/*.csv files (one per source)
+
+    Every (source, experiment, variable) has files of about filesize bytes (one for areacella),
+    each published on replicas of the data nodes node0.example, node1.example, ...
+
+    Args:
+        output_dir (str): Directory to write the csv files to
+        sources (int): Number of sources (BENCH-0, BENCH-1, ...)
+        experiments (list): Experiment ids
+        variables (list): Variables
+        files (int): Number of files per (source, experiment, variable)
+        filesize (float): Mean file size in bytes
+        data_nodes (int): Number of data nodes
+        replicas (int): Number of data nodes publishing each file
+        seed (int): Seed of the file sizes
+
+    Returns:
+        list: Rows of the catalog (see tables['queue'] in metadata_store)
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    rng = random.Random(seed)
+    hosts = [f"node{idx}.example" for idx in range(data_nodes)]
+    rows = []
+    for source_idx in range(sources):
+        source_id = f"BENCH-{source_idx}"
+        source_rows = []
+        for experiment_id in experiments:
+            for variable in variables:
+                if variable == 'areacella':
+                    filenames = [f"areacella_fx_{source_id}_{experiment_id}_r1i1p1f1_gn.nc"]
+                else:
+                    filenames = [f"{variable}_Amon_{source_id}_{experiment_id}_r1i1p1f1_gn_{1850 + 100 * idx:04d}01-{1949 + 100 * idx:04d}12.nc"
+                                 for idx in range(files)]
+                for idx, filename in enumerate(filenames):
+                    size = int(filesize * rng.uniform(0.8, 1.2)) if variable != 'areacella' else 100000
+                    file_hosts = [hosts[(source_idx + idx + offset) % len(hosts)] for offset in range(min(replicas, len(hosts)))]
+                    source_rows.append({
+                        'source_id': source_id, 'activity_id': 'CMIP', 'experiment_id': experiment_id,
+                        'variant_label': 'r1i1p1f1', 'variable': variable, 'grid_label': 'gn',
+                        'filenum': f"{idx + 1}/{len(filenames)}", 'filename': filename, 'filesize': size,
+                        'download_url': [f"https://{host}/thredds/fileServer/cmip6/{filename}" for host in file_hosts],
+                        'opendap_url': [f"https://{host}/thredds/dodsC/cmip6/{filename}" for host in file_hosts],
+                        'checksum': content_checksum(filename, size), 'checksum_type': 'SHA256'})
+        write_csv(os.path.join(output_dir, f"{source_id}.csv"), tables['queue'], tables['queue'], source_rows)
+        rows += source_rows
+    return rows
+
+def load_catalog(catalog_dir, max_filesize=None):
+    '''
+    Read a catalog of queue_for_download/*.csv files (e.g., made by make_catalog or stage 3)
+
+    The stand-in serves synthetic content of the listed size for every file, so the
+    checksums of the catalog are replaced by those of that content; max_filesize
+    (bytes) caps the sizes, e.g., to replay a real queue at a smaller scale
+    '''
+    rows = []
+    for filename in sorted(os.listdir(catalog_dir)):
+        if not filename.endswith('.csv'):
+            continue
+        for row in read_csv(os.path.join(catalog_dir, filename), tables['queue']):
+            row['filesize'] = int(row['filesize'])
+            if max_filesize is not None:
+                row['filesize'] = min(row['filesize'], int(max_filesize))
+            row['checksum'] = content_checksum(row['filename'], row['filesize'])
+            row['checksum_type'] = 'SHA256'
+            rows.append(row)
+    return rows
+
+class Node:
+    '''
+    Failure and bandwidth behaviour of one node, with counters of what it served
+    '''
+
+    def __init__(self, name, behaviour=None, seed=0):
+        self.name = name
+        self.behaviour = dict(default_behaviour, **(behaviour or {}))
+        self.counters = {'requests': 0, 'errors_503': 0, 'drops': 0, 'bytes_sent': 0}
+        self.port = None
+        self._random = random.Random(f"{seed}-{name}")
+        self._burst_left = 0
+        self._lock = threading.Lock()
+        self._next_send = time.monotonic()
+
+    def count(self, counter, value=1):
+        with self._lock:
+            self.counters[counter] += value
+
+    def unavailable(self):
+        '''
+        Return True if this request is answered with 503 (as part of a burst)
+        '''
+        with self._lock:
+            self.counters['requests'] += 1
+            if self._burst_left == 0 and self._random.random() < self.behaviour['error_rate']:
+                self._burst_left = max(1, int(self.behaviour['burst']))
+            if self._burst_left > 0:
+                self._burst_left -= 1
+                self.counters['errors_503'] += 1
+                return True
+        return False
+
+    def drop_point(self, num_bytes):
+        '''
+        Return the number of bytes after which this transfer is cut off, or None
+        '''
+        with self._lock:
+            if num_bytes and self._random.random() < self.behaviour['drop_rate']:
+                return self._random.randrange(num_bytes)
+        return None
+
+    def throttle(self, num_bytes):
+        '''
+        Wait until num_bytes more can be sent within the bandwidth of the node (shared by its connections)
+        '''
+        bandwidth = self.behaviour['bandwidth']
+        if not bandwidth:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next_send, now)
+            self._next_send = start + num_bytes / (bandwidth * 1e6)
+            wait = start - now
+        if wait > 0:
+            time.sleep(wait)
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def handle(self):
+        # clients give up on slow or failing transfers by closing the connection
+        try:
+            super().handle()
+        except ConnectionError:
+            self.close_connection = True
+
+    def send_body(self, status, body, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        node = self.server.node
+        if node.behaviour['latency']:
+            time.sleep(node.behaviour['latency'])
+        if node.unavailable():
+            self.send_body(503, b'Service Unavailable', 'text/plain')
+            return
+        path = urlparse(self.path).path
+        if self.server.kind == 'index' and path.rstrip('/').endswith('/search'):
+            query = parse_qs(urlparse(self.path).query)
+            body = json.dumps(self.server.standin.search(query, node.port)).encode()
+            node.count('bytes_sent', len(body))
+            self.send_body(200, body)
+        elif self.server.kind == 'data' and '/thredds/fileServer/' in path:
+            self.send_file(unquote(path.rsplit('/', 1)[-1]))
+        else:
+            self.send_body(404, b'Not Found', 'text/plain')
+
+    def send_file(self, filename):
+        node = self.server.node
+        filesize = self.server.standin.filesizes.get(filename)
+        if filesize is None or filename not in self.server.standin.node_files[node.name]:
+            self.send_body(404, b'Not Found', 'text/plain')
+            return
+
+        start, end = 0, filesize
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)) + 1, filesize) if match.group(2) else filesize
+            if start >= filesize:
+                self.send_response(416)
+                self.send_header('Content-Range', f"bytes */{filesize}")
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{end - 1}/{filesize}")
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/netcdf')
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+        drop = node.drop_point(end - start)
+        sent = 0
+        for chunk in content(filename, start, end):
+            if drop is not None and sent + len(chunk) > drop:
+                chunk = chunk[:drop - sent]
+            node.throttle(len(chunk))
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            node.count('bytes_sent', len(chunk))
+            if drop is not None and sent >= drop:
+                # cut the connection part way through the body
+                node.count('drops')
+                self.close_connection = True
+                self.connection.shutdown(socket.SHUT_RDWR)
+                return
+
+class StandIn:
+    '''
+    Local stand-in for ESGF index nodes (esg-search) and data nodes (THREDDS fileServer)
+    serving a fixture catalog, with configurable latency, bandwidth, 503 bursts,
+    dropped connections and dead nodes
+
+    Each node listens on its own port of 127.0.0.1, so that clients see distinct
+    hosts; the data node host names of the catalog urls are mapped to local ports
+    in the search responses, and every file is served as synthetic content of its size
+    '''
+
+    def __init__(self, rows, index_nodes=('index0',), config=None, seed=0):
+        '''
+        Args:
+            rows (list): Catalog rows (see make_catalog and load_catalog)
+            index_nodes (list): Names of the index nodes
+            config (dict): Node behaviour, {"index_nodes": {name: {...}}, "data_nodes": {host: {...}}},
+                           where the name "default" applies to nodes not listed (see default_behaviour)
+            seed (int): Seed of the failure injection
+        '''
+        config = config or {}
+        self.rows = rows
+        self.filesizes = {row['filename']: row['filesize'] for row in rows}
+        self.node_files = {}
+        for row in rows:
+            for url in row['download_url']:
+                self.node_files.setdefault(urlparse(url).netloc, set()).add(row['filename'])
+
+        def behaviour(kind, name):
+            nodes = config.get(kind, {})
+            return dict(nodes.get('default', {}), **nodes.get(name, {}))
+
+        self.index_nodes = [Node(name, behaviour('index_nodes', name), seed) for name in index_nodes]
+        self.data_nodes = {host: Node(host, behaviour('data_nodes', host), seed) for host in sorted(self.node_files)}
+        self.datasets = self._build_datasets()
+        self._servers = []
+
+    def _build_datasets(self):
+        # one dataset replica per (dataset, data node), with the files it publishes
+        datasets = {}
+        for row in self.rows:
+            facets = dataset_facets(row)
+            master_id = '.'.join(['CMIP6', row['activity_id'], 'BENCH', row['source_id'], row['experiment_id'],
+                                  row['variant_label'], facets['table_id'], row['variable'], row['grid_label'], 'v20190101'])
+            for url in row['download_url']:
+                host = urlparse(url).netloc
+                dataset = datasets.setdefault(f"{master_id}|{host}", {'facets': facets, 'files': [], 'host': host})
+                dataset['files'].append(row)
+        return datasets
+
+    def start(self):
+        '''
+        Start all nodes in background threads
+
+        Returns:
+            list: esg-search urls of the index nodes, in order
+        '''
+        for kind, nodes in [('index', self.index_nodes), ('data', list(self.data_nodes.values()))]:
+            for node in nodes:
+                if node.behaviour['dead']:
+                    # a port with nothing listening: connections are refused
+                    with socket.socket() as sock:
+                        sock.bind(('127.0.0.1', 0))
+                        node.port = sock.getsockname()[1]
+                    continue
+                server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+                server.daemon_threads = True
+                server.kind, server.node, server.standin = kind, node, self
+                node.port = server.server_address[1]
+                threading.Thread(target=server.serve_forever, daemon=True).start()
+                self._servers.append(server)
+        return [f"http://127.0.0.1:{node.port}/esg-search" for node in self.index_nodes]
+
+    def stop(self):
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        self._servers = []
+
+    def counters(self):
+        '''
+        Return the counters of every node
+        '''
+        return {'index_nodes': {node.name: dict(node.counters) for node in self.index_nodes},
+                'data_nodes': {host: dict(node.counters) for host, node in self.data_nodes.items()}}
+
+    def local_url(self, host, service, filename):
+        path = 'fileServer' if service == 'HTTPServer' else 'dodsC'
+        suffix = '.html' if service == 'OPENDAP' else ''
+        return f"http://127.0.0.1:{self.data_nodes[host].port}/thredds/{path}/cmip6/{filename}{suffix}"
+
+    def search(self, query, port):
+        '''
+        Answer an esg-search query (solr json format) for Dataset or File records
+        '''
+        search_type = query.get('type', ['Dataset'])[0]
+        limit = int(query.get('limit', ['10'])[0])
+        offset = int(query.get('offset', ['0'])[0])
+
+        if search_type == 'File':
+            docs = []
+            for dataset_id in query.get('dataset_id', []):
+                dataset = self.datasets.get(dataset_id)
+                if dataset is None:
+                    continue
+                for row in dataset['files']:
+                    docs.append({
+                        'id': f"{dataset_id.split('|')[0]}.{row['filename']}|{dataset['host']}",
+                        'dataset_id': dataset_id, 'title': row['filename'], 'size': row['filesize'],
+                        'data_node': dataset['host'], 'checksum': [row['checksum']], 'checksum_type': [row['checksum_type']],
+                        'url': [f"{self.local_url(dataset['host'], 'HTTPServer', row['filename'])}|application/netcdf|HTTPServer",
+                                f"{self.local_url(dataset['host'], 'OPENDAP', row['filename'])}|application/opendap-html|OPENDAP"]})
+        else:
+            constraints = {name: values for name, values in query.items() if name in facet_names}
+            docs = []
+            for dataset_id, dataset in sorted(self.datasets.items()):
+                facets = dataset['facets']
+                if all(facets[name] in values for name, values in constraints.items()):
+                    doc = {name: [value] for name, value in facets.items()}
+                    doc.update(id=dataset_id, master_id=dataset_id.split('|')[0], data_node=dataset['host'],
+                               version='20190101', number_of_files=len(dataset['files']), latest=True, replica=False)
+                    docs.append(doc)
+
+        facet_fields = {}
+        requested = [facet for value in query.get('facets', []) for facet in value.split(',') if facet in facet_names]
+        for facet in requested:
+            counts = {}
+            for doc in docs:
+                for value in doc.get(facet, []):
+                    counts[value] = counts.get(value, 0) + 1
+            facet_fields[facet] = [itm for value, count in sorted(counts.items()) for itm in (value, count)]
+
+        return {'responseHeader': {'status': 0, 'QTime': 0, 'params': {'shards': f"127.0.0.1:{port}/solr"}},
+                'response': {'numFound': len(docs), 'start': offset, 'docs': docs[offset:offset + limit] if limit else []},
+                'facet_counts': {'facet_fields': facet_fields}}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serve a fixture catalog as local ESGF index and data nodes")
+    parser.add_argument('--catalog', default=None,
+                        help="directory of queue csv files to serve (default: a generated catalog)")
+    parser.add_argument('--config', default=None,
+                        help="json file with the behaviour of the nodes (see StandIn)")
+    parser.add_argument('--index-nodes', type=int, default=1, help="number of index nodes")
+    parser.add_argument('--max-filesize', type=float, default=None, help="cap on the file sizes of --catalog in MB")
+    return parser.parse_args()
+
+def main():
+    '''
+    Serve until interrupted, printing the esg-search urls to pass to stages 1 and 5 (--search-domains)
+    '''
+
+    args = parse_args()
+    if args.catalog is None:
+        args.catalog = 'standin_catalog'
+        make_catalog(args.catalog)
+    rows = load_catalog(args.catalog, None if args.max_filesize is None else args.max_filesize * 1e6)
+    config = None
+    if args.config is not None:
+        with open(args.config, 'r') as f:
+            config = json.load(f)
+
+    standin = StandIn(rows, [f"index{idx}" for idx in range(args.index_nodes)], config)
+    urls = standin.start()
+    print(f"Serving {len(rows)} files of {args.catalog} on {len(standin.data_nodes)} data nodes")
+    print(f"--search-domains {' '.join(urls)}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    standin.stop()
+    print(json.dumps(standin.counters(), indent=1))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import os
+
+import numpy as np
+import netCDF4
+
+# first day (from the start of the year) and length of each month of a 365-day year
+month_starts = np.cumsum([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30])
+month_lengths = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+def grid(nlat, nlon):
+    '''
+    Return the cell centers and bounds (degrees) of a regular lat/lon grid
+    '''
+    lat_bnds = np.linspace(-90, 90, nlat + 1)
+    lon_bnds = np.linspace(0, 360, nlon + 1)
+    lat = (lat_bnds[:-1] + lat_bnds[1:]) / 2
+    lon = (lon_bnds[:-1] + lon_bnds[1:]) / 2
+    return lat, lon, np.stack([lat_bnds[:-1], lat_bnds[1:]], axis=1), np.stack([lon_bnds[:-1], lon_bnds[1:]], axis=1)
+
+def write_coordinates(ds, lat, lon, lat_bnds, lon_bnds):
+    ds.createDimension('lat', len(lat))
+    ds.createDimension('lon', len(lon))
+    ds.createDimension('bnds', 2)
+    coordinates = [('lat', lat, lat_bnds, 'degrees_north', 'Y', 'latitude'),
+                   ('lon', lon, lon_bnds, 'degrees_east', 'X', 'longitude')]
+    for name, values, bnds, units, axis, standard_name in coordinates:
+        var = ds.createVariable(name, 'f8', (name,))
+        var.setncatts({'units': units, 'axis': axis, 'bounds': f"{name}_bnds", 'standard_name': standard_name})
+        var[:] = values
+        ds.createVariable(f"{name}_bnds", 'f8', (name, 'bnds'))[:] = bnds
+
+def cell_area(lat_bnds, lon_bnds, radius=6371e3):
+    '''
+    Return the area (m2) of the cells of a regular lat/lon grid on a sphere
+    '''
+    band = np.diff(np.sin(np.deg2rad(lat_bnds)), axis=1)[:, 0]
+    width = np.deg2rad(np.diff(lon_bnds, axis=1)[:, 0])
+    return radius**2 * np.outer(band, width)
+
+def make_fixtures(output_dir, nlat=96, nlon=144, years=20, files=2, areacella=True, variable='tas',
+                  source_id='BENCH-ESM', experiment_id='piControl', variant_label='r1i1p1f1', grid_label='gn',
+                  start_year=1850, seed=0):
+    '''
+    Write CMIP-shaped NetCDF files of one (source_id, experiment_id, variable) as downloaded by stage 4
+
+    The monthly series of (time, lat, lon) float32 values is split into files of whole
+    years, named and laid out like CMIP6 Amon files (365-day calendar, lat/lon bounds,
+    variable_id attribute), optionally with the matching areacella_fx_* file
+
+    Args:
+        output_dir (str): Directory to write the files to
+        nlat (int): Number of latitudes
+        nlon (int): Number of longitudes
+        years (int): Number of years of the whole series
+        files (int): Number of files the series is split into
+        areacella (bool): Also write the areacella file
+        variable (str): Variable name
+        source_id, experiment_id, variant_label, grid_label (str): Facets used in the file names
+        start_year (int): First year
+        seed (int): Seed of the random variability
+
+    Returns:
+        list: Names of the data files, in time order
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    lat, lon, lat_bnds, lon_bnds = grid(nlat, nlon)
+
+    # a zonal climatology with a seasonal cycle, a trend and noise
+    climatology = (288 - 40 * np.sin(np.deg2rad(lat))**2)[:, None] * np.ones(nlon)
+    seasonal = 10 * np.sin(np.deg2rad(lat))[:, None]
+
+    file_names = []
+    splits = np.array_split(np.arange(years), min(files, years))
+    for file_years in splits:
+        first, last = start_year + file_years[0], start_year + file_years[-1]
+        file_name = f"{variable}_Amon_{source_id}_{experiment_id}_{variant_label}_{grid_label}_{first:04d}01-{last:04d}12.nc"
+        with netCDF4.Dataset(os.path.join(output_dir, file_name), 'w') as ds:
+            ds.setncatts({'variable_id': variable, 'source_id': source_id, 'experiment_id': experiment_id,
+                          'variant_label': variant_label, 'grid_label': grid_label, 'table_id': 'Amon', 'frequency': 'mon'})
+            ds.createDimension('time', None)
+            write_coordinates(ds, lat, lon, lat_bnds, lon_bnds)
+
+            offsets = np.add.outer((file_years + start_year - 1850) * 365, month_starts).ravel()
+            time = ds.createVariable('time', 'f8', ('time',))
+            time.setncatts({'units': 'days since 1850-01-01', 'calendar': '365_day', 'axis': 'T', 'bounds': 'time_bnds'})
+            time[:] = offsets + np.tile(month_lengths, len(file_years)) / 2
+            time_bnds = ds.createVariable('time_bnds', 'f8', ('time', 'bnds'))
+            time_bnds[:] = np.stack([offsets, offsets + np.tile(month_lengths, len(file_years))], axis=1)
+
+            var = ds.createVariable(variable, 'f4', ('time', 'lat', 'lon'), fill_value=np.float32(1e20))
+            var.setncatts({'units': 'K', 'cell_methods': 'area: time: mean', 'cell_measures': 'area: areacella'})
+            for idx, year in enumerate(file_years):
+                phase = np.cos(2 * np.pi * (np.arange(12) + 0.5) / 12)[:, None, None]
+                values = climatology + 0.01 * year + phase * seasonal + rng.normal(0, 1, (12, nlat, nlon))
+                var[idx * 12:(idx + 1) * 12] = values.astype(np.float32)
+        file_names.append(file_name)
+
+    if areacella:
+        file_name = f"areacella_fx_{source_id}_{experiment_id}_{variant_label}_{grid_label}.nc"
+        with netCDF4.Dataset(os.path.join(output_dir, file_name), 'w') as ds:
+            ds.setncatts({'variable_id': 'areacella', 'source_id': source_id, 'table_id': 'fx', 'frequency': 'fx'})
+            write_coordinates(ds, lat, lon, lat_bnds, lon_bnds)
+            var = ds.createVariable('areacella', 'f4', ('lat', 'lon'))
+            var.setncatts({'units': 'm2', 'standard_name': 'cell_area'})
+            var[:] = cell_area(lat_bnds, lon_bnds).astype(np.float32)
+
+    return file_names
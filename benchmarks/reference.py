@@ -0,0 +1,74 @@
+import os
+
+import numpy as np
+import xarray as xr
+
+from utils import deg2rad, surface_area
+
+# Reference implementations of the aggregation as first written (one timestep and one
+# longitude at a time); slow, but simple enough to check the optimized code against
+
+def reference_area(da):
+    '''
+    Compute the grid cell areas (square km) of a data array one longitude at a time (see utils.area)
+    '''
+    lat_vals = deg2rad(da.lat.data)
+    lon_vals = deg2rad(da.lon.data)
+    dlat_vals = np.gradient(lat_vals)
+    dlon_vals = np.gradient(lon_vals)
+    A = np.empty((len(lat_vals), len(lon_vals)), dtype=float)
+    for i, dlon in enumerate(dlon_vals):
+        A[:, i] = surface_area(lat_vals, dlat_vals, dlon)
+    return A
+
+def reference_annual_means(input_dir, file_names):
+    '''
+    Compute the annual global means of the files of a (source_id, experiment_id, variable)
+    one timestep at a time, as build_data did originally
+
+    Args:
+        input_dir (str): Input directory containing raw data files
+        file_names (list): NetCDF file names in input_dir
+
+    Returns:
+        list: (year, annual value) tuples sorted by year
+    '''
+    numdays_of_month = {1: 31, 2: 28, 3: 31, 4: 30, 5: 31, 6: 30, 7: 31, 8: 31, 9: 30, 10: 31, 11: 30, 12: 31}
+
+    output = []
+    for file_name in file_names:
+        ds = xr.open_dataset(os.path.join(input_dir, file_name))
+        da = ds[ds.variable_id]
+        _, _, model_id, experiment_id, variant_id, grid_type, _ = file_name.split('_')
+
+        area_file_path = os.path.join(input_dir, f"areacella_fx_{model_id}_{experiment_id}_{variant_id}_{grid_type}.nc")
+        if os.path.isfile(area_file_path):
+            with xr.open_dataset(area_file_path) as area_ds:
+                area_data = area_ds[area_ds.variable_id].values * 1e-6
+        else:
+            area_data = reference_area(da)
+
+        time = da['time']
+        current_year = int(time[0].dt.year.values)
+        month_values = []
+        for idx_t, t in enumerate(time):
+            year = int(t.dt.year.values)
+            month = int(t.dt.month.values)
+
+            month_value = np.nansum(da.sel(time=t).data * area_data / area_data.sum())
+            month_value *= numdays_of_month[month] / 365
+
+            if year == current_year:
+                month_values.append(month_value)
+            else:
+                if len(month_values) == 12:
+                    output.append((current_year, sum(month_values)))
+                month_values = [month_value]
+                current_year = year
+
+            if idx_t == len(time) - 1 and len(month_values) == 12:
+                output.append((year, sum(month_values)))
+        ds.close()
+
+    output.sort()
+    return output
@@ -0,0 +1,15 @@
+# experiments and variables to search for (stage 1) and process (stage 2)
+experiment_ids = ['piControl', 'abrupt-4xCO2', '1pctCO2', 'historical', 'ssp119', 'ssp245', 'ssp370', 'ssp460', 'ssp585', 'esm-piControl', 'esm-hist', 'esm-ssp585', 'esm-1pctCO2']
+variables = ["areacella", "tas", "rsdt", "rsut", "rlut"]
+
+# ESGF index nodes to search, in order (stages 1 and 5)
+search_domains = ["esgf-node.llnl.gov", "esgf-data.dkrz.de", "esgf-index1.ceda.ac.uk"]
+
+def search_url(search_domain):
+    '''
+    Return the esg-search url of an index node, given by host name or as a full url
+    (e.g., http://127.0.0.1:8000/esg-search for a local stand-in, see benchmarks/esgf_standin.py)
+    '''
+    if '://' in search_domain:
+        return search_domain
+    return f"https://{search_domain}/esg-search"
@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+default_path = os.path.join('downloaded', 'journal.db')
+
+# states of a file in the journal
+#  - queued: waiting to be downloaded
+#  - active: being downloaded; left over from an interrupted run, it is queued again (see recover)
+#  - done: downloaded (over HTTP, or subset over OPeNDAP)
+#  - failed: every mirror failed in the last attempt
+#  - remote: aggregated over OPeNDAP instead of downloaded (stage 4 --remote-aggregate)
+#  - evicted: downloaded, aggregated and removed from the download directory (stage 4 --evict)
+states = ['queued', 'active', 'done', 'failed', 'remote', 'evicted']
+
+file_columns = ['filename', 'source_id', 'experiment_id', 'variable', 'filesize', 'checksum', 'checksum_type',
+                'download_url', 'opendap_url', 'state', 'attempts', 'mirror', 'bytes_received', 'updated']
+attempt_columns = ['filename', 'method', 'mirror', 'outcome', 'bytes_received', 'started', 'finished', 'error']
+
+class DownloadJournal:
+    '''
+    Transactional record of the download state of every queued file, kept in
+    SQLite in WAL mode so that each state change is committed as it happens and
+    survives a crash, while other processes can read the journal at any time
+
+    Besides the state of each file, it keeps every attempt (method, mirror,
+    outcome, bytes received), so stages 4 and 5 pick their work with an
+    indexed query on the state instead of checking the download directory
+    '''
+
+    def __init__(self, path=default_path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # one connection shared by the download threads, serialized by the lock
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS files (filename TEXT PRIMARY KEY, source_id TEXT, experiment_id TEXT, variable TEXT, "
+                              "filesize INTEGER, checksum TEXT, checksum_type TEXT, download_url TEXT, opendap_url TEXT, "
+                              "state TEXT, attempts INTEGER, mirror TEXT, bytes_received INTEGER, updated REAL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS files_state ON files (state, source_id)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS attempts (filename TEXT, method TEXT, mirror TEXT, outcome TEXT, "
+                              "bytes_received INTEGER, started REAL, finished REAL, error TEXT)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS attempts_filename ON attempts (filename)")
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def enqueue(self, rows, output_dir=None):
+        '''
+        Add queue rows to the journal, updating the metadata of files already in it
+
+        Files new to the journal start as queued, or as done if they are already in
+        output_dir (i.e., downloaded before the journal was kept); the state of files
+        already in the journal is left as it is
+
+        Args:
+            rows (iterable): Rows of the queue table (see metadata_store)
+            output_dir (str): Download directory checked for files new to the journal
+
+        Returns:
+            None
+        '''
+        with self._lock, self.conn:
+            known = {row[0] for row in self.conn.execute("SELECT filename FROM files")}
+            now = time.time()
+            for row in rows:
+                values = [row['source_id'], row['experiment_id'], row['variable'], row['filesize'], row['checksum'],
+                          row['checksum_type'], json.dumps(row['download_url']), json.dumps(row['opendap_url'])]
+                if row['filename'] in known:
+                    self.conn.execute("UPDATE files SET source_id = ?, experiment_id = ?, variable = ?, filesize = ?, checksum = ?, "
+                                      "checksum_type = ?, download_url = ?, opendap_url = ? WHERE filename = ?",
+                                      values + [row['filename']])
+                    continue
+                done = output_dir is not None and os.path.isfile(os.path.join(output_dir, row['filename']))
+                self.conn.execute(f"INSERT INTO files ({', '.join(file_columns)}) VALUES ({', '.join('?' for _ in file_columns)})",
+                                  [row['filename']] + values + ['done' if done else 'queued', 0, '', row['filesize'] if done else 0, now])
+                known.add(row['filename'])
+
+    def recover(self):
+        '''
+        Queue again the files left active by an interrupted run (their .part files are resumed)
+        '''
+        with self._lock, self.conn:
+            self.conn.execute("UPDATE files SET state = 'queued', updated = ? WHERE state = 'active'", (time.time(),))
+
+    def rescan(self, output_dir):
+        '''
+        Queue again the files marked done that are no longer in output_dir (e.g., deleted by hand)
+        '''
+        with self._lock, self.conn:
+            done = [row[0] for row in self.conn.execute("SELECT filename FROM files WHERE state = 'done'")]
+            missing = [(time.time(), filename) for filename in done if not os.path.isfile(os.path.join(output_dir, filename))]
+            self.conn.executemany("UPDATE files SET state = 'queued', updated = ? WHERE filename = ?", missing)
+
+    def select(self, states, sources=None):
+        '''
+        Return the files in any of the states, in the order they were added to the journal
+
+        Args:
+            states (list): States to select (see states)
+            sources (list): Source ids to select, or None for all
+
+        Returns:
+            list: Dicts keyed by column name, with the mirror urls as lists
+        '''
+        clause = f"state IN ({', '.join('?' for _ in states)})"
+        params = list(states)
+        if sources is not None:
+            clause += f" AND source_id IN ({', '.join('?' for _ in sources)})"
+            params += list(sources)
+        with self._lock:
+            rows = self.conn.execute(f"SELECT * FROM files WHERE {clause} ORDER BY rowid", params).fetchall()
+        files = []
+        for row in rows:
+            entry = dict(row)
+            entry['download_url'] = json.loads(entry['download_url'])
+            entry['opendap_url'] = json.loads(entry['opendap_url'])
+            files.append(entry)
+        return files
+
+    def counts(self):
+        '''
+        Return the number of files in each state
+        '''
+        with self._lock:
+            return dict(self.conn.execute("SELECT state, COUNT(*) FROM files GROUP BY state").fetchall())
+
+    def attempts(self, filename):
+        '''
+        Return the attempts to download a file, oldest first
+        '''
+        with self._lock:
+            rows = self.conn.execute(f"SELECT {', '.join(attempt_columns)} FROM attempts WHERE filename = ? ORDER BY rowid", (filename,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def start(self, filename):
+        '''
+        Mark a file as being downloaded
+        '''
+        with self._lock, self.conn:
+            self.conn.execute("UPDATE files SET state = 'active', attempts = attempts + 1, updated = ? WHERE filename = ?",
+                              (time.time(), filename))
+
+    def record_attempt(self, filename, method, mirror, outcome, bytes_received, started, error=''):
+        '''
+        Record one attempt to download a file from a mirror
+
+        Args:
+            filename (str): File name
+            method (str): 'http', 'segmented' or 'opendap'
+            mirror (str): Url (or '|'-joined urls) tried
+            outcome (str): 'done' or 'failed'
+            bytes_received (int): Bytes of the file on disk after the attempt (complete or in its .part file)
+            started (float): Start time of the attempt (time.time())
+            error (str): Error message of a failed attempt
+
+        Returns:
+            None
+        '''
+        now = time.time()
+        with self._lock, self.conn:
+            self.conn.execute(f"INSERT INTO attempts ({', '.join(attempt_columns)}) VALUES ({', '.join('?' for _ in attempt_columns)})",
+                              (filename, method, mirror, outcome, bytes_received, started, now, error))
+            self.conn.execute("UPDATE files SET mirror = ?, bytes_received = ?, updated = ? WHERE filename = ?",
+                              (mirror, bytes_received, now, filename))
+
+    def finish(self, filename, state):
+        '''
+        Set the final state of a file after a run ('done', 'failed', 'remote' or 'evicted')
+        '''
+        with self._lock, self.conn:
+            self.conn.execute("UPDATE files SET state = ?, updated = ? WHERE filename = ?", (state, time.time(), filename))
@@ -0,0 +1,987 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import HTTPError, ConnectionError, ChunkedEncodingError, Timeout
+
+import netCDF4
+import xarray as xr
+
+from utils import area, stream_annual_mean, save_output
+from metrics import metrics, instrument_session, Progress, format_duration
+
+class IncompleteDownloadError(Exception):
+    '''
+    Raised when a transfer ends with a different number of bytes than expected
+    '''
+
+class ChecksumMismatchError(Exception):
+    '''
+    Raised when a downloaded file does not match the checksum published by ESGF
+    '''
+
+def new_hasher(checksum_type):
+    '''
+    Return a hashlib object for an ESGF checksum type (e.g., SHA256, MD5), or None if not supported
+    '''
+    try:
+        return hashlib.new(checksum_type.lower())
+    except (AttributeError, ValueError):
+        return None
+
+def hash_file(file_path, hasher, size=None, block_size=2**20):
+    '''
+    Feed the contents of a file (or its first size bytes) to a hashlib object and return it
+    '''
+    remaining = os.path.getsize(file_path) if size is None else size
+    with open(file_path, 'rb') as f:
+        while remaining > 0:
+            block = f.read(min(block_size, remaining))
+            if not block:
+                break
+            hasher.update(block)
+            remaining -= len(block)
+    return hasher
+
+def check_checksum(filename, hasher, checksum):
+    '''
+    Raise ChecksumMismatchError if the digest of a hashlib object differs from checksum
+    '''
+    if hasher.hexdigest() != checksum.strip().lower():
+        raise ChecksumMismatchError(f"{filename}: {hasher.name} {hasher.hexdigest()} does not match {checksum}")
+
+class TransferLayer:
+    '''
+    HTTP transfer settings and keep-alive sessions shared by stages 4 and 5
+
+    One requests session is kept per host and shared by all threads, so TCP and TLS
+    connections are reused across the files fetched from the same data node; the
+    latency of every request is observed per node (see metrics.instrument_session)
+    Reads use large chunks and writes a large buffer to keep the Python overhead
+    per byte low on fast links
+    '''
+
+    def __init__(self, chunk_size=4 * 2**20, write_buffer=16 * 2**20,
+                 connect_timeout=30, read_timeout=60, pool_size=8):
+        self.chunk_size = chunk_size
+        self.write_buffer = write_buffer
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pool_size = pool_size
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def session(self, url):
+        '''
+        Return the keep-alive session for the host of a url
+        '''
+        host = data_node(url)
+        with self._lock:
+            if host not in self._sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[host] = instrument_session(session)
+            return self._sessions[host]
+
+    def get(self, url, headers=None, read_timeout=None):
+        '''
+        Send a streaming GET request through the session of the url's host
+        '''
+        timeout = (self.connect_timeout, read_timeout or self.read_timeout)
+        return self.session(url).get(url, stream=True, timeout=timeout, headers=headers)
+
+# transfer layer used unless another one is passed in
+default_transfer = TransferLayer()
+
+def preallocate(f, size):
+    '''
+    Reserve disk space for size bytes, or extend the file sparsely if the file system does not support it
+    '''
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except (AttributeError, OSError):
+        f.truncate(size)
+
+def read_state(state_path):
+    '''
+    Read the progress of a preallocated .part file, or return None if there is none
+    '''
+    if not os.path.isfile(state_path):
+        return None
+    with open(state_path, 'r') as f:
+        return json.load(f)
+
+def write_state(state_path, filesize, segments):
+    '''
+    Write the progress of a preallocated .part file as a list of
+    {'start', 'end', 'received'} byte ranges (atomically)
+    '''
+    tmp_state_path = f"{state_path}.tmp"
+    with open(tmp_state_path, 'w') as f:
+        json.dump({'filesize': filesize, 'segments': segments}, f)
+    os.replace(tmp_state_path, state_path)
+
+def resume_offset(part_path, state_path, filesize):
+    '''
+    Return the number of bytes at the start of a .part file that are already downloaded
+
+    A .part file with a state file (preallocated) is valid up to its first gap;
+    one without (written sequentially) is valid up to its size
+    '''
+    if not os.path.isfile(part_path):
+        return 0
+    state = read_state(state_path)
+    if state is None:
+        return os.path.getsize(part_path)
+    if state['filesize'] != filesize:
+        return 0
+    offset = 0
+    for segment in sorted(state['segments'], key=lambda segment: segment['start']):
+        if segment['start'] > offset:
+            break
+        offset = max(offset, segment['start'] + segment['received'])
+        if segment['start'] + segment['received'] < segment['end']:
+            break
+    return offset
+
+def finalize(part_path, state_path, file_path):
+    '''
+    Rename a complete .part file into place and remove its state file
+    '''
+    os.replace(part_path, file_path)
+    if os.path.isfile(state_path):
+        os.remove(state_path)
+
+def report(filename, source, num_bytes, seconds):
+    '''
+    Print the throughput of a finished transfer
+    '''
+    rate = num_bytes / max(seconds, 1e-6)
+    print(f"===> {filename}: {num_bytes * 1e-6:.1f} MB in {seconds:.1f} s ({rate * 1e-6:.2f} MB/s) from {source}")
+
+def download(filename, download_url, output_dir, filesize=None, stats=None, checksum=None, checksum_type=None, transfer=None):
+    '''
+    Download a file over HTTP
+
+    Bytes are written to {filename}.part, which is renamed to filename only
+    once the transfer is complete, so an existing filename is always a full file
+    A .part file left by an interrupted transfer is resumed with a Range request
+    If the file size is known, the .part file is preallocated and the number of
+    bytes written so far is kept in {filename}.part.json
+
+    Args:
+        filename (str): File name to save in output_dir
+        download_url (str): HTTP download url
+        output_dir (str): Output directory
+        filesize (int): Expected file size in bytes, checked before the rename if given
+        stats (MirrorStats): Statistics to record the transfer in, if given
+        checksum (str): Expected checksum, computed on the bytes as they stream in and checked before the rename if given
+        checksum_type (str): Algorithm of the checksum (e.g., SHA256)
+        transfer (TransferLayer): Sessions and buffer settings, default_transfer if not given
+
+    Returns:
+        None
+
+    Raises:
+        ChecksumMismatchError: If the file does not match checksum; the .part file is removed
+    '''
+    transfer = transfer if transfer is not None else default_transfer
+    file_path = os.path.join(output_dir, filename)
+    part_path = f"{file_path}.part"
+    state_path = f"{part_path}.json"
+    retries = 3
+    for attempt in range(retries):
+        try:
+            offset = resume_offset(part_path, state_path, filesize)
+            hasher = new_hasher(checksum_type) if checksum else None
+            if filesize is not None and offset >= filesize:
+                if offset == filesize:
+                    if hasher is not None:
+                        check_checksum(filename, hash_file(part_path, hasher, filesize), checksum)
+                    if os.path.getsize(part_path) > filesize:
+                        with open(part_path, 'r+b') as f:
+                            f.truncate(filesize)
+                    finalize(part_path, state_path, file_path)
+                    break
+                offset = 0
+
+            # http download, resuming after the bytes already in the .part file
+            headers = {'Range': f'bytes={offset}-'} if offset else {}
+            start_time = time.monotonic()
+            response = transfer.get(download_url, headers=headers)
+            ttfb = time.monotonic() - start_time
+            with response:
+                response.raise_for_status()
+                if offset and not response_starts_at(response, offset):
+                    # the server ignored the Range header: start over
+                    offset = 0
+                if hasher is not None and offset:
+                    # only the bytes of the interrupted transfer are read back
+                    hash_file(part_path, hasher, offset)
+
+                if offset:
+                    f = open(part_path, 'r+b', buffering=transfer.write_buffer)
+                else:
+                    f = open(part_path, 'wb', buffering=transfer.write_buffer)
+                    if filesize is not None:
+                        # the state file goes first, so that a preallocated .part file is never taken for a plain one
+                        write_state(state_path, filesize, [{'start': 0, 'end': filesize, 'received': 0}])
+                        preallocate(f, filesize)
+                    elif os.path.isfile(state_path):
+                        os.remove(state_path)
+
+                received = offset
+                with f:
+                    f.seek(offset)
+                    last_saved = received
+                    try:
+                        for chunk in response.iter_content(chunk_size=transfer.chunk_size):
+                            if filesize is not None and received + len(chunk) > filesize:
+                                f.close()
+                                for path in [part_path, state_path]:
+                                    if os.path.isfile(path):
+                                        os.remove(path)
+                                raise IncompleteDownloadError(f"{filename}: received more than {filesize} bytes")
+                            f.write(chunk)
+                            received += len(chunk)
+                            if hasher is not None:
+                                hasher.update(chunk)
+                            if filesize is not None and received - last_saved >= transfer.write_buffer:
+                                f.flush()
+                                write_state(state_path, filesize, [{'start': 0, 'end': filesize, 'received': received}])
+                                last_saved = received
+                    finally:
+                        # also when the connection drops part way, so that the bytes written are resumed from
+                        # (and reported in the journal) rather than only those up to the last save
+                        if filesize is not None and not f.closed:
+                            f.flush()
+                            write_state(state_path, filesize, [{'start': 0, 'end': filesize, 'received': received}])
+
+            if filesize is not None and received != filesize:
+                raise IncompleteDownloadError(f"{filename}: received {received} of {filesize} bytes")
+            if hasher is not None:
+                check_checksum(filename, hasher, checksum)
+            finalize(part_path, state_path, file_path)
+            seconds = time.monotonic() - start_time
+            report(filename, data_node(download_url), received - offset, seconds)
+            if stats is not None:
+                stats.record_success(download_url, received - offset, seconds, ttfb)
+            break  # Break out of the loop if successful
+        except (HTTPError, ConnectionError, ChunkedEncodingError, Timeout, IncompleteDownloadError) as e:
+            if stats is not None:
+                stats.record_failure(download_url)
+            if attempt < retries - 1:
+                #print(f"Retrying... ({attempt + 1})")
+                metrics.inc('download_retries_total', node=data_node(download_url))
+                time.sleep(2)  # Wait before retrying
+            else:
+                raise
+        except ChecksumMismatchError as e:
+            # a corrupt or wrong replica: do not resume from it or retry the same mirror
+            for path in [part_path, state_path]:
+                if os.path.isfile(path):
+                    os.remove(path)
+            if stats is not None:
+                stats.record_failure(download_url)
+            raise
+
+def response_starts_at(response, offset):
+    '''
+    Check that a response is a partial content response starting at offset
+    '''
+    if response.status_code != 206:
+        return False
+    content_range = response.headers.get('Content-Range', '')
+    return content_range.startswith(f"bytes {offset}-")
+
+def opendap(filename, opendap_url, output_dir, variable=None, time_chunk=120):
+    '''
+    Download a file over OPeNDAP, fetching only the target variable and the
+    coordinates it needs (its dimension coordinates and the variables named
+    in their coordinates/bounds attributes)
+
+    The variable is requested time_chunk timesteps at a time and written to
+    {filename}.opendap.tmp, which is renamed to filename once complete
+
+    Args:
+        filename (str): File name to save in output_dir
+        opendap_url (str): OPeNDAP url
+        output_dir (str): Output directory
+        variable (str): Variable to fetch; taken from filename if not given
+        time_chunk (int): Number of timesteps per request
+
+    Returns:
+        None
+    '''
+    if variable is None:
+        variable = filename.split('_')[0]
+    file_path = os.path.join(output_dir, filename)
+    tmp_file_path = f"{file_path}.opendap.tmp"
+    retries = 3
+    for attempt in range(retries):
+        try:
+            with netCDF4.Dataset(opendap_url) as src, netCDF4.Dataset(tmp_file_path, 'w') as dst:
+                copy_subset(src, dst, variable, time_chunk)
+            os.replace(tmp_file_path, file_path)
+            break
+        except Exception as e:
+            if os.path.isfile(tmp_file_path):
+                os.remove(tmp_file_path)
+            if attempt < retries - 1:
+                time.sleep(2)  # Wait before retrying
+            else:
+                raise
+
+def required_variables(src, variable):
+    '''
+    Return the names of the variables needed to use a variable of a netCDF dataset:
+    the variable itself, its dimension coordinates and their coordinates/bounds
+    '''
+    names = [variable]
+    for name in names:
+        var = src.variables[name]
+        related = list(var.dimensions)
+        for attr in ['coordinates', 'bounds']:
+            if attr in var.ncattrs():
+                related += var.getncattr(attr).split()
+        for related_name in related:
+            if related_name in src.variables and related_name not in names:
+                names.append(related_name)
+    return names
+
+def copy_subset(src, dst, variable, time_chunk=120):
+    '''
+    Copy a variable with its coordinates and the global attributes from one
+    netCDF dataset to another, reading variables with a time dimension in
+    chunks of time_chunk timesteps
+    '''
+    names = required_variables(src, variable)
+    dst.setncatts({attr: src.getncattr(attr) for attr in src.ncattrs()})
+    dims = dict.fromkeys(dim for name in names for dim in src.variables[name].dimensions)
+    for dim in dims:
+        dimension = src.dimensions[dim]
+        dst.createDimension(dim, None if dimension.isunlimited() else len(dimension))
+
+    for name in names:
+        var = src.variables[name]
+        attrs = {attr: var.getncattr(attr) for attr in var.ncattrs()}
+        fill_value = attrs.pop('_FillValue', None)
+        out = dst.createVariable(name, var.datatype, var.dimensions, fill_value=fill_value)
+        out.setncatts(attrs)
+        # keep raw values; scaling and masking are left to the reader
+        var.set_auto_maskandscale(False)
+        out.set_auto_maskandscale(False)
+        if var.ndim and var.dimensions[0] == 'time':
+            for start in range(0, var.shape[0], time_chunk):
+                out[start:start + time_chunk] = var[start:start + time_chunk]
+        elif var.ndim:
+            out[:] = var[:]
+        else:
+            out.assignValue(var.getValue())
+
+def open_remote(opendap_urls, stats=None, retries=3):
+    '''
+    Open a remote dataset lazily from the first of its OPeNDAP mirrors that answers
+
+    Args:
+        opendap_urls (list): OPeNDAP urls of the same file
+        stats (MirrorStats): Statistics used to try the fastest mirror first
+        retries (int): Attempts per mirror
+
+    Returns:
+        xarray.Dataset: Dataset whose values are fetched on access
+    '''
+    urls = [url for url in opendap_urls if url]
+    if stats is not None:
+        urls = stats.rank(urls, None)
+    for opendap_url in urls:
+        for attempt in range(retries):
+            try:
+                return xr.open_dataset(opendap_url)
+            except Exception as e:
+                if attempt < retries - 1:
+                    time.sleep(2)  # Wait before retrying
+    raise IOError(f"No OPeNDAP mirror could be opened: {urls}")
+
+def remote_aggregate(variable, opendap_urls, output_file_path, area_urls=None, memory_budget=512, stats=None):
+    '''
+    Compute the area-weighted annual global mean of a (source_id, experiment_id, variable)
+    over OPeNDAP and write it as a data_aggregated csv file
+
+    Only the target variable is read, in time chunks (see utils.stream_annual_mean),
+    so that the raw fields never reach the disk
+
+    Args:
+        variable (str): Variable name
+        opendap_urls (list): OPeNDAP mirror urls, one list per file of the time series
+        output_file_path (str): Output csv file path
+        area_urls (list): OPeNDAP mirror urls of the matching areacella file, if any
+        memory_budget (float): Peak memory for one chunk in megabytes
+        stats (MirrorStats): Statistics used to try the fastest mirror first
+
+    Returns:
+        None
+    '''
+    datasets = []
+    try:
+        for urls in opendap_urls:
+            datasets.append(open_remote(urls, stats))
+        das = [ds[variable] for ds in datasets]
+
+        area_data = None
+        if area_urls:
+            try:
+                with open_remote(area_urls, stats) as area_ds:
+                    area_data = area_ds['areacella'].values
+            except Exception as e:
+                print(f"===> areacella not available over OPeNDAP: {e}. Using generated area weights.")
+        if area_data is None:
+            area_data = area(das[0]).values
+        weights = area_data / area_data.sum()
+
+        years, annual_values = stream_annual_mean(das, weights, memory_budget)
+    finally:
+        for ds in datasets:
+            ds.close()
+
+    if not len(years):
+        raise ValueError(f"No complete year in {output_file_path}")
+    save_output(output_file_path, variable, years, annual_values)
+
+def data_node(url):
+    '''
+    Return the data node (host name) serving a url
+    '''
+    return urlparse(url).netloc
+
+class MirrorStats:
+    '''
+    Transfer statistics per data node (throughput, time to first byte and
+    failure rate), kept in a json file across runs and used to order the
+    mirrors of a file by expected completion time
+
+    Throughput and time to first byte are exponential moving averages so that
+    the ranking follows changes in the nodes' performance from our site
+    '''
+
+    # weight of the latest transfer in the moving averages
+    smoothing = 0.3
+
+    # size assumed for ranking when the file size is unknown (bytes)
+    default_filesize = 100e6
+
+    def __init__(self, file_path=None):
+        self.file_path = file_path
+        self.nodes = {}
+        self._lock = threading.Lock()
+        if file_path is not None and os.path.isfile(file_path):
+            with open(file_path, 'r') as f:
+                self.nodes = json.load(f)
+
+    def _node(self, url):
+        return self.nodes.setdefault(data_node(url), {'throughput': None, 'ttfb': None, 'successes': 0, 'failures': 0})
+
+    def record_success(self, url, num_bytes, seconds, ttfb):
+        '''
+        Record a completed transfer of num_bytes in seconds from the data node of a url
+        '''
+        with self._lock:
+            node = self._node(url)
+            throughput = num_bytes / max(seconds - ttfb, 1e-3)
+            for key, value in [('throughput', throughput), ('ttfb', ttfb)]:
+                if node[key] is None:
+                    node[key] = value
+                else:
+                    node[key] += self.smoothing * (value - node[key])
+            node['successes'] += 1
+            throughput = node['throughput']
+        metrics.inc('download_bytes_total', num_bytes, node=data_node(url))
+        metrics.inc('download_transfer_seconds_total', seconds, node=data_node(url))
+        metrics.observe('download_ttfb_seconds', ttfb, node=data_node(url))
+        metrics.set('download_throughput_bytes_per_second', throughput, node=data_node(url))
+
+    def record_failure(self, url):
+        '''
+        Record a failed transfer attempt from the data node of a url
+        '''
+        with self._lock:
+            self._node(url)['failures'] += 1
+        metrics.inc('download_failures_total', node=data_node(url))
+
+    def throughput(self, url):
+        '''
+        Measured throughput (bytes/s) of the data node of a url, or None if not measured yet
+        '''
+        with self._lock:
+            node = self.nodes.get(data_node(url))
+            return node['throughput'] if node is not None else None
+
+    def expected_time(self, url, filesize=None):
+        '''
+        Expected time (seconds) to download a file of filesize bytes from the data node of a url,
+        including the expected cost of failed attempts
+
+        Nodes without measurements are assumed to perform like the median measured node
+        so that they are tried ahead of nodes known to be slow
+        '''
+        if filesize is None:
+            filesize = self.default_filesize
+        with self._lock:
+            measured = [node for node in self.nodes.values() if node['throughput'] is not None]
+            if not measured:
+                return 0.0
+            node = self.nodes.get(data_node(url), {'throughput': None, 'ttfb': None, 'successes': 0, 'failures': 0})
+            throughput = node['throughput'] or median([n['throughput'] for n in measured])
+            ttfb = node['ttfb'] if node['ttfb'] is not None else median([n['ttfb'] for n in measured])
+            # failure rate with one prior success, so that a single failure does not rule a node out
+            failure_rate = node['failures'] / (node['successes'] + node['failures'] + 1)
+        return (ttfb + filesize / throughput) / (1 - failure_rate)
+
+    def rank(self, urls, filesize=None):
+        '''
+        Order urls by expected completion time, keeping the given order for ties
+        '''
+        return sorted(urls, key=lambda url: self.expected_time(url, filesize))
+
+    def save(self):
+        '''
+        Write the statistics to file_path (atomically) if one is set
+        '''
+        if self.file_path is None:
+            return
+        with self._lock:
+            tmp_file_path = f"{self.file_path}.tmp"
+            with open(tmp_file_path, 'w') as f:
+                json.dump(self.nodes, f, indent=1, sort_keys=True)
+            os.replace(tmp_file_path, self.file_path)
+
+class SegmentedDownload:
+    '''
+    Download one large file as byte ranges fetched at the same time from
+    several mirrors, or over several connections to one mirror
+
+    Segments are written at their offsets into a preallocated {filename}.part
+    and their progress is kept in {filename}.part.json, so an interrupted
+    download resumes with the missing bytes only. A connection that runs far
+    slower than the fastest mirror of the file hands its remaining range back,
+    which is then picked up from a faster mirror; a connection that stalls
+    completely is cut by the read timeout and handled the same way.
+
+    Segments arrive out of order, so a checksum, if given, is verified by
+    reading the finished file once before the rename
+    '''
+
+    # seconds before a connection's throughput is compared with the other mirrors
+    grace_period = 10
+
+    # a connection slower than this fraction of the fastest mirror gives up its segment
+    slow_ratio = 0.25
+
+    # failed requests after which a mirror is no longer used for this file
+    max_failures = 3
+
+    def __init__(self, filename, download_urls, output_dir, filesize, stats=None,
+                 connections=4, segment_size=64 * 2**20, stall_timeout=60, node_slot=None,
+                 checksum=None, checksum_type=None, transfer=None):
+        self.filename = filename
+        self.transfer = transfer if transfer is not None else default_transfer
+        self.chunk_size = self.transfer.chunk_size
+        self.checksum = checksum
+        self.checksum_type = checksum_type
+        self.file_path = os.path.join(output_dir, filename)
+        self.part_path = f"{self.file_path}.part"
+        self.state_path = f"{self.part_path}.json"
+        self.filesize = filesize
+        self.stats = stats if stats is not None else MirrorStats()
+        self.mirrors = self.stats.rank(download_urls, filesize)
+        self.connections = connections
+        self.segment_size = segment_size
+        self.stall_timeout = stall_timeout
+        self.node_slot = node_slot
+        self.segments = []
+        self._pending = []
+        self._active = {url: 0 for url in self.mirrors}
+        self._failures = {url: 0 for url in self.mirrors}
+        self._rates = {}
+        self._used = set()
+        self._slow = set()
+        self._lock = threading.Lock()
+
+    def run(self):
+        '''
+        Download the file and rename it into place once all segments are complete
+
+        Raises:
+            IncompleteDownloadError: If some segments could not be downloaded from any mirror
+            ChecksumMismatchError: If the finished file does not match the checksum; the .part file is removed
+        '''
+        start_time = time.monotonic()
+        self._load_state()
+        received_before = sum(segment['received'] for segment in self.segments)
+        self._pending = [idx for idx, segment in enumerate(self.segments) if not self._done(segment)]
+        num_threads = min(self.connections, len(self._pending))
+        threads = [threading.Thread(target=self._worker) for _ in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self._save_state()
+        missing = sum(segment['end'] - segment['start'] - segment['received'] for segment in self.segments)
+        if missing:
+            raise IncompleteDownloadError(f"{self.filename}: {missing} of {self.filesize} bytes missing")
+        hasher = new_hasher(self.checksum_type) if self.checksum else None
+        if hasher is not None:
+            try:
+                check_checksum(self.filename, hash_file(self.part_path, hasher), self.checksum)
+            except ChecksumMismatchError:
+                os.remove(self.part_path)
+                os.remove(self.state_path)
+                raise
+        finalize(self.part_path, self.state_path, self.file_path)
+        nodes = sorted({data_node(url) for url in self._used})
+        report(self.filename, ', '.join(nodes), self.filesize - received_before, time.monotonic() - start_time)
+
+    def _load_state(self):
+        state = read_state(self.state_path)
+        if state is not None and state['filesize'] == self.filesize and os.path.isfile(self.part_path):
+            received_ranges = [(segment['start'], segment['start'] + segment['received'])
+                               for segment in state['segments'] if segment['received']]
+        elif state is None and os.path.isfile(self.part_path):
+            # bytes of a plain download interrupted earlier
+            received_ranges = [(0, min(os.path.getsize(self.part_path), self.filesize))]
+        else:
+            received_ranges = []
+
+        # finished ranges are kept as they are, the missing ones are split into
+        # several segments per connection, so that a slow mirror holds up only a small part
+        missing = self.filesize - sum(end - start for start, end in received_ranges)
+        segment_size = min(self.segment_size, max(self.chunk_size, missing // (4 * self.connections)))
+        self.segments = [{'start': start, 'end': end, 'received': end - start} for start, end in received_ranges if end > start]
+        position = 0
+        for start, end in sorted(received_ranges) + [(self.filesize, self.filesize)]:
+            for gap_start in range(position, start, segment_size):
+                gap_end = min(gap_start + segment_size, start)
+                self.segments.append({'start': gap_start, 'end': gap_end, 'received': 0})
+            position = max(position, end)
+        self.segments.sort(key=lambda segment: segment['start'])
+
+        # the state file goes first, so that a preallocated .part file is never taken for a plain one
+        self._save_state()
+        with open(self.part_path, 'ab') as f:
+            if os.path.getsize(self.part_path) > self.filesize:
+                f.truncate(self.filesize)
+            preallocate(f, self.filesize)
+
+    def _save_state(self):
+        with self._lock:
+            write_state(self.state_path, self.filesize, self.segments)
+
+    @staticmethod
+    def _done(segment):
+        return segment['start'] + segment['received'] >= segment['end']
+
+    def _worker(self):
+        # unbuffered, so that the saved progress never runs ahead of the bytes in the file
+        with open(self.part_path, 'r+b', buffering=0) as f:
+            while True:
+                with self._lock:
+                    if not self._pending:
+                        return
+                    idx = self._pending.pop(0)
+                url = self._acquire_mirror()
+                if url is None:
+                    with self._lock:
+                        self._pending.insert(0, idx)
+                    return
+                try:
+                    self._fetch_segment(f, idx, url)
+                except Exception as e:
+                    self.stats.record_failure(url)
+                    with self._lock:
+                        self._failures[url] += 1
+                finally:
+                    self._release_mirror(url)
+                if not self._done(self.segments[idx]):
+                    with self._lock:
+                        self._pending.insert(0, idx)
+
+    def _usable_mirrors(self):
+        usable = [url for url in self.mirrors if self._failures[url] < self.max_failures]
+        fast = [url for url in usable if url not in self._slow]
+        return fast or usable
+
+    def _acquire_mirror(self):
+        '''
+        Pick the usable mirror with the fewest connections of this download (fastest first on ties)
+        and take one of its data node's transfer slots, waiting if all of them are busy
+        '''
+        while True:
+            with self._lock:
+                usable = self._usable_mirrors()
+                if not usable:
+                    return None
+                candidates = sorted(usable, key=lambda url: (self._active[url], -self._rates.get(url, float('inf'))))
+            for url in candidates:
+                if self.node_slot is None or self.node_slot(url).acquire(blocking=False):
+                    with self._lock:
+                        self._active[url] += 1
+                    return url
+            time.sleep(1)
+
+    def _release_mirror(self, url):
+        with self._lock:
+            self._active[url] -= 1
+        if self.node_slot is not None:
+            self.node_slot(url).release()
+
+    def _fetch_segment(self, f, idx, url):
+        segment = self.segments[idx]
+        offset = segment['start'] + segment['received']
+        headers = {'Range': f"bytes={offset}-{segment['end'] - 1}"}
+        start_time = time.monotonic()
+        response = self.transfer.get(url, headers=headers, read_timeout=self.stall_timeout)
+        ttfb = time.monotonic() - start_time
+        with response:
+            response.raise_for_status()
+            with self._lock:
+                self._used.add(url)
+            if not response_starts_at(response, offset):
+                # no range support: this mirror cannot serve segments
+                with self._lock:
+                    self._failures[url] = self.max_failures
+                return
+
+            received = 0
+            last_saved = 0
+            f.seek(offset)
+            for chunk in response.iter_content(chunk_size=self.chunk_size):
+                chunk = chunk[:segment['end'] - offset - received]
+                f.write(chunk)
+                received += len(chunk)
+                with self._lock:
+                    segment['received'] += len(chunk)
+                if self._done(segment):
+                    break
+
+                elapsed = time.monotonic() - start_time
+                with self._lock:
+                    self._rates[url] = received / elapsed
+                    fastest = max(list(self._rates.values()) + [self.stats.throughput(other) or 0 for other in self._usable_mirrors() if other != url])
+                if elapsed > self.grace_period and self._rates[url] < self.slow_ratio * fastest:
+                    # hand the rest of the segment to a faster mirror
+                    with self._lock:
+                        if len(self._usable_mirrors()) > 1:
+                            self._slow.add(url)
+                    if url in self._slow:
+                        break
+                if received - last_saved >= 16 * self.chunk_size:
+                    self._save_state()
+                    last_saved = received
+
+        self._save_state()
+        if received == 0 or (not self._done(segment) and url not in self._slow):
+            # empty or truncated body: a failure of the mirror (see _worker), or it would be asked again forever
+            raise IncompleteDownloadError(f"{self.filename}: range response of {url} ended after {received} bytes")
+        self.stats.record_success(url, received, time.monotonic() - start_time, ttfb)
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2
+
+class DownloadEngine:
+    '''
+    Download files concurrently with a global limit on simultaneous files
+    and a limit on simultaneous transfers from any one data node
+
+    Each file tries its download urls in order of expected completion time
+    (see MirrorStats) and falls back to its opendap urls if all of them fail
+
+    Files of at least segment_threshold bytes are first tried as a segmented
+    download over all their mirrors at once (see SegmentedDownload)
+
+    With opendap_fallback=False, files that fail over HTTP are only reported,
+    e.g., to be aggregated remotely instead (see remote_aggregate)
+
+    With a journal (see download_journal), the state of every file and each
+    attempt with its mirror and bytes received are recorded as they happen
+
+    With a gate, every file waits for gate.acquire(filename, filesize) before it starts
+    and calls gate.release(filename, filesize, done) when it ends, e.g., to cap the raw files on
+    disk (see aggregation_scheduler)
+    '''
+
+    def __init__(self, output_dir, max_workers=8, per_node=2, stats=None,
+                 segment_threshold=1e9, segment_connections=4, transfer=None, opendap_fallback=True, journal=None, gate=None):
+        self.output_dir = output_dir
+        self.journal = journal
+        self.gate = gate
+        self.opendap_fallback = opendap_fallback
+        self.transfer = transfer if transfer is not None else default_transfer
+        self.max_workers = max_workers
+        self.per_node = per_node
+        self.stats = stats if stats is not None else MirrorStats()
+        self.segment_threshold = segment_threshold
+        self.segment_connections = segment_connections
+        self._node_slots = {}
+        self._lock = threading.Lock()
+
+    def node_slot(self, url):
+        '''
+        Return the semaphore limiting concurrent transfers from the data node of a url
+        '''
+        node = data_node(url)
+        with self._lock:
+            if node not in self._node_slots:
+                self._node_slots[node] = threading.BoundedSemaphore(self.per_node)
+            return self._node_slots[node]
+
+    def received_bytes(self, filename):
+        '''
+        Return the number of bytes of a file received so far: the size of the complete file, the bytes
+        received in the segments of a preallocated .part file (its size is the full file size, see
+        write_state), or the size of a .part file written sequentially
+        '''
+        file_path = os.path.join(self.output_dir, filename)
+        if os.path.isfile(file_path):
+            return os.path.getsize(file_path)
+        part_path = f"{file_path}.part"
+        if not os.path.isfile(part_path):
+            return 0
+        state = read_state(f"{part_path}.json")
+        if state is None:
+            return os.path.getsize(part_path)
+        return sum(segment['received'] for segment in state['segments'])
+
+    def record_attempt(self, filename, method, mirror, started, error=None):
+        metrics.inc('download_attempts_total', method=method, outcome='failed' if error is not None else 'done')
+        if self.journal is not None:
+            self.journal.record_attempt(filename, method, mirror, 'failed' if error is not None else 'done',
+                                        self.received_bytes(filename), started, '' if error is None else str(error))
+
+    def fetch(self, filename, download_urls, opendap_urls, filesize=None, checksum=None, checksum_type=None):
+        '''
+        Download a single file, trying the mirrors fastest first
+
+        Args:
+            filename (str): File name to save in output_dir
+            download_urls (list): HTTP download urls
+            opendap_urls (list): OPeNDAP urls
+            filesize (int): Expected file size in bytes, if known
+            checksum (str): Expected checksum, if known; a mismatching replica is discarded and the next mirror tried
+            checksum_type (str): Algorithm of the checksum (e.g., SHA256)
+
+        Returns:
+            bool: True if the file was downloaded over HTTP
+        '''
+        if filesize is not None and filesize >= self.segment_threshold:
+            started = time.time()
+            try:
+                SegmentedDownload(filename, download_urls, self.output_dir, filesize, self.stats,
+                                  connections=self.segment_connections, node_slot=self.node_slot,
+                                  checksum=checksum, checksum_type=checksum_type, transfer=self.transfer).run()
+                self.record_attempt(filename, 'segmented', '|'.join(download_urls), started)
+                return True
+            except Exception as e:
+                print(f"===> Segmented download failed for {filename}: {e}")
+                self.record_attempt(filename, 'segmented', '|'.join(download_urls), started, e)
+
+        for download_url in self.stats.rank(download_urls, filesize):
+            started = time.time()
+            try:
+                with self.node_slot(download_url):
+                    download(filename, download_url, self.output_dir, filesize, self.stats, checksum, checksum_type, self.transfer)
+                self.record_attempt(filename, 'http', download_url, started)
+                return True
+            except ChecksumMismatchError as e:
+                print(f"===> {e}")
+                self.record_attempt(filename, 'http', download_url, started, e)
+            except Exception as e:
+                #print(f"Error downloading {filename} from {download_url}: {e}")
+                self.record_attempt(filename, 'http', download_url, started, e)
+
+        print(f"===> Failed to download {filename}")
+        if not self.opendap_fallback:
+            return False
+        print(f"===> Trying opendap download")
+        for opendap_url in self.stats.rank(opendap_urls, filesize):
+            if not opendap_url:
+                continue
+            started = time.time()
+            try:
+                with self.node_slot(opendap_url):
+                    opendap(filename, opendap_url, self.output_dir)
+                print('===> Done!')
+                self.record_attempt(filename, 'opendap', opendap_url, started)
+                return False
+            except Exception as e:
+                self.record_attempt(filename, 'opendap', opendap_url, started, e)
+        print(f'===> Options exhausted!: {filename}')
+        return False
+
+    def run(self, items, on_finish=None):
+        '''
+        Download all items concurrently
+
+        Args:
+            items (list): List of (filename, download_urls, opendap_urls, filesize, checksum, checksum_type) tuples
+            on_finish (callable): Called with (filename, done) as each file ends, after its journal update;
+                                  done is True if the file is in output_dir (over HTTP or OPeNDAP)
+
+        Returns:
+            list: File names that could not be downloaded over HTTP
+        '''
+        failed_filenames = []
+        num_items = len(items)
+        # queue depth and ETA in bytes (see metrics.Progress)
+        progress = Progress('download', {item[0]: item[3] for item in items})
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            future_to_filename = {}
+            for idx, item in enumerate(items):
+                future = executor.submit(self._fetch_item, f'{idx+1:>3d}/{num_items}', *item)
+                future_to_filename[future] = item[0]
+            for future in as_completed(future_to_filename):
+                filename = future_to_filename[future]
+                try:
+                    success = future.result()
+                except Exception as e:
+                    print(f"===> Error downloading {filename}: {e}")
+                    success = False
+                if not success:
+                    failed_filenames.append(filename)
+                metrics.inc('download_files_total', outcome='done' if success else 'failed')
+                eta = progress.done(filename)
+                print(f"--- {len(progress.remaining)} of {num_items} files left "
+                      f"({progress.remaining_size * 1e-6:.1f} MB), ETA {format_duration(eta)}")
+                # a file that failed over HTTP may still have been fetched over OPeNDAP
+                done = success or os.path.isfile(os.path.join(self.output_dir, filename))
+                if self.journal is not None:
+                    self.journal.finish(filename, 'done' if done else 'failed')
+                if on_finish is not None:
+                    on_finish(filename, done)
+                self.stats.save()
+        return failed_filenames
+
+    def _fetch_item(self, progress, filename, download_urls, opendap_urls, filesize=None, *args):
+        if self.gate is not None:
+            self.gate.acquire(filename, filesize)
+        print(f'{progress}: Downloading {filename}')
+        done = False
+        try:
+            if self.journal is not None:
+                self.journal.start(filename)
+            success = self.fetch(filename, download_urls, opendap_urls, filesize, *args)
+            done = success or os.path.isfile(os.path.join(self.output_dir, filename))
+            return success
+        finally:
+            if self.gate is not None:
+                self.gate.release(filename, filesize, done)
@@ -0,0 +1,221 @@
+import os
+import csv
+import json
+import hashlib
+import sqlite3
+
+import pandas as pd
+
+default_path = os.path.join('database', 'metadata.db')
+
+# columns of each table; list valued columns (mirrors of a file) are kept as json arrays
+tables = {
+    # file metadata per dataset replica (stage 1 and stage 5)
+    # search: the (experiment_id, variable) search that found it, as {experiment_id}.{variable}
+    # origin: '' for stage 1, the source_id of the retry search for stage 5
+    'replicas': ['search', 'origin', 'master_id', 'data_node', 'filename', 'size', 'download_url', 'opendap_url',
+                 'checksum', 'checksum_type', 'activity_id', 'source_id', 'experiment_id', 'variant_label',
+                 'variable', 'grid_label'],
+    # one row per file with all its mirrors (stage 2)
+    'files': ['source_id', 'activity_id', 'experiment_id', 'variant_label', 'variable', 'grid_label',
+              'filename', 'filesize', 'download_url', 'opendap_url', 'checksum', 'checksum_type'],
+    # files selected for download (stage 3)
+    'queue': ['source_id', 'activity_id', 'experiment_id', 'variant_label', 'variable', 'grid_label',
+              'filenum', 'filename', 'filesize', 'download_url', 'opendap_url', 'checksum', 'checksum_type'],
+}
+list_columns = {'data_node', 'download_url', 'opendap_url'}
+integer_columns = {'size', 'filesize'}
+
+# every table is indexed on the dataset facets
+facets = ['source_id', 'experiment_id', 'variable', 'variant_label', 'grid_label']
+
+class MetadataStore:
+    '''
+    Local SQLite store of the file metadata passed between stages 1 to 5
+
+    Rows are dicts keyed by column name, with the mirrors of a file as lists,
+    so that no stage needs to split or join csv lines itself
+    '''
+
+    def __init__(self, path=default_path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.row_factory = sqlite3.Row
+        with self.conn:
+            for table, columns in tables.items():
+                definitions = ', '.join(f"{column} {'INTEGER' if column in integer_columns else 'TEXT'}" for column in columns)
+                self.conn.execute(f"CREATE TABLE IF NOT EXISTS {table} ({definitions})")
+                self.conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_facets ON {table} ({', '.join(facets)})")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS replicas_search ON replicas (search, origin)")
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def replace(self, table, rows, **where):
+        '''
+        Replace the rows of a table matching the filters with new rows in one transaction
+
+        Args:
+            table (str): Table name
+            rows (iterable): Dicts keyed by column name; missing columns are stored as ''
+            where: Equality filters on columns (a list or tuple matches any of its values);
+                   without filters the whole table is replaced
+
+        Returns:
+            None
+        '''
+        columns = tables[table]
+        clause, params = self._where(where)
+        placeholders = ', '.join('?' for _ in columns)
+        with self.conn:
+            self.conn.execute(f"DELETE FROM {table}{clause}", params)
+            self.conn.executemany(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})",
+                                  ([self._encode(column, row.get(column, '')) for column in columns] for row in rows))
+
+    def select(self, table, order_by='rowid', **where):
+        '''
+        Return the rows of a table matching the filters
+
+        Args:
+            table (str): Table name
+            order_by (str): Column(s) to sort by; insertion order by default
+            where: Equality filters on columns (a list or tuple matches any of its values)
+
+        Returns:
+            list: Dicts keyed by column name
+        '''
+        clause, params = self._where(where)
+        cursor = self.conn.execute(f"SELECT * FROM {table}{clause} ORDER BY {order_by}", params)
+        return [{column: self._decode(column, row[column]) for column in row.keys()} for row in cursor]
+
+    def frame(self, table, order_by='rowid', **where):
+        '''
+        Return the rows of a table matching the filters as a data frame (see select)
+        '''
+        clause, params = self._where(where)
+        df = pd.read_sql_query(f"SELECT * FROM {table}{clause} ORDER BY {order_by}", self.conn, params=params)
+        for column in list_columns.intersection(df.columns):
+            # decode the whole column in one call
+            df[column] = pd.Series(json.loads(f"[{','.join(df[column])}]"), index=df.index, dtype=object)
+        return df
+
+    def count(self, table, **where):
+        '''
+        Return the number of rows of a table matching the filters
+        '''
+        clause, params = self._where(where)
+        return self.conn.execute(f"SELECT COUNT(*) FROM {table}{clause}", params).fetchone()[0]
+
+    def distinct(self, table, column, **where):
+        '''
+        Return the sorted distinct values of a column among the rows matching the filters
+        '''
+        clause, params = self._where(where)
+        cursor = self.conn.execute(f"SELECT DISTINCT {column} FROM {table}{clause} ORDER BY {column}", params)
+        return [row[0] for row in cursor]
+
+    def digest(self, table, order_by='rowid', **where):
+        '''
+        Return a sha256 hex digest of the contents of the rows matching the filters
+        (e.g., to tell whether the input of a stage has changed since its last run)
+        '''
+        clause, params = self._where(where)
+        cursor = self.conn.execute(f"SELECT {', '.join(tables[table])} FROM {table}{clause} ORDER BY {order_by}", params)
+        h = hashlib.sha256()
+        for row in cursor:
+            h.update(json.dumps(tuple(row)).encode())
+        return h.hexdigest()
+
+    @staticmethod
+    def _where(where):
+        conditions = []
+        params = []
+        for column, value in where.items():
+            if isinstance(value, (list, tuple)):
+                conditions.append(f"{column} IN ({', '.join('?' for _ in value)})")
+                params += list(value)
+            else:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        clause = f" WHERE {' AND '.join(conditions)}" if conditions else ''
+        return clause, params
+
+    @staticmethod
+    def _encode(column, value):
+        if column in list_columns:
+            if isinstance(value, str):
+                value = value.split('|')
+            return json.dumps([itm for itm in value if itm])
+        if column in integer_columns:
+            return int(value) if value != '' else None
+        return value
+
+    @staticmethod
+    def _decode(column, value):
+        if column in list_columns:
+            return json.loads(value)
+        return value
+
+def dataset_facets(master_id):
+    '''
+    Return the facets of a dataset from its id (e.g., CMIP6.CMIP.NCAR.CESM2.piControl.r1i1p1f1.Amon.tas.gn.v20190320)
+    '''
+    project, activity_id, institution_id, source_id, experiment_id, variant_label, frequency, variable, grid_label, *_ = master_id.split('.')
+    return {'activity_id': activity_id, 'source_id': source_id, 'experiment_id': experiment_id,
+            'variant_label': variant_label, 'variable': variable, 'grid_label': grid_label}
+
+def write_csv(file_path, header, columns, rows):
+    '''
+    Export rows as a csv file, joining list valued columns with '|'
+
+    Args:
+        file_path (str): Output csv file path
+        header (list): Column names written in the header line
+        columns (list): Keys of the rows written in that order
+        rows (iterable): Dicts keyed by column name
+
+    Returns:
+        None
+    '''
+    with open(file_path, 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        f.write(','.join(header) + '\n')
+        for row in rows:
+            writer.writerow(['|'.join(row[column]) if column in list_columns else row[column] for column in columns])
+
+def read_csv(file_path, columns):
+    '''
+    Read a csv file exported by an earlier version of the pipeline into rows
+
+    Fields are assigned to columns by position; rows of older formats with
+    fewer fields get '' for the missing trailing columns
+
+    Args:
+        file_path (str): Input csv file path
+        columns (list): Column names in the order of the fields
+
+    Returns:
+        list: Dicts keyed by column name, with list valued columns split on '|'
+    '''
+    rows = []
+    with open(file_path, 'r', newline='') as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        for fields in reader:
+            if not fields:
+                continue
+            fields = (fields + [''] * len(columns))[:len(columns)]
+            row = dict(zip(columns, fields))
+            for column in list_columns.intersection(columns):
+                row[column] = [itm for itm in row[column].split('|') if itm]
+            rows.append(row)
+    return rows
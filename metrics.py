@@ -0,0 +1,330 @@
+import os
+import json
+import time
+import bisect
+import threading
+from datetime import datetime, timezone
+from contextlib import contextmanager
+from urllib.parse import urlparse
+import __main__
+
+# metrics of every stage are written to metrics/{stage}.json at the end of the run and, for
+# long runs, to metrics/{stage}.prom while they run (Prometheus text format, e.g. for the
+# textfile collector of node_exporter)
+metrics_dir = 'metrics'
+
+# prefix of the metric names in the Prometheus text files
+prefix = 'cmip_'
+
+# upper bounds (seconds) of the histogram buckets, suited to request latencies and processing times
+default_buckets = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600]
+
+def stage_name():
+    return os.path.splitext(os.path.basename(getattr(__main__, '__file__', 'python')))[0]
+
+class Histogram:
+    '''
+    Count, sum, range and bucket counts of observed values
+    '''
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        '''
+        Estimate a quantile by linear interpolation within its bucket (as Prometheus' histogram_quantile)
+        '''
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for idx, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                lower = self.buckets[idx - 1] if idx > 0 else self.min
+                upper = self.buckets[idx] if idx < len(self.buckets) else self.max
+                lower, upper = max(lower, self.min), min(upper, self.max)
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.max
+
+    def summary(self):
+        return {'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max,
+                'mean': self.sum / self.count if self.count else None,
+                'p50': self.quantile(0.5), 'p90': self.quantile(0.9), 'p99': self.quantile(0.99)}
+
+class Metrics:
+    '''
+    Counters, gauges and histograms of a stage, each with optional labels (e.g., node=...),
+    plus per-item records (e.g., one per aggregated file) that only go to the json summary
+
+    All methods are thread safe; one registry per process (see metrics below) is shared
+    by the stage and the modules it uses
+    '''
+
+    def __init__(self, stage=None):
+        self.stage = stage or stage_name()
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.records = {}
+        self._lock = threading.Lock()
+        self._exporter = None
+        self._stop = threading.Event()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        '''
+        Add value to a counter
+        '''
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        '''
+        Set a gauge
+        '''
+        with self._lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, buckets=default_buckets, **labels):
+        '''
+        Add a value to a histogram
+        '''
+        key = self._key(name, labels)
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets)
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        '''
+        Observe the seconds spent in a with block in a histogram
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def record(self, name, **fields):
+        '''
+        Append a record (e.g., the timing of one file) to the json summary
+        '''
+        with self._lock:
+            self.records.setdefault(name, []).append(fields)
+
+    def summary(self):
+        '''
+        Return all metrics as a json-serializable dict
+        '''
+        def series(items, value):
+            grouped = {}
+            for (name, labels), item in sorted(items, key=lambda itm: itm[0]):
+                grouped.setdefault(name, []).append(dict(labels=dict(labels), **value(item)))
+            return grouped
+
+        with self._lock:
+            finished = time.time()
+            return {
+                'stage': self.stage,
+                'started': datetime.fromtimestamp(self.started, timezone.utc).isoformat(),
+                'finished': datetime.fromtimestamp(finished, timezone.utc).isoformat(),
+                'seconds': finished - self.started,
+                'counters': series(self.counters.items(), lambda value: {'value': value}),
+                'gauges': series(self.gauges.items(), lambda value: {'value': value}),
+                'histograms': series(self.histograms.items(), lambda histogram: histogram.summary()),
+                'records': {name: list(records) for name, records in self.records.items()},
+            }
+
+    def prometheus(self):
+        '''
+        Return the counters, gauges and histograms in the Prometheus text format
+        '''
+        def labels_text(labels, extra=()):
+            labels = (('stage', self.stage),) + labels + tuple(extra)
+            escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, value in labels)
+            return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+        lines = []
+        with self._lock:
+            for kind, items in [('counter', self.counters), ('gauge', self.gauges)]:
+                names = sorted({name for name, _ in items})
+                for name in names:
+                    metric = f"{prefix}{name}"
+                    lines.append(f"# TYPE {metric} {kind}")
+                    for (item_name, labels), value in sorted(items.items()):
+                        if item_name == name:
+                            lines.append(f"{metric}{labels_text(labels)} {'NaN' if value is None else value}")
+            lines.append(f"# TYPE {prefix}stage_seconds gauge")
+            lines.append(f"{prefix}stage_seconds{labels_text(())} {time.time() - self.started}")
+            for name in sorted({name for name, _ in self.histograms}):
+                metric = f"{prefix}{name}"
+                lines.append(f"# TYPE {metric} histogram")
+                for (item_name, labels), histogram in sorted(self.histograms.items(), key=lambda itm: itm[0]):
+                    if item_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ['+Inf'], histogram.counts):
+                        cumulative += count
+                        lines.append(f"{metric}_bucket{labels_text(labels, [('le', bound)])} {cumulative}")
+                    lines.append(f"{metric}_sum{labels_text(labels)} {histogram.sum}")
+                    lines.append(f"{metric}_count{labels_text(labels)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, file_path=None):
+        '''
+        Write the Prometheus text file (atomically), by default to metrics/{stage}.prom
+        '''
+        file_path = file_path or os.path.join(metrics_dir, f"{self.stage}.prom")
+        write_atomic(file_path, self.prometheus())
+
+    def write_json(self, file_path=None):
+        '''
+        Write the json summary (atomically), by default to metrics/{stage}.json
+        '''
+        file_path = file_path or os.path.join(metrics_dir, f"{self.stage}.json")
+        write_atomic(file_path, json.dumps(self.summary(), indent=1))
+
+    def export(self):
+        '''
+        Write the json summary and the Prometheus text file of the run
+        '''
+        self.write_json()
+        self.write_prometheus()
+
+    def start_exporter(self, interval=10):
+        '''
+        Rewrite the Prometheus text file every interval seconds in a background thread until stop_exporter
+        '''
+        if self._exporter is not None:
+            return
+        self._stop.clear()
+
+        def run():
+            while not self._stop.wait(interval):
+                self.write_prometheus()
+
+        self._exporter = threading.Thread(target=run, daemon=True)
+        self._exporter.start()
+
+    def stop_exporter(self):
+        if self._exporter is None:
+            return
+        self._stop.set()
+        self._exporter.join()
+        self._exporter = None
+        self.write_prometheus()
+
+def write_atomic(file_path, text):
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+    tmp_file_path = f"{file_path}.tmp"
+    with open(tmp_file_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_file_path, file_path)
+
+# registry of the running stage
+metrics = Metrics()
+
+def instrument_session(session, name='http_request_seconds', registry=None):
+    '''
+    Observe the latency (time to the response headers) of every request sent through a requests
+    session in a histogram per host and status code
+
+    Args:
+        session (requests.Session): Session to instrument
+        name (str): Histogram name
+        registry (Metrics): Registry to record in, metrics if not given
+
+    Returns:
+        requests.Session: The session
+    '''
+    registry = registry if registry is not None else metrics
+
+    def hook(response, *args, **kwargs):
+        registry.observe(name, response.elapsed.total_seconds(), node=urlparse(response.url).netloc,
+                         status=response.status_code)
+
+    session.hooks['response'].append(hook)
+    return session
+
+class Progress:
+    '''
+    Queue depth and estimated time to completion of a batch of items with known sizes
+    (e.g., bytes to download), kept as gauges {name}_queue_items, {name}_queue_size
+    and {name}_eta_seconds
+
+    The ETA assumes the rest of the queue is worked through at the rate seen so far
+    '''
+
+    def __init__(self, name, sizes, registry=None):
+        '''
+        Args:
+            name (str): Prefix of the gauge names
+            sizes (dict): Size of each item (None counts as 0)
+            registry (Metrics): Registry to record in, metrics if not given
+        '''
+        self.name = name
+        self.sizes = {item: size or 0 for item, size in sizes.items()}
+        self.remaining = set(self.sizes)
+        self.remaining_size = sum(self.sizes.values())
+        self.registry = registry if registry is not None else metrics
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self._update(None)
+
+    def done(self, item):
+        '''
+        Take an item off the queue
+
+        Returns:
+            float: Estimated seconds until the queue is empty, or None before there is a rate
+        '''
+        with self._lock:
+            if item in self.remaining:
+                self.remaining.remove(item)
+                self.remaining_size -= self.sizes[item]
+            completed_size = sum(self.sizes.values()) - self.remaining_size
+            elapsed = time.monotonic() - self.started
+            if not self.remaining:
+                eta = 0.0
+            elif completed_size > 0:
+                eta = self.remaining_size * elapsed / completed_size
+            elif len(self.remaining) < len(self.sizes):
+                # items without sizes: go by the number of items
+                eta = len(self.remaining) * elapsed / (len(self.sizes) - len(self.remaining))
+            else:
+                eta = None
+            self._update(eta)
+            return eta
+
+    def _update(self, eta):
+        self.registry.set(f"{self.name}_queue_items", len(self.remaining))
+        self.registry.set(f"{self.name}_queue_size", self.remaining_size)
+        self.registry.set(f"{self.name}_eta_seconds", eta)
+
+def format_duration(seconds):
+    '''
+    Format a duration such as an ETA as h:mm:ss
+    '''
+    if seconds is None:
+        return '?'
+    seconds = int(round(seconds))
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
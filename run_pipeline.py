@@ -0,0 +1,322 @@
+import os
+import sys
+import json
+import hashlib
+import time
+import argparse
+import subprocess
+
+from config import experiment_ids, variables, search_domains
+from metadata_store import MetadataStore
+from download_journal import DownloadJournal, default_path as journal_path
+
+state_path = os.path.join('database', 'pipeline_state.json')
+download_dir = 'downloaded'
+aggregated_dir = 'data_aggregated'
+
+stages = ['search', 'process', 'queue', 'download', 'retry', 'aggregate']
+
+def content_hash(*parts):
+    '''
+    Return a sha256 hex digest of json serializable parts
+    '''
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(json.dumps(part, sort_keys=True).encode())
+    return h.hexdigest()
+
+def file_hash(file_path):
+    '''
+    Return a sha256 hex digest of the contents of a file, or None if it does not exist
+    '''
+    if file_path is None or not os.path.isfile(file_path):
+        return None
+    h = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def file_stamp(filename, evicted=None):
+    '''
+    Return the size of a downloaded file, or None if it is missing
+
+    Downloaded files are identified by the checksum and size in their queue row
+    (which stage 4 verifies), so they are not hashed again here; files removed
+    after their aggregation (stage 4 --evict) count with their queued size
+    '''
+    file_path = os.path.join(download_dir, filename)
+    if os.path.isfile(file_path):
+        return os.path.getsize(file_path)
+    return (evicted or {}).get(filename)
+
+def evicted_files():
+    '''
+    Return the queued size of each file evicted after its aggregation, from the download journal
+    '''
+    if not os.path.isfile(journal_path):
+        return {}
+    with DownloadJournal(journal_path) as journal:
+        return {entry['filename']: entry['filesize'] for entry in journal.select(['evicted'])}
+
+class PipelineState:
+    '''
+    Hashes of the inputs and outputs of every partition of every stage at its
+    last run, kept in a json file across runs
+
+    A partition is up to date if its inputs hash to the value recorded at its last
+    run and its outputs still hash to the value recorded after that run. Outputs of None
+    (some expected output missing, e.g., a failed download) are never recorded, so such
+    a partition stays out of date until all its outputs exist
+    '''
+
+    def __init__(self, file_path=state_path):
+        self.file_path = file_path
+        self.stages = {}
+        if os.path.isfile(file_path):
+            with open(file_path, 'r') as f:
+                self.stages = json.load(f)
+
+    def up_to_date(self, stage, partition, inputs, outputs):
+        return outputs is not None and self.stages.get(stage, {}).get(partition) == {'inputs': inputs, 'outputs': outputs}
+
+    def record(self, stage, partition, inputs, outputs):
+        if outputs is None:
+            self.stages.get(stage, {}).pop(partition, None)
+            return
+        self.stages.setdefault(stage, {})[partition] = {'inputs': inputs, 'outputs': outputs}
+
+    def prune(self, stage, partitions):
+        '''
+        Forget the partitions of a stage that no longer exist
+        '''
+        entries = self.stages.get(stage, {})
+        for partition in set(entries) - set(partitions):
+            del entries[partition]
+
+    def save(self):
+        '''
+        Write the state to file_path (atomically)
+        '''
+        tmp_file_path = f"{self.file_path}.tmp"
+        with open(tmp_file_path, 'w') as f:
+            json.dump(self.stages, f, indent=1, sort_keys=True)
+        os.replace(tmp_file_path, self.file_path)
+
+def run_stage(state, stage, partitions, outputs, commands, force=False, dry_run=False, before=None):
+    '''
+    Run a stage for its partitions that are not up to date and record their hashes
+
+    Args:
+        state (PipelineState): Hashes recorded at previous runs
+        stage (str): Stage name
+        partitions (dict): Input hash of each partition
+        outputs (callable): Returns the output hash of a partition
+        commands (callable): Returns the command lines that run a list of partitions
+        force (bool): Run all partitions
+        dry_run (bool): Only report the partitions to run
+        before (callable): Called with the partitions to run before running them
+
+    Returns:
+        list: Partitions that were run (or would be run with dry_run)
+    '''
+    stale = [partition for partition, inputs in partitions.items()
+             if force or not state.up_to_date(stage, partition, inputs, outputs(partition))]
+    print(f"===> {stage}: {len(stale)} of {len(partitions)} partitions to run")
+    for partition in stale[:10]:
+        print(f" - {partition}")
+    if len(stale) > 10:
+        print(f" - ... and {len(stale) - 10} more")
+    if dry_run or not stale:
+        return stale
+
+    if before is not None:
+        before(stale)
+    for command in commands(stale):
+        subprocess.run([sys.executable] + command, check=True)
+    for partition in stale:
+        state.record(stage, partition, partitions[partition], outputs(partition))
+    state.prune(stage, partitions)
+    state.save()
+    return stale
+
+def search_commands(searches):
+    '''
+    Group the (experiment_id, variable) searches to run into stage 1 calls,
+    one per set of variables, so that only those combinations are searched
+    '''
+    experiment_variables = {}
+    for search in searches:
+        experiment_id, variable = search.split('.', 1)
+        experiment_variables.setdefault(experiment_id, []).append(variable)
+    groups = {}
+    for experiment_id, search_variables in experiment_variables.items():
+        groups.setdefault(tuple(search_variables), []).append(experiment_id)
+    return [['1_retrieve_database_from_esgf.py', '--experiments'] + group_experiments + ['--variables'] + list(group_variables)
+            for group_variables, group_experiments in groups.items()]
+
+def queue_partitions(store):
+    '''
+    Group the queue rows by source (stage 4) and by (source_id, experiment_id, variable) bundle (aggregation)
+
+    Returns:
+        tuple: (sources, bundles), dicts of the queue rows of each source and of each bundle,
+               where a bundle also holds the areacella rows of its source and experiment
+    '''
+    sources = {}
+    bundles = {}
+    area_rows = {}
+    for row in store.select('queue'):
+        source_id, experiment_id, variable = row['source_id'], row['experiment_id'], row['variable']
+        sources.setdefault(source_id, []).append(row)
+        if variable == 'areacella':
+            area_rows.setdefault((source_id, experiment_id), []).append(row)
+        else:
+            bundles.setdefault(f"{variable}_{source_id}_{experiment_id}", []).append(row)
+    for rows in bundles.values():
+        rows += area_rows.get((rows[0]['source_id'], rows[0]['experiment_id']), [])
+    return sources, bundles
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the pipeline stages whose inputs changed since their last run")
+    parser.add_argument('--profile', default=None,
+                        help="selection rules for stage 3 (see 3_generate_queue_for_download.py)")
+    parser.add_argument('--budget', type=float, default=None,
+                        help="storage budget in gigabytes for stage 3")
+    parser.add_argument('--priorities', default=None,
+                        help="bundle priorities for stage 3 --budget")
+    parser.add_argument('--retry', action='store_true',
+                        help="run stage 5 when the list of failed downloads changed")
+    parser.add_argument('--overlap', action='store_true',
+                        help="aggregate during the downloads of stage 4 (4_download_datasets.py --aggregate)")
+    parser.add_argument('--evict', action='store_true',
+                        help="with --overlap, remove raw files once aggregated")
+    parser.add_argument('--high-water-mark', type=float, default=None,
+                        help="with --overlap --evict, cap in gigabytes on the raw files in downloaded/")
+    parser.add_argument('--force', nargs='+', default=[], choices=stages,
+                        help="run all partitions of these stages (e.g., 'search' to refresh the ESGF metadata)")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="only report the partitions that are out of date now, without running anything")
+    args = parser.parse_args()
+    if args.evict and not args.overlap:
+        parser.error("--evict requires --overlap")
+    if args.high_water_mark is not None and not args.evict:
+        parser.error("--high-water-mark requires --overlap --evict (raw files are never removed otherwise)")
+    return args
+
+def main():
+    '''
+    Run stages 1 to 5 and the aggregation like make: the hashes of the inputs and outputs of
+    every partition are kept in database/pipeline_state.json, and only the partitions whose inputs
+    changed (or whose outputs changed or disappeared) since their last run are run again
+     - search (stage 1): one partition per (experiment_id, variable) in config.py
+     - process (stage 2) and queue (stage 3): the whole catalog, as one partition each
+     - download (stage 4): one partition per source in the queue
+     - retry (stage 5, with --retry): the list of failed downloads
+     - aggregate: one partition per (source_id, experiment_id, variable) in the queue
+    Adding an experiment to config.py thus searches only for that experiment, and downloads
+    and aggregates only for the sources whose queue changed
+    '''
+
+    args = parse_args()
+    state = PipelineState()
+    store = MetadataStore()
+
+    def run(stage, partitions, outputs, commands, before=None):
+        return run_stage(state, stage, partitions, outputs, commands, stage in args.force, args.dry_run, before)
+
+    # stage 1
+    searches = [f"{experiment_id}.{variable}" for experiment_id in experiment_ids for variable in variables]
+    # a search without replicas (failed, or nothing published yet) stays out of date and is run again
+    run('search', {search: content_hash(search, search_domains) for search in searches},
+        lambda search: store.digest('replicas', search=search, origin='') if store.count('replicas', search=search, origin='') else None,
+        search_commands)
+
+    # stage 2 (consolidates every source across all searches)
+    run('process', {'catalog': store.digest('replicas', order_by='search, origin, rowid', search=searches)},
+        lambda _: store.digest('files'),
+        lambda _: [['2_process_database.py']])
+
+    # stage 3
+    options = []
+    if args.profile is not None:
+        options += ['--profile', args.profile]
+    if args.budget is not None:
+        options += ['--budget', str(args.budget)]
+    if args.priorities is not None:
+        options += ['--priorities', args.priorities]
+    run('queue', {'catalog': content_hash(store.digest('files'), options, file_hash(args.profile), file_hash(args.priorities))},
+        lambda _: store.digest('queue'),
+        lambda _: [['3_generate_queue_for_download.py'] + options])
+
+    # stage 4
+    sources, bundles = queue_partitions(store)
+
+    def download_outputs(source_id):
+        # None while a file is missing, so that failed downloads are attempted again at the next run
+        evicted = evicted_files()
+        stamps = [(row['filename'], file_stamp(row['filename'], evicted)) for row in sources[source_id]]
+        if any(stamp is None for _, stamp in stamps):
+            return None
+        return content_hash(stamps)
+
+    def aggregate_partitions():
+        evicted = evicted_files()
+        return {bundle: content_hash(rows, [file_stamp(row['filename'], evicted) for row in rows]) for bundle, rows in bundles.items()}
+
+    overlap_options = []
+    if args.overlap:
+        overlap_options.append('--aggregate')
+        if args.evict:
+            overlap_options.append('--evict')
+        if args.high_water_mark is not None:
+            overlap_options += ['--high-water-mark', str(args.high_water_mark)]
+    download_partitions = {source_id: content_hash(rows) for source_id, rows in sources.items()}
+    download_started = time.time()
+    downloaded = run('download', download_partitions, download_outputs,
+                     lambda stale: [['4_download_datasets.py', '--sources'] + stale + overlap_options])
+    if args.overlap and downloaded and not args.dry_run:
+        # bundles aggregated during the downloads are up to date
+        for bundle, inputs in aggregate_partitions().items():
+            output_file_path = os.path.join(aggregated_dir, f"{bundle}.csv")
+            if os.path.isfile(output_file_path) and os.path.getmtime(output_file_path) >= download_started:
+                state.record('aggregate', bundle, inputs, file_hash(output_file_path))
+        state.save()
+
+    # stage 5
+    failed_file_path = os.path.join(download_dir, 'failed_download.txt')
+    if args.retry and os.path.isfile(failed_file_path):
+        retried = run('retry', {'failed': file_hash(failed_file_path)},
+                      lambda _: file_hash(os.path.join(download_dir, 'still_failed_download.txt')),
+                      lambda _: [['5_retry_for_failed_download.py']])
+        if retried and not args.dry_run:
+            # files downloaded by stage 5 complete the outputs of stage 4
+            for source_id in download_partitions:
+                state.record('download', source_id, download_partitions[source_id], download_outputs(source_id))
+            state.save()
+
+    # aggregation
+    def remove_outputs(stale):
+        # the aggregation skips existing outputs, so remove those to be replaced,
+        # except for bundles whose raw files were evicted and cannot be aggregated again
+        evicted = evicted_files()
+        for bundle in stale:
+            output_file_path = os.path.join(aggregated_dir, f"{bundle}.csv")
+            if any(row['filename'] in evicted for row in bundles[bundle]):
+                print(f"===> Keeping {output_file_path}: its raw files were evicted after aggregation")
+            elif os.path.isfile(output_file_path):
+                os.remove(output_file_path)
+
+    def aggregate_commands(stale):
+        stale_sources = sorted({bundles[bundle][0]['source_id'] for bundle in stale})
+        stale_experiments = sorted({bundles[bundle][0]['experiment_id'] for bundle in stale})
+        return [['aggregate_cmip_data.py', '--sources'] + stale_sources + ['--experiments'] + stale_experiments]
+
+    run('aggregate', aggregate_partitions(),
+        lambda bundle: file_hash(os.path.join(aggregated_dir, f"{bundle}.csv")),
+        aggregate_commands, before=remove_outputs)
+
+    store.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,8 @@
 import os
+import hashlib
 import logging
+from logging.handlers import QueueHandler, QueueListener
+from collections import OrderedDict
 import __main__
 
 import numpy as np
@@ -7,11 +10,37 @@ import xarray as xr
 
 script_name, _ = os.path.splitext(os.path.basename(__main__.__file__))
 
-def make_logger(name=script_name):
+# number of days in each month (365-day calendar), used as monthly weights
+numdays_of_month = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+def make_logger(name=script_name, queue=None):
+    '''
+    Return the named logger, adding the stream/file handler pair only once
+
+    In a worker process, pass the queue of the parent's log listener (see make_log_listener)
+    so that records are handed over to the parent instead of written to log.txt directly
+
+    Args:
+        name (str): Logger name
+        queue (multiprocessing.Queue): Queue to the parent's log listener, if any
+
+    Returns:
+        logging.Logger: Configured logger
+    '''
 
     logger = logging.getLogger(name)
     logger.setLevel(logging.DEBUG)
 
+    if queue is not None:
+        # drop handlers inherited from the parent process
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        logger.addHandler(QueueHandler(queue))
+        return logger
+
+    if logger.handlers:
+        return logger
+
     formatter = logging.Formatter(
         '[%(asctime)s %(name)s] %(levelname)s:%(message)s',
         datefmt='%Y-%m-%d %H:%M:%S')
@@ -24,6 +53,22 @@ def make_logger(name=script_name):
 
     return logger
 
+def make_log_listener(logger, queue):
+    '''
+    Start a listener in the parent process that passes records sent by
+    worker processes to the handlers of the given logger one at a time
+
+    Args:
+        logger (logging.Logger): Logger made by make_logger in the parent process
+        queue (multiprocessing.Queue): Queue shared with the worker processes
+
+    Returns:
+        logging.handlers.QueueListener: Started listener, to be stopped after the workers finish
+    '''
+    listener = QueueListener(queue, *logger.handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
 def deg2rad(deg):
     """ Convert degrees to radians.
 
@@ -81,14 +126,9 @@ def area(da):
     dlat_vals = np.gradient(lat_vals)
     dlon_vals = np.gradient(lon_vals)
 
-    # number of latitude/longitude points
-    lat_num = len(lat_vals)
-    lon_num = len(lon_vals)
-
-    # compute area matrix (in square kilometer)
-    A = np.empty((lat_num, lon_num), dtype=float)
-    for i, dlon in enumerate(dlon_vals):
-        A[:,i] = surface_area(lat_vals, dlat_vals, dlon)
+    # compute area matrix (in square kilometer) as an outer product
+    # of the per-latitude strip area (per radian of longitude) and dlon
+    A = np.outer(surface_area(lat_vals, dlat_vals, 1.0), dlon_vals)
 
     # sanity check
     A_true = 510065621 # Earth's surface area in square kilometer
@@ -105,3 +145,209 @@ def area(da):
     array = xr.DataArray(A, dims=dims, coords=coords, attrs=attrs)
 
     return array
+
+def global_mean(data, weights):
+    '''
+    Compute the area-weighted global mean of every timestep at once
+    as a single dot product (missing values count as zero)
+
+    Args:
+        data (numpy.ndarray): Data array of shape (time, lat, lon)
+        weights (numpy.ndarray): Normalized area weights (area / total area) of shape (lat, lon)
+
+    Returns:
+        numpy.ndarray: 1-d array of global mean values, one per timestep
+    '''
+    # a single float64 working copy, with missing values zeroed in place
+    data = np.nan_to_num(np.array(data, dtype=float).reshape(len(data), -1), copy=False)
+    return data @ weights.ravel()
+
+def annual_mean(values, years, months):
+    '''
+    Compute month-length-weighted annual means from monthly values
+    Years without values for all 12 months are dropped
+
+    Args:
+        values (numpy.ndarray): Monthly values
+        years (numpy.ndarray): Year of each monthly value
+        months (numpy.ndarray): Month (1-12) of each monthly value
+
+    Returns:
+        tuple: (years, annual_values), both 1-d arrays sorted by year
+    '''
+    weighted_values = values * numdays_of_month[np.asarray(months) - 1] / 365
+
+    # grouped reduction over year
+    unique_years, inverse, counts = np.unique(years, return_inverse=True, return_counts=True)
+    annual_values = np.bincount(inverse, weights=weighted_values, minlength=len(unique_years))
+
+    # save only if values exist for full year
+    complete = counts == 12
+    return unique_years[complete], annual_values[complete]
+
+def stream_annual_mean(das, weights, memory_budget=512):
+    '''
+    Compute annual global means of data arrays that together form one time series
+    (e.g., the files of a run) without loading them whole
+
+    The data arrays are ordered by their first timestep and read in time chunks
+    sized so that the raw and working copies of a chunk fit in memory_budget
+    Timesteps repeated at a boundary are taken from the earlier array, and
+    years spanning two arrays are combined into one annual value
+
+    Args:
+        das (list): Lazily loaded data arrays of shape (time, lat, lon) on the same grid
+        weights (numpy.ndarray): Normalized area weights of shape (lat, lon)
+        memory_budget (float): Peak memory for one chunk in megabytes
+
+    Returns:
+        tuple: (years, annual_values), both 1-d arrays sorted by year
+    '''
+    das = sorted(das, key=lambda da: da['time'].values[0])
+
+    last_time = None
+    month_values = []
+    years = []
+    months = []
+    for da in das:
+        # skip timesteps already covered by an earlier array
+        time = da['time']
+        start = 0 if last_time is None else int(np.searchsorted(time.values, last_time, side='right'))
+        if start == len(time):
+            continue
+        last_time = time.values[-1]
+
+        # bytes per timestep: the values as read, the fill value mask and the decoded copy
+        # (xarray's masking of _FillValue), plus the float64 working copy of global_mean
+        step_bytes = weights.size * (2 * da.dtype.itemsize + 1 + 8)
+        chunk_size = max(1, int(memory_budget * 1e6 // step_bytes))
+        for chunk_start in range(start, len(time), chunk_size):
+            chunk = da.isel(time=slice(chunk_start, chunk_start + chunk_size))
+            month_values.append(global_mean(chunk.values, weights))
+        years.append(time.dt.year.values[start:])
+        months.append(time.dt.month.values[start:])
+
+    if not month_values:
+        return np.array([], dtype=int), np.array([])
+    return annual_mean(np.concatenate(month_values), np.concatenate(years), np.concatenate(months))
+
+def save_output(file_path, var_id, years, annual_values):
+    '''
+    Write an annual series as a "year,{var_id}" csv file atomically (temporary file, then rename),
+    so that an existing output file is always complete
+
+    Args:
+        file_path (str): Output csv file path
+        var_id (str): Variable name used in the header
+        years (array-like): Years
+        annual_values (array-like): Annual values
+
+    Returns:
+        None
+    '''
+    output_dir, file_name = os.path.split(file_path)
+    tmp_file_path = os.path.join(output_dir, f".{file_name}.{os.getpid()}.tmp")
+    lines = [f"{year},{annual_value}" for year, annual_value in zip(years, annual_values)]
+    with open(tmp_file_path, 'w') as f:
+        f.write(f"year,{var_id}\n")
+        f.write('\n'.join(lines))
+    os.replace(tmp_file_path, file_path)
+
+class AreaWeightCache:
+    '''
+    LRU cache of normalized area weights (area / total area) keyed by grid identity,
+    i.e., model, grid label and a hash of the lat/lon coordinates,
+    so that all variables and experiments of a model on one grid share the weights
+
+    Weights taken from an areacella file are preferred over computed ones
+    If cache_dir is given, weights are also stored there as .npy files
+    and reused across runs and processes
+    '''
+
+    def __init__(self, maxsize=32, cache_dir=None):
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self._weights = OrderedDict()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def grid_key(model_id, grid_label, da):
+        '''
+        Build the grid identity of a data array
+
+        Args:
+            model_id (str): Model (source_id) name
+            grid_label (str): Grid label such as gn or gr
+            da (xarray.DataArray): Data array with latitude and longitude coordinates
+
+        Returns:
+            str: Key of the form {model_id}_{grid_label}_{hash of lat/lon}
+        '''
+        digest = hashlib.sha1()
+        for coord in [da.lat.values, da.lon.values]:
+            digest.update(np.ascontiguousarray(coord, dtype=float).tobytes())
+        return f"{model_id}_{grid_label}_{digest.hexdigest()[:16]}"
+
+    def get(self, model_id, grid_label, da, area_file_path=None):
+        '''
+        Return normalized area weights for the grid of a data array
+
+        Args:
+            model_id (str): Model (source_id) name
+            grid_label (str): Grid label such as gn or gr
+            da (xarray.DataArray): Data array with latitude and longitude coordinates
+            area_file_path (str): Path to the areacella file, used on cache miss if it exists
+
+        Returns:
+            numpy.ndarray: Weights of shape (lat, lon) summing to one
+        '''
+        key = self.grid_key(model_id, grid_label, da)
+        has_area_file = area_file_path is not None and os.path.isfile(area_file_path)
+
+        # computed weights are only reused if no areacella file is available
+        sources = ['areacella'] if has_area_file else ['areacella', 'computed']
+        for source in sources:
+            weights = self._lookup(f"{key}_{source}")
+            if weights is not None:
+                return weights
+
+        if has_area_file:
+            source = 'areacella'
+            with xr.open_dataset(area_file_path) as area_ds:
+                area_data = area_ds[area_ds.variable_id].values
+        else:
+            source = 'computed'
+            area_data = area(da).values
+        weights = area_data / area_data.sum()
+
+        self._store(f"{key}_{source}", weights)
+        return weights
+
+    def _lookup(self, key):
+        if key in self._weights:
+            self._weights.move_to_end(key)
+            return self._weights[key]
+        if self.cache_dir is not None:
+            file_path = os.path.join(self.cache_dir, f"{key}.npy")
+            if os.path.isfile(file_path):
+                weights = np.load(file_path)
+                self._insert(key, weights)
+                return weights
+        return None
+
+    def _store(self, key, weights):
+        self._insert(key, weights)
+        if self.cache_dir is not None:
+            # write to a temporary file first so that concurrent readers never see a partial file
+            file_path = os.path.join(self.cache_dir, f"{key}.npy")
+            tmp_file_path = f"{file_path}.{os.getpid()}.tmp"
+            with open(tmp_file_path, 'wb') as f:
+                np.save(f, weights)
+            os.replace(tmp_file_path, file_path)
+
+    def _insert(self, key, weights):
+        self._weights[key] = weights
+        self._weights.move_to_end(key)
+        while len(self._weights) > self.maxsize:
+            self._weights.popitem(last=False)